@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 import os
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 from datetime import timedelta
 
 
@@ -40,15 +40,18 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'rest_framework_simplejwt',
+    'channels',
     'shipments',
 ]
 
 MIDDLEWARE = [
+    'shipments.middleware.InstrumentationMiddleware',  # First, so it times everything below it
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shipments.middleware.ReadYourWritesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -72,17 +75,50 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'logistics.wsgi.application'
+ASGI_APPLICATION = 'logistics.asgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# Set DB_ENGINE=postgresql (with DB_NAME, DB_USER...) in production; SQLite is for local dev
+if config('DB_ENGINE', default='sqlite3') == 'postgresql':
+    _primary = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': config('DB_NAME', default='logistics'),
+        'USER': config('DB_USER', default='postgres'),
+        'PASSWORD': config('DB_PASSWORD', default=''),
+        'HOST': config('DB_HOST', default='127.0.0.1'),
+        'PORT': config('DB_PORT', default='5432'),
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),  # Seconds to keep connections open; 0 closes after each request
+        'CONN_HEALTH_CHECKS': True,  # Re-check reused connections so a dead one isn't handed to a request
+        'OPTIONS': {'connect_timeout': config('DB_CONNECT_TIMEOUT', default=5, cast=int)},
+    }
+    # Streaming replicas as "host" or "host:port", e.g. DB_REPLICA_HOSTS=replica-1,replica-2:5433
+    _replica_hosts = config('DB_REPLICA_HOSTS', default='', cast=Csv())
+else:
+    _primary = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
     }
-}
+    _replica_hosts = []
+
+DATABASES = {'default': _primary}
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(_replica_hosts, start=1):
+    _host, _, _port = _host.partition(':')
+    DATABASES[f'replica{_index}'] = {
+        **_primary,
+        'HOST': _host,
+        'PORT': _port or _primary['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{_index}')
+
+# Reads go to replicas only in views that opt in (see shipments/db_router.py)
+DATABASE_ROUTERS = ['shipments.db_router.PrimaryReplicaRouter']
+DATABASE_PIN_SECONDS = config('DATABASE_PIN_SECONDS', default=10, cast=int)  # After a write, the user reads from the primary this long
+DATABASE_REPLICA_RETRY_AFTER = config('DATABASE_REPLICA_RETRY_AFTER', default=30, cast=int)  # Seconds to skip a replica that failed to connect
 
 
 # email smtp settings
@@ -187,10 +223,224 @@ if not DEBUG:
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "BACKEND": "shipments.instrumentation.InstrumentedRedisCache",  # RedisCache plus hit/miss counts per request
         "LOCATION": "redis://127.0.0.1:6379/1",
     }
 }
 
+# Shared client for streams and pub/sub (the cache uses db 1, Celery db 0)
+REDIS_URL = config('REDIS_URL', default='redis://127.0.0.1:6379/2')
+REDIS_SOCKET_TIMEOUT = config('REDIS_SOCKET_TIMEOUT', default=2, cast=float)
+
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
-CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'  # Store task results
\ No newline at end of file
+CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'  # Store task results
+
+CELERY_BEAT_SCHEDULE = {
+    "purge-geocode-cache": {
+        "task": "shipments.tasks.purge_geocode_cache",
+        "schedule": timedelta(hours=6),
+    },
+    # Flushes also requeue batches left unacked by a worker that died mid-send
+    "flush-email-notifications": {
+        "task": "shipments.tasks.flush_notifications",
+        "schedule": timedelta(minutes=1),
+        "args": ("email",),
+        "options": {"queue": "notifications.email"},
+    },
+    "flush-sms-notifications": {
+        "task": "shipments.tasks.flush_notifications",
+        "schedule": timedelta(minutes=1),
+        "args": ("sms",),
+        "options": {"queue": "notifications.sms"},
+    },
+    "flush-location-buffer": {
+        "task": "shipments.tasks.flush_location_buffer",
+        "schedule": timedelta(seconds=config('LOCATION_FLUSH_INTERVAL', default=5, cast=int)),
+    },
+    "compact-location-history": {
+        "task": "shipments.tasks.compact_location_history",
+        "schedule": timedelta(hours=24),
+    },
+    # Requests never enqueue tasks for parcel events; the relay polls the outbox
+    "relay-parcel-events": {
+        "task": "shipments.tasks.relay_parcel_events",
+        "schedule": timedelta(seconds=config('OUTBOX_RELAY_INTERVAL', default=1, cast=float)),
+    },
+    "purge-parcel-events": {
+        "task": "shipments.tasks.purge_parcel_events",
+        "schedule": timedelta(hours=24),
+    },
+    "recount-driver-loads": {
+        "task": "shipments.tasks.recount_driver_loads",
+        "schedule": timedelta(hours=1),
+    },
+    "recompute-etas": {
+        "task": "shipments.tasks.recompute_etas",
+        "schedule": timedelta(seconds=config('ETA_REFRESH_INTERVAL', default=120, cast=int)),
+    },
+    # The webhook only stores events; this applies them in batches
+    "process-stripe-events": {
+        "task": "shipments.tasks.process_stripe_events",
+        "schedule": timedelta(seconds=config('STRIPE_EVENTS_INTERVAL', default=1, cast=float)),
+    },
+    "purge-stripe-events": {
+        "task": "shipments.tasks.purge_stripe_events",
+        "schedule": timedelta(hours=24),
+    },
+    "roll-up-analytics": {
+        "task": "shipments.tasks.roll_up_analytics",
+        "schedule": timedelta(seconds=config('ANALYTICS_ROLLUP_INTERVAL', default=60, cast=int)),
+    },
+    "archive-parcels": {
+        "task": "shipments.tasks.archive_parcels",
+        "schedule": timedelta(hours=24),
+    },
+}
+if config('DISPATCH_AUTO_INTERVAL', default=0, cast=int):
+    CELERY_BEAT_SCHEDULE["auto-dispatch-parcels"] = {
+        "task": "shipments.tasks.auto_dispatch_parcels",
+        "schedule": timedelta(seconds=config('DISPATCH_AUTO_INTERVAL', cast=int)),
+    }
+
+# Notifications: messages are queued per channel and sent in batches. Each
+# channel's flushes go to its own Celery queue (notifications.email,
+# notifications.sms) so they get separate worker pools, e.g.
+# `celery -A logistics worker -Q notifications.sms -c 4`
+NOTIFY_BACKEND = config('NOTIFY_BACKEND', default='live')  # live | fake (records instead of sending)
+NOTIFY_QUEUE_BACKEND = config('NOTIFY_QUEUE_BACKEND', default='redis')  # redis | memory
+NOTIFY_BATCH_WINDOW = config('NOTIFY_BATCH_WINDOW', default=1.0, cast=float)  # Seconds to collect a batch
+NOTIFY_BATCH_SIZE = config('NOTIFY_BATCH_SIZE', default=100, cast=int)
+NOTIFY_DEDUPE_WINDOW = config('NOTIFY_DEDUPE_WINDOW', default=300, cast=int)  # Identical messages within this are dropped
+NOTIFY_MAX_ATTEMPTS = config('NOTIFY_MAX_ATTEMPTS', default=3, cast=int)
+NOTIFY_ACK_TIMEOUT = config('NOTIFY_ACK_TIMEOUT', default=300, cast=int)  # Seconds before an unacked batch is requeued
+NOTIFY_SMS_WORKERS = config('NOTIFY_SMS_WORKERS', default=8, cast=int)  # Concurrent Twilio requests per worker process
+NOTIFY_SMS_TIMEOUT = config('NOTIFY_SMS_TIMEOUT', default=10, cast=float)
+NOTIFY_FAKE_LATENCY = config('NOTIFY_FAKE_LATENCY', default=0.0, cast=float)
+
+# Parcel event outbox
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=200, cast=int)
+OUTBOX_MAX_ATTEMPTS = config('OUTBOX_MAX_ATTEMPTS', default=10, cast=int)
+OUTBOX_RELAY_LOCK_TTL = config('OUTBOX_RELAY_LOCK_TTL', default=60, cast=int)
+OUTBOX_RETENTION_DAYS = config('OUTBOX_RETENTION_DAYS', default=7, cast=int)
+
+# Auto-dispatch (set DISPATCH_AUTO_INTERVAL to a number of seconds to run it from beat)
+DISPATCH_MAX_PARCELS = config('DISPATCH_MAX_PARCELS', default=5000, cast=int)  # Backlog size per run
+DISPATCH_MAX_DISTANCE_KM = config('DISPATCH_MAX_DISTANCE_KM', default=25, cast=float)
+DISPATCH_CANDIDATES = config('DISPATCH_CANDIDATES', default=5, cast=int)  # Nearest drivers considered per parcel
+DISPATCH_CELL_KM = config('DISPATCH_CELL_KM', default=2, cast=float)
+DISPATCH_DRIVER_STALE_AFTER = config('DISPATCH_DRIVER_STALE_AFTER', default=600, cast=int)  # Seconds since last position
+DRIVER_POSITION_WRITE_INTERVAL = config('DRIVER_POSITION_WRITE_INTERVAL', default=15, cast=int)
+
+# Nearby queries
+SPATIAL_MAX_RADIUS_KM = config('SPATIAL_MAX_RADIUS_KM', default=50, cast=float)
+SPATIAL_MAX_CANDIDATES = config('SPATIAL_MAX_CANDIDATES', default=20000, cast=int)  # Rows read before the exact distance pass
+SPATIAL_MAX_RESULTS = config('SPATIAL_MAX_RESULTS', default=500, cast=int)
+
+# Route planning
+ROUTE_OPTIMIZE_TIME_LIMIT = config('ROUTE_OPTIMIZE_TIME_LIMIT', default=2.0, cast=float)  # Seconds of 2-opt per plan
+ROUTE_CACHE_TTL = config('ROUTE_CACHE_TTL', default=60 * 60 * 12, cast=int)
+ROUTE_MATRIX_CACHE_SIZE = config('ROUTE_MATRIX_CACHE_SIZE', default=256, cast=int)  # Distance matrices kept per process
+ROUTE_PLAN_DEBOUNCE = config('ROUTE_PLAN_DEBOUNCE', default=5, cast=int)
+
+# ETA estimates
+ETA_DEFAULT_SPEED_KMH = config('ETA_DEFAULT_SPEED_KMH', default=25, cast=float)  # Until a driver's speed is known
+ETA_MIN_SPEED_KMH = config('ETA_MIN_SPEED_KMH', default=5, cast=float)
+ETA_MAX_SPEED_KMH = config('ETA_MAX_SPEED_KMH', default=120, cast=float)
+ETA_SPEED_ALPHA = config('ETA_SPEED_ALPHA', default=0.3, cast=float)  # Weight of the newest speed observation
+ETA_SPEED_MIN_INTERVAL = config('ETA_SPEED_MIN_INTERVAL', default=5, cast=float)  # Seconds between positions to trust a speed
+ETA_SPEED_MAX_INTERVAL = config('ETA_SPEED_MAX_INTERVAL', default=900, cast=float)
+ETA_ROAD_FACTOR = config('ETA_ROAD_FACTOR', default=1.3, cast=float)  # Road distance / straight-line distance
+ETA_STOP_MINUTES = config('ETA_STOP_MINUTES', default=5, cast=float)  # Per earlier stop on the route
+ETA_MIN_CHANGE = config('ETA_MIN_CHANGE', default=60, cast=int)  # Seconds an ETA must move before the fleet refresh rewrites it
+
+# Analytics rollups
+ANALYTICS_BATCH_SIZE = config('ANALYTICS_BATCH_SIZE', default=5000, cast=int)  # Parcel events folded per transaction
+ANALYTICS_SETTLE_SECONDS = config('ANALYTICS_SETTLE_SECONDS', default=5, cast=int)  # Age before an event is counted
+ANALYTICS_MAX_DAYS = config('ANALYTICS_MAX_DAYS', default=366, cast=int)  # Longest range a report can ask for
+
+# Payments
+PAYMENT_GATEWAY = config('PAYMENT_GATEWAY', default='stripe')  # stripe | stub (local, for load tests)
+PAYMENT_ASYNC = config('PAYMENT_ASYNC', default=False, cast=bool)  # Charge from a worker and answer 202 straight away
+PAYMENT_SUBMIT_LOCK_TTL = config('PAYMENT_SUBMIT_LOCK_TTL', default=60, cast=int)  # Longest expected gateway call
+PAYMENT_STUB_LATENCY = config('PAYMENT_STUB_LATENCY', default=0.0, cast=float)
+
+# Stripe webhook events
+STRIPE_EVENTS_BATCH_SIZE = config('STRIPE_EVENTS_BATCH_SIZE', default=200, cast=int)
+STRIPE_EVENTS_MAX_ATTEMPTS = config('STRIPE_EVENTS_MAX_ATTEMPTS', default=10, cast=int)
+STRIPE_EVENTS_RETENTION_DAYS = config('STRIPE_EVENTS_RETENTION_DAYS', default=30, cast=int)  # Duplicates are recognised for this long
+
+# Parcel exports
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=5000, cast=int)  # Rows per cursor fetch and per streamed chunk
+
+# Parcel archive: terminal parcels move to ArchivedParcel after this many days
+ARCHIVE_AFTER_DAYS = config('ARCHIVE_AFTER_DAYS', default=90, cast=int)
+ARCHIVE_BATCH_SIZE = config('ARCHIVE_BATCH_SIZE', default=1000, cast=int)  # Parcels moved per transaction
+
+# Geocoding
+GEOCODING_TIMEOUT = config('GEOCODING_TIMEOUT', default=5, cast=float)  # seconds per Google API call
+GEOCODE_CACHE_TTL = config('GEOCODE_CACHE_TTL', default=60 * 60 * 24 * 30, cast=int)  # 30 days
+GEOCODE_NEGATIVE_CACHE_TTL = config('GEOCODE_NEGATIVE_CACHE_TTL', default=60 * 60, cast=int)
+
+# Bulk parcel ingestion
+BULK_PARCEL_MAX_ROWS = config('BULK_PARCEL_MAX_ROWS', default=10000, cast=int)
+BULK_PARCEL_CHUNK_SIZE = config('BULK_PARCEL_CHUNK_SIZE', default=500, cast=int)
+BULK_GEOCODE_BATCH_SIZE = config('BULK_GEOCODE_BATCH_SIZE', default=200, cast=int)
+
+# Driver location ingestion: "direct" saves every ping, "buffered" appends to
+# the location buffer and lets the periodic flusher write batched updates
+LOCATION_INGEST_MODE = config('LOCATION_INGEST_MODE', default='direct')
+LOCATION_BUFFER_BACKEND = config('LOCATION_BUFFER_BACKEND', default='redis')  # redis | memory
+LOCATION_BUFFER_RETRY_AFTER = config('LOCATION_BUFFER_RETRY_AFTER', default=30, cast=int)  # Seconds to write pings directly after Redis failed
+LOCATION_STREAM_MAXLEN = config('LOCATION_STREAM_MAXLEN', default=1_000_000, cast=int)
+LOCATION_LATEST_TTL = config('LOCATION_LATEST_TTL', default=60 * 60 * 24, cast=int)
+LOCATION_FLUSH_BATCH_SIZE = config('LOCATION_FLUSH_BATCH_SIZE', default=5000, cast=int)
+LOCATION_ASSIGNMENT_CACHE_TTL = config('LOCATION_ASSIGNMENT_CACHE_TTL', default=60, cast=int)
+
+# Location history (one packed row per parcel/driver per day)
+LOCATION_HISTORY_ENABLED = config('LOCATION_HISTORY_ENABLED', default=True, cast=bool)
+LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS = config('LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS', default=7, cast=int)
+LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION = config('LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION', default=60, cast=int)  # seconds
+LOCATION_HISTORY_RETENTION_DAYS = config('LOCATION_HISTORY_RETENTION_DAYS', default=180, cast=int)
+LOCATION_HISTORY_MAX_WINDOW_DAYS = config('LOCATION_HISTORY_MAX_WINDOW_DAYS', default=31, cast=int)
+
+# Tracking cache (seconds)
+TRACKING_CACHE_TTL = config('TRACKING_CACHE_TTL', default=300, cast=int)
+TRACKING_CACHE_TERMINAL_TTL = config('TRACKING_CACHE_TERMINAL_TTL', default=3600, cast=int)
+TRACKING_CACHE_NOT_FOUND_TTL = config('TRACKING_CACHE_NOT_FOUND_TTL', default=30, cast=int)
+TRACKING_CACHE_STALE_TTL = config('TRACKING_CACHE_STALE_TTL', default=600, cast=int)  # How long past freshness an entry may be served
+TRACKING_CACHE_STALE_WHILE_REVALIDATE = config('TRACKING_CACHE_STALE_WHILE_REVALIDATE', default=True, cast=bool)
+TRACKING_CACHE_LOCK_TTL = config('TRACKING_CACHE_LOCK_TTL', default=5, cast=int)
+TRACKING_CACHE_LOCK_WAIT = config('TRACKING_CACHE_LOCK_WAIT', default=1, cast=float)
+# Process-local tier in front of Redis, kept coherent over pub/sub
+TRACKING_L1_ENABLED = config('TRACKING_L1_ENABLED', default=True, cast=bool)
+TRACKING_L1_MAX_ENTRIES = config('TRACKING_L1_MAX_ENTRIES', default=10000, cast=int)
+TRACKING_L1_TTL = config('TRACKING_L1_TTL', default=5, cast=float)
+TRACKING_INVALIDATION_CHANNEL = config('TRACKING_INVALIDATION_CHANNEL', default='tracking:invalidate')
+
+# Seconds between pushes of in-process metric increments to the shared cache
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=1.0, cast=float)
+
+# Request instrumentation (per-view counters on /metrics, slow-request log)
+INSTRUMENTATION_ENABLED = config('INSTRUMENTATION_ENABLED', default=True, cast=bool)
+SLOW_REQUEST_SECONDS = config('SLOW_REQUEST_SECONDS', default=1.0, cast=float)
+SLOW_REQUEST_TOP_QUERIES = config('SLOW_REQUEST_TOP_QUERIES', default=5, cast=int)  # Statements listed per slow request
+SLOW_REQUEST_SQL_CHARS = config('SLOW_REQUEST_SQL_CHARS', default=300, cast=int)  # Each statement is cut to this length
+METRICS_TOKEN = config('METRICS_TOKEN', default='')  # Lets a scraper read /metrics with "Authorization: Token <value>"
+
+# Real-time push (WebSocket/SSE). The Redis layer is required once more than
+# one ASGI process serves subscribers; "memory" is for tests and single-process dev.
+if config('CHANNEL_LAYER_BACKEND', default='redis') == 'memory':
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [config('CHANNEL_LAYER_REDIS_URL', default='redis://127.0.0.1:6379/3')],
+                "capacity": config('CHANNEL_LAYER_CAPACITY', default=100, cast=int),  # Per-connection backlog before messages are dropped
+                "expiry": 10,
+            },
+        },
+    }
+PUSH_MIN_INTERVAL = config('PUSH_MIN_INTERVAL', default=0.25, cast=float)  # Seconds between sends to one connection
+PUSH_HEARTBEAT_INTERVAL = config('PUSH_HEARTBEAT_INTERVAL', default=15, cast=float)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Driver, Parcel
+from .models import ArchivedParcel, Driver, Parcel
 
 
 @admin.register(Driver)
@@ -13,12 +13,28 @@ class DriverAdmin(admin.ModelAdmin):
 
 @admin.register(Parcel)
 class ParcelAdmin(admin.ModelAdmin):
-    list_display = ("tracking_code", "sender", "receiver", "origin", "destination", "status", "assigned_driver", "payment_status", "created_at")  
-    search_fields = ("tracking_code", "sender", "receiver", "origin", "destination")
-    list_filter = ("status", "is_paid", "is_delivered", "created_at")
+    list_display = ("tracking_code", "sender", "recipient_name", "origin", "destination", "status", "assigned_driver", "payment_status", "created_at")
+    search_fields = ("tracking_code", "sender__username", "recipient_name", "origin", "destination")
+    list_filter = ("status", "payment_status", "created_at")
+    list_select_related = ("sender", "assigned_driver")
+    raw_id_fields = ("sender", "assigned_driver")
     ordering = ("-created_at",)
     readonly_fields = ("created_at",)
     fieldsets = (
-        ("Parcel Information", {"fields": ("tracking_code", "sender", "receiver", "origin", "destination", "weight", "status")}),
-        ("Driver & Payment", {"fields": ("assigned_driver", "is_paid", "is_delivered")}),
+        ("Parcel Information", {"fields": ("tracking_code", "sender", "recipient_name", "recipient_address", "recipient_phone", "origin", "destination", "status")}),
+        ("Driver & Payment", {"fields": ("assigned_driver", "price", "payment_status")}),
     )
+
+
+@admin.register(ArchivedParcel)
+class ArchivedParcelAdmin(admin.ModelAdmin):
+    list_display = ("tracking_code", "sender", "recipient_name", "origin", "destination", "status", "payment_status", "created_at", "archived_at")
+    search_fields = ("tracking_code", "recipient_name", "origin", "destination")
+    list_filter = ("status", "payment_status", "archived_at")
+    ordering = ("-created_at",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,223 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import ArchivedParcel, DriverDailyRollup, Parcel, ParcelEvent, RevenueDailyRollup, RollupCursor, StatusDailyRollup
+
+logger = logging.getLogger(__name__)
+
+CURSOR = "parcel_events"
+
+DELIVERED_STATUSES = ("delivered", "confirmed")
+
+
+class Deltas:
+    """
+    Increments to apply to the rollup tables, keyed by each table's unique fields.
+    """
+    def __init__(self):
+        self.statuses = defaultdict(lambda: [0, 0])  # (day, status): [entered, left]
+        self.drivers = defaultdict(lambda: [0, 0])  # (day, driver_id): [assigned, delivered]
+        self.revenue = defaultdict(lambda: [0, Decimal(0)])  # (day, payment_status): [parcels, amount]
+
+    def transition(self, day, status, previous=None, count=1):
+        self.statuses[day, status][0] += count
+        if previous is not None:
+            self.statuses[day, previous][1] += count
+
+    def payment(self, day, payment_status, amount, count=1):
+        totals = self.revenue[day, payment_status]
+        totals[0] += count
+        totals[1] += amount
+
+    def add_event(self, event):
+        day = timezone.localdate(event.created_at)
+        data = event.data
+        if event.kind == "created":
+            self.transition(day, data["status"])
+            self.payment(day, data.get("payment_status", "pending"), Decimal(data.get("price", 0)))
+        elif event.kind == "status_changed":
+            self.transition(day, data["status"], data.get("previous_status"))
+            if data["status"] == "delivered" and data.get("assigned_driver_id"):
+                self.drivers[day, data["assigned_driver_id"]][1] += 1
+        elif event.kind == "driver_assigned":
+            # Carries the status change when the parcel moved to "assigned" with it
+            if "previous_status" in data:
+                self.transition(day, data["status"], data["previous_status"])
+            self.drivers[day, data["assigned_driver_id"]][0] += 1
+        elif event.kind == "payment_updated":
+            self.payment(day, data["payment_status"], Decimal(data.get("price", 0)))
+
+    def apply(self):
+        _apply(StatusDailyRollup, ("day", "status"), ("entered", "left"), self.statuses)
+        _apply(DriverDailyRollup, ("day", "driver_id"), ("assigned", "delivered"), self.drivers)
+        _apply(RevenueDailyRollup, ("day", "payment_status"), ("parcels", "amount"), self.revenue)
+
+
+def _apply(model, key_fields, value_fields, deltas):
+    """
+    Adds `deltas` to the matching rows (creating missing ones) with one read
+    and at most one bulk insert and one bulk update.
+    """
+    if not deltas:
+        return
+    keys = Q()
+    for key in deltas:
+        keys |= Q(**dict(zip(key_fields, key)))
+    existing = {
+        tuple(getattr(row, field) for field in key_fields): row
+        for row in model.objects.filter(keys)
+    }
+    created, updated = [], []
+    for key, values in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            row = model(**dict(zip(key_fields, key)))
+            created.append(row)
+        else:
+            updated.append(row)
+        for field, delta in zip(value_fields, values):
+            setattr(row, field, getattr(row, field) + delta)
+    model.objects.bulk_create(created, batch_size=500)
+    model.objects.bulk_update(updated, value_fields, batch_size=500)
+
+
+def _lock_cursor():
+    cursor, _ = RollupCursor.objects.select_for_update().get_or_create(name=CURSOR)
+    return cursor
+
+
+def cursor_position():
+    return RollupCursor.objects.filter(name=CURSOR).values_list("last_event_id", flat=True).first() or 0
+
+
+def roll_up(batch_size=None):
+    """
+    Folds new ParcelEvents into the rollup tables. Each batch and the cursor
+    move commit together under the cursor's row lock, so events are counted
+    exactly once however often this runs. Events younger than
+    ANALYTICS_SETTLE_SECONDS are left for the next run, giving transactions
+    that took a lower id time to commit. Returns the number of events counted.
+    """
+    batch_size = batch_size or settings.ANALYTICS_BATCH_SIZE
+    settled = timezone.now() - timedelta(seconds=settings.ANALYTICS_SETTLE_SECONDS)
+    total = 0
+    while True:
+        with transaction.atomic():
+            cursor = _lock_cursor()
+            events = list(
+                ParcelEvent.objects.filter(id__gt=cursor.last_event_id, created_at__lt=settled)
+                .order_by("id").only("id", "kind", "data", "created_at")[:batch_size]
+            )
+            if not events:
+                break
+            deltas = Deltas()
+            for event in events:
+                deltas.add_event(event)
+            deltas.apply()
+            cursor.last_event_id = events[-1].pk
+            cursor.save(update_fields=["last_event_id", "updated_at"])
+        total += len(events)
+        if len(events) < batch_size:
+            break
+    return total
+
+
+def rebuild():
+    """
+    Recomputes the rollups from the parcel and archive tables and moves the
+    cursor past every existing event. Parcels only record their current
+    state, so the rebuild counts one transition from pending to the current
+    status on the day of the last update, and assignments and payments on
+    that day too.
+    """
+    deltas = Deltas()
+    with transaction.atomic():
+        cursor = _lock_cursor()
+        cursor.last_event_id = ParcelEvent.objects.aggregate(last=Max("id"))["last"] or 0
+
+        # Archived parcels still count toward the days they were active on
+        for model in (Parcel, ArchivedParcel):
+            created = (
+                model.objects.annotate(day=TruncDate("created_at"))
+                .values("day").annotate(total=Count("id"), amount=Sum("price"))
+            )
+            for row in created:
+                deltas.transition(row["day"], "pending", count=row["total"])
+                deltas.payment(row["day"], "pending", row["amount"] or 0, count=row["total"])
+
+            moved = (
+                model.objects.exclude(status="pending").annotate(day=TruncDate("updated_at"))
+                .values("day", "status").annotate(total=Count("id"))
+            )
+            for row in moved:
+                deltas.transition(row["day"], row["status"], "pending", count=row["total"])
+
+            paid = (
+                model.objects.exclude(payment_status="pending").annotate(day=TruncDate("updated_at"))
+                .values("day", "payment_status").annotate(total=Count("id"), amount=Sum("price"))
+            )
+            for row in paid:
+                deltas.payment(row["day"], row["payment_status"], row["amount"] or 0, count=row["total"])
+
+            by_driver = (
+                model.objects.filter(assigned_driver__isnull=False).annotate(day=TruncDate("updated_at"))
+                .values("day", "assigned_driver")
+                .annotate(total=Count("id"), delivered=Count("id", filter=Q(status__in=DELIVERED_STATUSES)))
+            )
+            for row in by_driver:
+                totals = deltas.drivers[row["day"], row["assigned_driver"]]
+                totals[0] += row["total"]
+                totals[1] += row["delivered"]
+
+        StatusDailyRollup.objects.all().delete()
+        DriverDailyRollup.objects.all().delete()
+        RevenueDailyRollup.objects.all().delete()
+        deltas.apply()
+        cursor.save(update_fields=["last_event_id", "updated_at"])
+    logger.info(f"Rebuilt analytics rollups up to event {cursor.last_event_id}")
+    return cursor.last_event_id
+
+
+# Reads: bounded by days in the range, never by the number of parcels
+
+def status_report(start, end):
+    rows = list(
+        StatusDailyRollup.objects.filter(day__range=(start, end))
+        .order_by("day", "status").values("day", "status", "entered", "left")
+    )
+    current = {
+        row["status"]: row["entered"] - row["left"]
+        for row in StatusDailyRollup.objects.values("status").annotate(entered=Sum("entered"), left=Sum("left"))
+    }
+    return {"days": rows, "current": current}
+
+
+def revenue_report(start, end):
+    queryset = RevenueDailyRollup.objects.filter(day__range=(start, end))
+    rows = list(queryset.order_by("day", "payment_status").values("day", "payment_status", "parcels", "amount"))
+    totals = {
+        row["payment_status"]: {"parcels": row["parcels"], "amount": row["amount"]}
+        for row in queryset.values("payment_status").annotate(parcels=Sum("parcels"), amount=Sum("amount"))
+    }
+    return {"days": rows, "totals": totals}
+
+
+def driver_report(start, end, driver_id=None, limit=50):
+    queryset = DriverDailyRollup.objects.filter(day__range=(start, end))
+    if driver_id is not None:
+        return {
+            "driver": driver_id,
+            "days": list(queryset.filter(driver_id=driver_id).order_by("day").values("day", "assigned", "delivered")),
+        }
+    drivers = list(
+        queryset.values("driver_id", "driver__name")
+        .annotate(assigned=Sum("assigned"), delivered=Sum("delivered"))
+        .order_by("-delivered", "driver_id")[:limit]
+    )
+    return {"drivers": drivers}
@@ -0,0 +1,44 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedParcel, Parcel
+from .tracking import TERMINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Every archive column except archived_at, read straight from the hot table
+COLUMNS = tuple(field.attname for field in ArchivedParcel._meta.concrete_fields if field.name != "archived_at")
+
+
+def archive_parcels(batch_size=None):
+    """
+    Moves parcels that have sat in a terminal status for ARCHIVE_AFTER_DAYS
+    into ArchivedParcel, ARCHIVE_BATCH_SIZE at a time. Each batch is copied
+    and deleted in one transaction, with rows claimed by SKIP LOCKED so a
+    parcel being refunded right now waits for the next run. Returns the
+    number of parcels archived.
+    """
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS)
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Parcel.objects.select_for_update(skip_locked=True)
+                .filter(status__in=TERMINAL_STATUSES, updated_at__lt=cutoff)
+                .values(*COLUMNS).order_by("updated_at")[:batch_size]
+            )
+            if not rows:
+                break
+            ArchivedParcel.objects.bulk_create([ArchivedParcel(**row) for row in rows])
+            # Parcel events are kept (parcel set to null); attempts and tracks keep the id
+            Parcel.objects.filter(pk__in=[row["id"] for row in rows]).delete()
+        archived += len(rows)
+        if len(rows) < batch_size:
+            break
+    if archived:
+        logger.info(f"Archived {archived} parcels")
+    return archived
+
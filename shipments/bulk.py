@@ -0,0 +1,128 @@
+import codecs
+import csv
+import json
+import logging
+from itertools import islice
+from django.conf import settings
+from django.db import transaction
+from . import notifications, versioning
+from .serializers import ParcelBulkSerializer
+from .tasks import geocode_parcels
+
+logger = logging.getLogger(__name__)
+
+CSV_CONTENT_TYPES = ("text/csv", "application/csv")
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def _iter_lines(stream):
+    """
+    Reads the request body line by line so the upload is never held in memory
+    as a whole.
+    """
+    return codecs.iterdecode(iter(stream.readline, b""), "utf-8-sig")
+
+
+def _csv_rows(lines):
+    for row in csv.DictReader(lines):
+        # Empty cells mean "not provided" so optional fields fall back to their defaults
+        yield {key: value for key, value in row.items() if key and value not in ("", None)}, None
+
+
+def _ndjson_rows(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield None, {"non_field_errors": [f"Invalid JSON: {e}"]}
+            continue
+        if not isinstance(row, dict):
+            yield None, {"non_field_errors": ["Each line must be a JSON object."]}
+            continue
+        yield row, None
+
+
+def iter_rows(stream, content_type):
+    """
+    Yields (row, parse_error) pairs from a CSV or NDJSON request body.
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in CSV_CONTENT_TYPES:
+        return _csv_rows(_iter_lines(stream))
+    if content_type in NDJSON_CONTENT_TYPES:
+        return _ndjson_rows(_iter_lines(stream))
+    raise UnsupportedFormat(f"Unsupported content type '{content_type}'. Use text/csv or application/x-ndjson.")
+
+
+def ingest(stream, content_type, sender):
+    """
+    Validates and inserts parcels chunk by chunk with bulk_create, then queues
+    geocoding and a single summary notification. Returns a per-row report.
+    """
+    chunk_size = settings.BULK_PARCEL_CHUNK_SIZE
+    max_rows = settings.BULK_PARCEL_MAX_ROWS
+    rows = enumerate(iter_rows(stream, content_type), start=1)
+    results = []
+    created_ids = []
+    truncated = False
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        if chunk[-1][0] > max_rows:
+            chunk = [item for item in chunk if item[0] <= max_rows]
+            truncated = True
+
+        parseable = [(number, row) for number, (row, error) in chunk if error is None]
+        for number, (row, error) in chunk:
+            if error is not None:
+                results.append({"row": number, "status": "error", "errors": error})
+
+        serializer = ParcelBulkSerializer(data=[row for _, row in parseable], many=True)
+        serializer.is_valid()
+        for index, errors in serializer.row_errors.items():
+            results.append({"row": parseable[index][0], "status": "error", "errors": errors})
+        if serializer.valid_indexes:
+            parcels = serializer.save(sender=sender)
+            for index, parcel in zip(serializer.valid_indexes, parcels):
+                results.append({
+                    "row": parseable[index][0],
+                    "status": "created",
+                    "id": str(parcel.id),
+                    "tracking_code": parcel.tracking_code,
+                })
+                created_ids.append(str(parcel.id))
+
+        if truncated:
+            break
+
+    results.sort(key=lambda result: result["row"])
+    if created_ids:
+        transaction.on_commit(lambda: versioning.touch_dashboards([sender.pk]))
+        batch = settings.BULK_GEOCODE_BATCH_SIZE
+        for start in range(0, len(created_ids), batch):
+            ids = created_ids[start:start + batch]
+            transaction.on_commit(lambda ids=ids: geocode_parcels.delay(ids))
+        if sender.email:
+            count = len(created_ids)
+            transaction.on_commit(lambda: notifications.notify_email(
+                "Parcels Registered",
+                f"{count} parcels from your manifest have been registered.",
+                [sender.email],
+            ))
+
+    return {
+        "created": len(created_ids),
+        "failed": sum(1 for result in results if result["status"] == "error"),
+        "truncated": truncated,
+        "max_rows": max_rows,
+        "results": results,
+    }
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse, StreamingHttpResponse
+from . import ids, push, tracking
+
+logger = logging.getLogger(__name__)
+
+
+@database_sync_to_async
+def _user_from_token(raw_token):
+    from rest_framework.exceptions import AuthenticationFailed
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return AnonymousUser()
+
+
+def _token_from_scope(scope):
+    """
+    Browsers can't set headers on WebSocket/EventSource requests, so the JWT
+    may also come as ?token=.
+    """
+    for name, value in scope.get("headers", []):
+        if name == b"authorization" and value.startswith(b"Bearer "):
+            return value[7:].decode()
+    token = parse_qs(scope.get("query_string", b"").decode()).get("token")
+    return token[0] if token else None
+
+
+class JWTAuthMiddleware:
+    """
+    Populates scope["user"] from a SimpleJWT access token.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        token = _token_from_scope(scope)
+        scope = dict(scope, user=await _user_from_token(token) if token else AnonymousUser())
+        return await self.app(scope, receive, send)
+
+
+def _can_watch_driver(user, driver_id):
+    return user.is_authenticated and (user.role == "admin" or user.pk == driver_id)
+
+
+def _coalesce(coalescer, event, message):
+    if "parcels" in event["data"]:
+        # Driver-group positions cover several parcels; merge rather than replace
+        coalescer.put(f"{event['kind']}:parcels", message, merge=push.merge_positions)
+    else:
+        coalescer.put(f"{event['kind']}:{event['data'].get('tracking_code', '')}", message)
+
+
+class ParcelUpdatesConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Streams status and location updates for one tracking code
+    (ws/track/<code>/) or for all of a driver's parcels (ws/drivers/<id>/).
+    """
+    async def connect(self):
+        user = self.scope["user"]
+        kwargs = self.scope["url_route"]["kwargs"]
+        if "driver_id" in kwargs:
+            if not _can_watch_driver(user, kwargs["driver_id"]):
+                await self.close(code=4403)
+                return
+            self.group = push.driver_group(kwargs["driver_id"])
+            snapshot = None
+        else:
+            if not user.is_authenticated:
+                await self.close(code=4401)
+                return
+            # Hand-typed variants must join the same group the publisher uses
+            tracking_code = ids.normalize_tracking_code(kwargs["tracking_code"])
+            snapshot = await database_sync_to_async(tracking.get)(tracking_code)
+            if snapshot is None:
+                await self.close(code=4404)  # As the SSE endpoint's 404
+                return
+            self.group = push.tracking_group(tracking_code)
+
+        self.coalescer = push.Coalescer()
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+        if snapshot is not None:
+            await self.send_json({"kind": "status", "data": snapshot})
+        self.sender = asyncio.create_task(self._send_loop())
+
+    async def disconnect(self, code):
+        if hasattr(self, "sender"):
+            self.sender.cancel()
+        if hasattr(self, "group"):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def parcel_update(self, event):
+        _coalesce(self.coalescer, event, {"kind": event["kind"], "data": event["data"]})
+
+    async def _send_loop(self):
+        while True:
+            for message in await self.coalescer.next_batch():
+                await self.send_json(message)
+
+
+async def _sse_stream(group, snapshot):
+    layer = get_channel_layer()
+    channel = await layer.new_channel()
+    await layer.group_add(group, channel)
+    coalescer = push.Coalescer()
+
+    async def receive():
+        while True:
+            event = await layer.receive(channel)
+            _coalesce(coalescer, event, event)
+
+    receiver = asyncio.create_task(receive())
+    try:
+        yield "retry: 3000\n\n"
+        if snapshot is not None:
+            yield f"event: status\ndata: {json.dumps(snapshot)}\n\n"
+        while True:
+            batch = await coalescer.next_batch(timeout=settings.PUSH_HEARTBEAT_INTERVAL)
+            if not batch:
+                yield ": keepalive\n\n"  # Keeps proxies from closing an idle stream
+            for event in batch:
+                yield f"event: {event['kind']}\ndata: {json.dumps(event['data'])}\n\n"
+    finally:
+        receiver.cancel()
+        await layer.group_discard(group, channel)
+
+
+async def _request_user(request):
+    header = request.headers.get("Authorization", "")
+    token = header[7:] if header.startswith("Bearer ") else request.GET.get("token")
+    return await _user_from_token(token) if token else AnonymousUser()
+
+
+def _event_stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Disable nginx response buffering
+    return response
+
+
+async def track_parcel_events(request, tracking_code):
+    """
+    Server-Sent Events variant of ws/track/<code>/ for clients that can't
+    use WebSockets. Requires the ASGI server.
+    """
+    user = await _request_user(request)
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    tracking_code = ids.normalize_tracking_code(tracking_code)
+    snapshot = await database_sync_to_async(tracking.get)(tracking_code)
+    if snapshot is None:
+        return HttpResponse(status=404)
+    return _event_stream_response(_sse_stream(push.tracking_group(tracking_code), snapshot))
+
+
+async def driver_events(request, driver_id):
+    user = await _request_user(request)
+    if not _can_watch_driver(user, driver_id):
+        return HttpResponse(status=403)
+    return _event_stream_response(_sse_stream(push.driver_group(driver_id), None))
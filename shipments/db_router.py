@@ -0,0 +1,140 @@
+import functools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# Set per request by ReadYourWritesMiddleware and the replica_reads helpers;
+# the replica alias reads inside a replica_reads() block go to, or None
+_replica_reads = ContextVar("replica_reads", default=None)
+_wrote = ContextVar("wrote", default=False)
+
+# Replicas that failed to connect, skipped until the time given (per process)
+_down_until = {}
+
+
+def _pin_key(user_id):
+    return f"db:pinned:{user_id}"
+
+
+def pin(user_id):
+    """
+    Sends the user's reads to the primary for DATABASE_PIN_SECONDS, long
+    enough for replicas to catch up with what they just wrote.
+    """
+    cache.set(_pin_key(user_id), 1, timeout=settings.DATABASE_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return cache.get(_pin_key(user_id)) is not None
+
+
+def _usable(alias):
+    if _down_until.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()  # A no-op on an open persistent connection
+    except DatabaseError as e:
+        logger.warning(f"Replica {alias} unavailable, reading from the primary for now: {e}")
+        _down_until[alias] = time.monotonic() + settings.DATABASE_REPLICA_RETRY_AFTER
+        return False
+    return True
+
+
+def replica_alias():
+    """
+    A reachable replica picked at random, or "default" when none is.
+    """
+    candidates = list(settings.DATABASE_REPLICAS)
+    random.shuffle(candidates)
+    for alias in candidates:
+        if _usable(alias):
+            return alias
+    return "default"
+
+
+def read_alias(user):
+    """
+    Where a read-only request for `user` should query: a replica, unless
+    replicas aren't configured or the user wrote within the pin window.
+    """
+    if not settings.DATABASE_REPLICAS or (user.is_authenticated and is_pinned(user.pk)):
+        return "default"
+    return replica_alias()
+
+
+@contextmanager
+def replica_reads(user):
+    """
+    Lets reads inside the block go to a replica (see read_alias), picked
+    once so every query in the block sees the same snapshot. Writes, and
+    reads after a write or inside a transaction, still use the primary.
+    """
+    alias = read_alias(user) if _replica_reads.get() is None else None  # Nested blocks keep the outer replica
+    if alias is None or alias == "default":
+        yield
+        return
+    token = _replica_reads.set(alias)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def reads_from_replica(view):
+    """
+    replica_reads() for a whole function view; goes under @api_view so the
+    user is already authenticated.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads(request.user):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    """
+    Writes go to the primary. Reads do too, except inside replica_reads()
+    blocks, so only endpoints that opted in can see replication lag.
+    """
+    def db_for_read(self, model, **hints):
+        alias = _replica_reads.get()
+        if alias is None or _wrote.get() or connections["default"].in_atomic_block:
+            return "default"
+        return alias
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Replicas hold the same data as the primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+def start_request():
+    """
+    Clears the per-request routing state; threads serve many requests.
+    Returns the tokens for end_request().
+    """
+    return _replica_reads.set(None), _wrote.set(False)
+
+
+def end_request(tokens):
+    """
+    Returns whether the request wrote to the database.
+    """
+    wrote = _wrote.get()
+    replica_token, wrote_token = tokens
+    _replica_reads.reset(replica_token)
+    _wrote.reset(wrote_token)
+    return wrote
@@ -0,0 +1,221 @@
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+from . import eta, location_buffer, outbox, tracking, versioning
+from .geo import GridIndex, geohash
+from .models import Driver, Parcel
+
+logger = logging.getLogger(__name__)
+
+
+# Active-parcel counter maintenance
+
+def _is_active(driver_id, status):
+    return driver_id is not None and status in Parcel.ACTIVE_STATUSES
+
+
+def sync_driver_load(parcel, created, update_fields=None):
+    """
+    Keeps Driver.active_parcels in step with a parcel save. Runs inside the
+    save's transaction and must be called before the tracked snapshot is reset.
+    """
+    changes = {} if created else parcel.tracked_changes(update_fields)
+    before_driver = None if created else changes.get("assigned_driver_id", parcel.assigned_driver_id)
+    before_status = None if created else changes.get("status", parcel.status)
+    was_active = _is_active(before_driver, before_status)
+    is_active = _is_active(parcel.assigned_driver_id, parcel.status)
+    if was_active and (not is_active or before_driver != parcel.assigned_driver_id):
+        release_load(before_driver)
+    if is_active and (not was_active or before_driver != parcel.assigned_driver_id):
+        Driver.objects.filter(pk=parcel.assigned_driver_id).update(active_parcels=F("active_parcels") + 1)
+
+
+def release_load(driver_id, count=1):
+    Driver.objects.filter(pk=driver_id, active_parcels__gte=count).update(active_parcels=F("active_parcels") - count)
+
+
+def recount_active_parcels():
+    """
+    Rebuilds every driver's counter from the parcels table, correcting drift
+    from writes that bypass save() (e.g. raw queryset updates).
+    """
+    counted = dict(
+        Parcel.objects.filter(status__in=Parcel.ACTIVE_STATUSES, assigned_driver__isnull=False)
+        .values("assigned_driver").annotate(total=Count("id")).values_list("assigned_driver", "total")
+    )
+    drifted = [
+        Driver(pk=pk, active_parcels=counted.get(pk, 0))
+        for pk, current in Driver.objects.values_list("pk", "active_parcels")
+        if current != counted.get(pk, 0)
+    ]
+    Driver.objects.bulk_update(drifted, ["active_parcels"], batch_size=500)
+    return len(drifted)
+
+
+# Driver positions
+
+def _position_key(driver_id):
+    return f"driver:position:{driver_id}"
+
+
+def record_driver_position(driver_id, latitude, longitude, ts=None):
+    """
+    Stores where a driver was last seen and their smoothed speed, at most
+    once per DRIVER_POSITION_WRITE_INTERVAL per driver; dispatch and ETAs
+    don't need every ping. Returns True when the driver row was written.
+    """
+    if latitude is None or longitude is None:
+        return False
+    ts = ts if ts is not None else time.time()
+    previous = cache.get(_position_key(driver_id))
+    if previous and ts - previous["ts"] < settings.DRIVER_POSITION_WRITE_INTERVAL:
+        return False
+    speed = eta.update_speed(previous, latitude, longitude, ts)
+    cache.set(_position_key(driver_id), {"lat": latitude, "lng": longitude, "ts": ts, "speed": speed}, timeout=60 * 60 * 24)
+    Driver.objects.filter(pk=driver_id).update(
+        last_latitude=latitude, last_longitude=longitude, geohash=geohash(latitude, longitude),
+        last_seen_at=timezone.now(), speed_kmh=speed,
+    )
+    return True
+
+
+# Matching
+
+def plan(parcels, drivers, capacity, max_km=None, candidates=None):
+    """
+    Matches parcels to drivers without touching the database.
+
+    `parcels` is [(parcel_id, lat, lng)] in priority order, `drivers` is
+    [(driver_id, lat, lng, active_parcels)]. Each parcel is paired with its
+    nearest drivers through a grid index, then all pairs are taken shortest
+    first while the parcel is unassigned and the driver below `capacity`,
+    a greedy approximation of the min-cost matching. Returns
+    {parcel_id: (driver_id, distance_km)}.
+    """
+    max_km = settings.DISPATCH_MAX_DISTANCE_KM if max_km is None else max_km
+    candidates = candidates or settings.DISPATCH_CANDIDATES
+    free = {driver_id: capacity - load for driver_id, _, _, load in drivers if load < capacity}
+    if not free:
+        return {}
+    index = GridIndex(settings.DISPATCH_CELL_KM)
+    for driver_id, lat, lng, _ in drivers:
+        if driver_id in free:
+            index.insert(driver_id, lat, lng)
+
+    pairs = []
+    for rank, (parcel_id, lat, lng) in enumerate(parcels):
+        for distance, driver_id in index.nearest(lat, lng, candidates, max_km):
+            # Rank breaks distance ties in favour of older parcels
+            pairs.append((distance, rank, parcel_id, driver_id))
+    pairs.sort()
+
+    assignments = {}
+    for distance, _, parcel_id, driver_id in pairs:
+        if parcel_id in assignments or not free[driver_id]:
+            continue
+        assignments[parcel_id] = (driver_id, distance)
+        free[driver_id] -= 1
+    return assignments
+
+
+def _backlog(limit):
+    return list(
+        Parcel.objects.filter(
+            status="pending", assigned_driver__isnull=True,
+            current_latitude__isnull=False, current_longitude__isnull=False,
+        ).order_by("created_at").values_list("id", "current_latitude", "current_longitude")[:limit]
+    )
+
+
+def _available_drivers(capacity):
+    seen_after = timezone.now() - timedelta(seconds=settings.DISPATCH_DRIVER_STALE_AFTER)
+    return list(
+        Driver.objects.filter(
+            active_parcels__lt=capacity, last_seen_at__gte=seen_after,
+            last_latitude__isnull=False, last_longitude__isnull=False,
+        ).values_list("pk", "last_latitude", "last_longitude", "active_parcels")
+    )
+
+
+def _commit(assignments, capacity):
+    """
+    Applies a plan under row locks. Drivers are locked in primary-key order
+    (so concurrent runs can't deadlock) and their counters re-checked;
+    parcels already taken by someone else are skipped.
+    """
+    by_driver = {}
+    for parcel_id, (driver_id, _) in assignments.items():
+        by_driver.setdefault(driver_id, []).append(parcel_id)
+
+    with transaction.atomic():
+        drivers = {
+            driver.pk: driver
+            for driver in Driver.objects.select_for_update().filter(pk__in=by_driver).order_by("pk")
+        }
+        parcels = {
+            parcel.pk: parcel
+            for parcel in Parcel.objects.select_for_update(skip_locked=True).filter(
+                pk__in=assignments, status="pending", assigned_driver__isnull=True
+            )
+        }
+        now = timezone.now()
+        assigned = []
+        for driver_id, parcel_ids in by_driver.items():
+            driver = drivers.get(driver_id)
+            if driver is None:
+                continue
+            for parcel_id in parcel_ids:
+                parcel = parcels.get(parcel_id)
+                if parcel is None or driver.active_parcels >= capacity:
+                    continue
+                parcel.assigned_driver_id = driver_id
+                parcel.status = "assigned"
+                parcel.updated_at = now
+                driver.active_parcels += 1
+                assigned.append(parcel)
+        if not assigned:
+            return []
+        # bulk_update bypasses post_save, so counters and outbox rows are written here
+        Parcel.objects.bulk_update(assigned, ["assigned_driver", "status", "updated_at"], batch_size=500)
+        Driver.objects.bulk_update(list(drivers.values()), ["active_parcels"], batch_size=500)
+        outbox.record_assigned(assigned)
+
+        codes = [parcel.tracking_code for parcel in assigned]
+        users = {parcel.sender_id for parcel in assigned} | set(drivers)
+        transaction.on_commit(lambda: tracking.refresh(codes))
+        transaction.on_commit(lambda: versioning.touch_dashboards(users))
+        transaction.on_commit(lambda: location_buffer.forget_assignments([parcel.pk for parcel in assigned]))
+    return assigned
+
+
+def auto_assign(limit=None):
+    """
+    Assigns the oldest pending parcels to nearby drivers with spare capacity.
+    Returns a summary with the time spent planning and committing.
+    """
+    capacity = Driver.MAX_ACTIVE_PARCELS
+    started = time.perf_counter()
+    parcels = _backlog(limit or settings.DISPATCH_MAX_PARCELS)
+    drivers = _available_drivers(capacity)
+    loaded = time.perf_counter()
+    assignments = plan(parcels, drivers, capacity)
+    planned = time.perf_counter()
+    assigned = _commit(assignments, capacity) if assignments else []
+    finished = time.perf_counter()
+
+    summary = {
+        "pending": len(parcels),
+        "drivers": len(drivers),
+        "assigned": len(assigned),
+        "unassigned": len(parcels) - len(assigned),
+        "load_ms": round((loaded - started) * 1000, 1),
+        "plan_ms": round((planned - loaded) * 1000, 1),
+        "commit_ms": round((finished - planned) * 1000, 1),
+    }
+    logger.info(f"Auto-dispatch: {summary}")
+    return summary
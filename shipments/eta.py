@@ -0,0 +1,118 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from . import geo
+from .models import Parcel
+from .route_planner import route_key
+
+logger = logging.getLogger(__name__)
+
+
+def update_speed(previous, lat, lng, ts):
+    """
+    Folds the move from the previous recorded position into the driver's
+    speed estimate (km/h, exponentially weighted). Returns the new estimate,
+    or the old one when the interval is too short or too long to trust.
+    """
+    if not previous:
+        return None
+    speed = previous.get("speed")
+    elapsed = ts - previous["ts"]
+    if not settings.ETA_SPEED_MIN_INTERVAL <= elapsed <= settings.ETA_SPEED_MAX_INTERVAL:
+        return speed
+    observed = geo.haversine_km(previous["lat"], previous["lng"], lat, lng) / (elapsed / 3600)
+    observed = min(observed, settings.ETA_MAX_SPEED_KMH)  # GPS jumps
+    if speed is None:
+        return observed
+    return speed + settings.ETA_SPEED_ALPHA * (observed - speed)
+
+
+def _effective_speed(speed_kmh):
+    if not speed_kmh:
+        return settings.ETA_DEFAULT_SPEED_KMH
+    # A driver stuck at a stop shouldn't push every ETA to infinity
+    return max(speed_kmh, settings.ETA_MIN_SPEED_KMH)
+
+
+def estimate(position, destinations, speed_kmh, route=None, now=None):
+    """
+    Estimates arrival at each destination ({parcel_id: (lat, lng)}) for a
+    driver at `position`. Parcels in the driver's planned route are reached
+    in stop order, each earlier stop adding ETA_STOP_MINUTES; others are
+    estimated directly. Returns {parcel_id: datetime}.
+    """
+    now = now or timezone.now()
+    km_per_hour = _effective_speed(speed_kmh)
+    factor = settings.ETA_ROAD_FACTOR  # Straight-line to road distance
+    legs = {}
+    if route:
+        travelled, previous, stops_before = 0.0, position, 0
+        for stop in route["stops"]:
+            point = destinations.get(stop["parcel_id"])
+            if point is None:
+                continue  # Delivered or reassigned since the route was planned
+            travelled += geo.haversine_km(*previous, *point) * factor
+            legs[stop["parcel_id"]] = (travelled, stops_before)
+            previous, stops_before = point, stops_before + 1
+    for parcel_id, point in destinations.items():
+        if parcel_id not in legs:
+            legs[parcel_id] = (geo.haversine_km(*position, *point) * factor, 0)
+    return {
+        parcel_id: now + timedelta(hours=distance / km_per_hour, minutes=stops * settings.ETA_STOP_MINUTES)
+        for parcel_id, (distance, stops) in legs.items()
+    }
+
+
+def refresh(parcel_ids=None, min_change=0):
+    """
+    Recomputes stored ETAs for the given parcels (or every active parcel)
+    with one read and one bulk write. Only ETAs moving by more than
+    `min_change` seconds are written. Returns the changed rows as
+    (tracking_code, sender_id, driver_id).
+    """
+    queryset = Parcel.objects.filter(
+        status__in=Parcel.ACTIVE_STATUSES, assigned_driver__isnull=False,
+        destination_latitude__isnull=False, destination_longitude__isnull=False,
+    )
+    if parcel_ids is not None:
+        queryset = queryset.filter(id__in=list(parcel_ids))
+    rows = list(queryset.values(
+        "id", "tracking_code", "sender_id", "assigned_driver_id", "estimated_arrival",
+        "current_latitude", "current_longitude", "destination_latitude", "destination_longitude",
+        "assigned_driver__last_latitude", "assigned_driver__last_longitude", "assigned_driver__speed_kmh",
+    ))
+    if not rows:
+        return []
+
+    by_driver = {}
+    for row in rows:
+        by_driver.setdefault(row["assigned_driver_id"], []).append(row)
+    routes = cache.get_many([route_key(driver_id) for driver_id in by_driver])
+
+    now = timezone.now()
+    changed = []
+    for driver_id, driver_rows in by_driver.items():
+        first = driver_rows[0]
+        if first["assigned_driver__last_latitude"] is not None and first["assigned_driver__last_longitude"] is not None:
+            position = (first["assigned_driver__last_latitude"], first["assigned_driver__last_longitude"])
+        elif first["current_latitude"] is not None and first["current_longitude"] is not None:
+            position = (first["current_latitude"], first["current_longitude"])
+        else:
+            continue  # Nowhere to estimate from yet
+        destinations = {str(row["id"]): (row["destination_latitude"], row["destination_longitude"]) for row in driver_rows}
+        etas = estimate(position, destinations, first["assigned_driver__speed_kmh"], routes.get(route_key(driver_id)), now)
+        for row in driver_rows:
+            eta = etas[str(row["id"])]
+            previous = row["estimated_arrival"]
+            if previous is None or abs((eta - previous).total_seconds()) > min_change:
+                changed.append(row)
+                row["estimated_arrival"] = eta
+
+    if changed:
+        Parcel.objects.bulk_update(
+            [Parcel(id=row["id"], estimated_arrival=row["estimated_arrival"], updated_at=now) for row in changed],
+            ["estimated_arrival", "updated_at"], batch_size=1000,
+        )
+    return [(row["tracking_code"], row["sender_id"], row["assigned_driver_id"]) for row in changed]
@@ -0,0 +1,191 @@
+import csv
+import io
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from .models import ArchivedParcel, Parcel
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Optional: only needed for the columnar formats
+    pyarrow = None
+
+# (output column, queryset field, type); the type picks the Arrow column type
+COLUMNS = (
+    ("id", "id", "uuid"),
+    ("tracking_code", "tracking_code", "str"),
+    ("sender_id", "sender_id", "int"),
+    ("recipient_name", "recipient_name", "str"),
+    ("recipient_address", "recipient_address", "str"),
+    ("recipient_phone", "recipient_phone", "str"),
+    ("origin", "origin", "str"),
+    ("destination", "destination", "str"),
+    ("status", "status", "str"),
+    ("assigned_driver_id", "assigned_driver_id", "int"),
+    ("assigned_driver_name", "assigned_driver__name", "str"),
+    ("price", "price", "decimal"),
+    ("payment_status", "payment_status", "str"),
+    ("current_latitude", "current_latitude", "float"),
+    ("current_longitude", "current_longitude", "float"),
+    ("destination_latitude", "destination_latitude", "float"),
+    ("destination_longitude", "destination_longitude", "float"),
+    ("estimated_arrival", "estimated_arrival", "datetime"),
+    ("created_at", "created_at", "datetime"),
+    ("updated_at", "updated_at", "datetime"),
+)
+HEADER = [name for name, _, _ in COLUMNS]
+
+FORMATS = {
+    # format: (content type, file extension, needs pyarrow)
+    "csv": ("text/csv", "csv", False),
+    "ndjson": ("application/x-ndjson", "ndjson", False),
+    "parquet": ("application/vnd.apache.parquet", "parquet", True),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows", True),
+}
+
+
+def available_formats():
+    return [name for name, (_, _, columnar) in FORMATS.items() if pyarrow is not None or not columnar]
+
+
+def _filter(queryset, statuses, payment_status, driver_id, created_from, created_to):
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if payment_status:
+        queryset = queryset.filter(payment_status=payment_status)
+    if driver_id is not None:
+        queryset = queryset.filter(assigned_driver_id=driver_id)
+    if created_from:
+        queryset = queryset.filter(created_at__gte=timezone.make_aware(datetime.combine(created_from, time.min)))
+    if created_to:
+        queryset = queryset.filter(created_at__lt=timezone.make_aware(datetime.combine(created_to + timedelta(days=1), time.min)))
+    return queryset.values_list(*[field for _, field, _ in COLUMNS])
+
+
+def parcels(statuses=None, payment_status=None, driver_id=None, created_from=None, created_to=None, archived=True):
+    """
+    Parcels to export as value tuples in COLUMNS order, oldest first (the
+    created_at/id indexes serve the ordering). Dates are inclusive. Archived
+    parcels are included unless `archived` is False.
+    """
+    filters = (statuses, payment_status, driver_id, created_from, created_to)
+    queryset = _filter(Parcel.objects.all(), *filters)
+    if archived:
+        queryset = queryset.union(_filter(ArchivedParcel.objects.all(), *filters), all=True)
+    return queryset.order_by("created_at", "id")
+
+
+def _batches(queryset, size):
+    """
+    Reads through a server-side cursor (on PostgreSQL) so only `size` rows
+    are held at a time, however many the export has.
+    """
+    batch = []
+    for row in queryset.iterator(chunk_size=size):
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv(queryset, size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    for batch in _batches(queryset, size):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson(queryset, size):
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    for batch in _batches(queryset, size):
+        yield "".join(encoder.encode(dict(zip(HEADER, row))) + "\n" for row in batch).encode()
+
+
+class _Sink(io.RawIOBase):
+    """
+    Write-only file that hands back whatever was written since the last
+    drain(), so a columnar writer's output can be streamed as it goes.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_schema():
+    types = {
+        "uuid": pyarrow.string(),
+        "str": pyarrow.string(),
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "decimal": pyarrow.decimal128(10, 2),
+        "datetime": pyarrow.timestamp("us", tz="UTC"),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, _, kind in COLUMNS])
+
+
+def _record_batch(batch, schema):
+    columns = list(zip(*batch))
+    columns[0] = [str(value) for value in columns[0]]  # UUIDs
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+    )
+
+
+def _columnar(queryset, size, file_format):
+    schema = _arrow_schema()
+    sink = _Sink()
+    if file_format == "parquet":
+        # One row group per batch keeps the writer's memory to a single batch
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    try:
+        for batch in _batches(queryset, size):
+            writer.write_batch(_record_batch(batch, schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def stream(queryset, file_format, chunk_size=None):
+    """
+    Yields the export as byte chunks of about `chunk_size` rows each.
+    """
+    size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    if file_format == "csv":
+        return _csv(queryset, size)
+    if file_format == "ndjson":
+        return _ndjson(queryset, size)
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format {file_format!r}")
+    if pyarrow is None:
+        raise ValueError(f"The {file_format} format needs pyarrow installed")
+    return _columnar(queryset, size, file_format)
@@ -0,0 +1,118 @@
+from decimal import Decimal
+from operator import itemgetter
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # Optional: FastJSONRenderer falls back to DRF's encoder
+    orjson = None
+
+
+class Projection:
+    """
+    Read-only parcel representation over .values() rows, compiled once per
+    role: the columns to fetch, and for each output key the column it shows
+    (None to always send null). Projecting a row is a dict copy and one
+    itemgetter call, with none of the serializer field machinery.
+    """
+    def __init__(self, fields):
+        self.fields = tuple(fields)  # ((output key, column or None), ...)
+        self.columns = tuple(dict.fromkeys(column for _, column in self.fields if column))
+        visible = [(key, column) for key, column in self.fields if column]
+        self._keys = tuple(key for key, _ in visible)
+        getter = itemgetter(*(column for _, column in visible))
+        self._get = getter if len(visible) > 1 else lambda row: (getter(row),)
+        # Every key in output order, so filling it in keeps that order
+        self._template = dict.fromkeys(key for key, _ in self.fields)
+
+    def values(self, queryset, *extra):
+        """
+        The queryset as .values() rows holding this projection's columns plus `extra`.
+        """
+        return queryset.values(*dict.fromkeys(self.columns + extra))
+
+    def project(self, rows):
+        template, keys, get = self._template, self._keys, self._get
+        projected = []
+        for row in rows:
+            item = template.copy()
+            item.update(zip(keys, get(row)))
+            projected.append(item)
+        return projected
+
+
+# Same fields and order as ParcelSerializer
+PARCEL_LIST = Projection([
+    ("id", "id"),
+    ("tracking_code", "tracking_code"),
+    ("sender", "sender_id"),
+    ("recipient_name", "recipient_name"),
+    ("recipient_address", "recipient_address"),
+    ("recipient_phone", "recipient_phone"),
+    ("origin", "origin"),
+    ("destination", "destination"),
+    ("status", "status"),
+    ("assigned_driver", "assigned_driver_id"),
+    ("current_location", "current_location"),
+    ("current_latitude", "current_latitude"),
+    ("current_longitude", "current_longitude"),
+    ("price", "price"),
+    ("payment_status", "payment_status"),
+    ("created_at", "created_at"),
+])
+
+
+def _dashboard(show_recipient):
+    return Projection([
+        ("tracking_code", "tracking_code"),
+        ("recipient_name", "recipient_name"),
+        ("recipient_address", "recipient_address" if show_recipient else None),
+        ("recipient_phone", "recipient_phone" if show_recipient else None),
+        ("status", "status"),
+        ("current_latitude", "current_latitude"),
+        ("current_longitude", "current_longitude"),
+        ("assigned_driver", "assigned_driver__name"),
+        ("estimated_arrival", "estimated_arrival"),
+    ])
+
+
+# Recipients' contact details are for the people delivering, not other customers
+DASHBOARD = {
+    "admin": _dashboard(show_recipient=True),
+    "driver": _dashboard(show_recipient=True),
+    "customer": _dashboard(show_recipient=False),
+}
+
+
+def dashboard_projection(role):
+    return DASHBOARD.get(role, DASHBOARD["customer"])
+
+
+class _Encoder(JSONEncoder):
+    """
+    DRF's encoder, but with decimals as strings (as DecimalField renders
+    them) where DRF's would write floats.
+    """
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+        return super().default(obj)
+
+
+_default = _Encoder().default
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer backed by orjson when it's installed. Output matches DRF's
+    for what these payloads hold: UUIDs and decimals as strings, UTC
+    datetimes ending in Z. Pretty-printed (indent) requests, and all of them
+    without orjson, use DRF's encoder with the same decimal handling.
+    """
+    encoder_class = _Encoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z)
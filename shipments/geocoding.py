@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.utils import timezone
+from . import metrics
+from .models import GeocodeCache
+from .utils import get_coordinates
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "geocode"
+MISSING = (None, None)
+
+# Counters exported through shipments.metrics
+HITS_REDIS = "geocode.hits.redis"
+HITS_DB = "geocode.hits.db"
+MISSES = "geocode.misses"
+ERRORS = "geocode.errors"
+COUNTERS = (HITS_REDIS, HITS_DB, MISSES, ERRORS)
+
+_whitespace = re.compile(r"\s+")
+_punctuation = re.compile(r"[^\w\s]")
+
+
+def normalize_address(address):
+    """
+    Canonical form used as the cache key: case, punctuation and whitespace
+    differences between otherwise identical addresses collapse together.
+    """
+    address = _punctuation.sub(" ", (address or "").lower())
+    return _whitespace.sub(" ", address).strip()
+
+
+def address_key(address):
+    return hashlib.sha256(normalize_address(address).encode("utf-8")).hexdigest()
+
+
+def _ttl(lat):
+    # Addresses Google couldn't resolve are retried sooner than good ones expire
+    return settings.GEOCODE_CACHE_TTL if lat is not None else settings.GEOCODE_NEGATIVE_CACHE_TTL
+
+
+def _remember(key, address, lat, lng):
+    ttl = _ttl(lat)
+    cache.set(f"{CACHE_PREFIX}:{key}", (lat, lng), timeout=ttl)
+    try:
+        GeocodeCache.objects.update_or_create(
+            address_key=key,
+            defaults={
+                "address": normalize_address(address),
+                "latitude": lat,
+                "longitude": lng,
+                "expires_at": timezone.now() + timedelta(seconds=ttl),
+            },
+        )
+    except IntegrityError:
+        # Another worker stored the same address first; its value is as good as ours
+        pass
+
+
+def geocode(address):
+    """
+    Resolves an address to (lat, lng) through Redis, then the GeocodeCache
+    table, and only then the Google Geocoding API. Returns (None, None) when
+    the address can't be resolved.
+    """
+    if not normalize_address(address):
+        return MISSING
+
+    key = address_key(address)
+    cached = cache.get(f"{CACHE_PREFIX}:{key}")
+    if cached is not None:
+        metrics.increment(HITS_REDIS)
+        return tuple(cached)
+
+    row = GeocodeCache.objects.filter(address_key=key, expires_at__gt=timezone.now()).values_list(
+        "latitude", "longitude", "expires_at"
+    ).first()
+    if row:
+        lat, lng, expires_at = row
+        metrics.increment(HITS_DB)
+        remaining = int((expires_at - timezone.now()).total_seconds())
+        if remaining > 0:
+            cache.set(f"{CACHE_PREFIX}:{key}", (lat, lng), timeout=remaining)
+        return lat, lng
+
+    metrics.increment(MISSES)
+    try:
+        lat, lng = get_coordinates(address, timeout=settings.GEOCODING_TIMEOUT, raise_errors=True)
+    except Exception as e:
+        # Transient failures (timeouts, 5xx) are not cached so the next attempt retries
+        metrics.increment(ERRORS)
+        logger.warning(f"Geocoding failed for {address}: {e}")
+        raise
+
+    _remember(key, address, lat, lng)
+    return lat, lng
+
+
+def purge_expired():
+    """
+    Evicts expired rows from the GeocodeCache table. Redis entries expire on
+    their own TTL.
+    """
+    deleted, _ = GeocodeCache.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
+
+
+def cache_stats():
+    stats = metrics.get_counters(COUNTERS)
+    hits = stats[HITS_REDIS] + stats[HITS_DB]
+    lookups = hits + stats[MISSES]
+    stats["hit_rate"] = round(hits / lookups, 4) if lookups else None
+    stats["entries"] = GeocodeCache.objects.count()
+    return stats
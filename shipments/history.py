@@ -0,0 +1,219 @@
+import logging
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Driver, LocationTrack, Parcel
+
+logger = logging.getLogger(__name__)
+
+SCALE = 1_000_000  # Coordinates are stored as integer micro-degrees (~0.1 m)
+
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+
+def encode(points, previous=(0, 0, 0)):
+    """
+    Packs (offset_seconds, lat_e6, lng_e6) integer tuples as zigzag varint
+    deltas from the previous point. A stationary ping costs 3 bytes.
+    """
+    out = bytearray()
+    prev = previous
+    for point in points:
+        for value, last in zip(point, prev):
+            n = _zigzag(value - last)
+            while n > 0x7F:
+                out.append((n & 0x7F) | 0x80)
+                n >>= 7
+            out.append(n)
+        prev = point
+    return bytes(out)
+
+
+def decode(blob):
+    points = []
+    values = []
+    prev = [0, 0, 0]
+    n = shift = 0
+    for byte in bytes(blob):
+        n |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(_unzigzag(n))
+        n = shift = 0
+        if len(values) == 3:
+            prev = [last + delta for last, delta in zip(prev, values)]
+            points.append(tuple(prev))
+            values = []
+    return points
+
+
+def _day_start(day):
+    return datetime.combine(day, dt_time.min, tzinfo=dt_timezone.utc)
+
+
+def to_point(ts, latitude, longitude):
+    """
+    Splits an epoch timestamp into its UTC day and the packed point.
+    """
+    moment = datetime.fromtimestamp(ts, tz=dt_timezone.utc)
+    offset = int(ts - _day_start(moment.date()).timestamp())
+    return moment.date(), (offset, round(latitude * SCALE), round(longitude * SCALE))
+
+
+def append_points(track, points):
+    """
+    Adds sorted points to a track. In-order points are appended to the blob
+    as-is; late ones force a merge and re-encode of the day.
+    """
+    if not points:
+        return
+    if track.point_count and points[0][0] < track.last_offset:
+        merged = sorted(set(decode(track.points)) | set(points))
+        track.points = encode(merged)
+        track.point_count = len(merged)
+        last = merged[-1]
+    else:
+        previous = (track.last_offset, track.last_latitude, track.last_longitude) if track.point_count else (0, 0, 0)
+        track.points = bytes(track.points or b"") + encode(points, previous)
+        track.point_count += len(points)
+        last = points[-1]
+    track.last_offset, track.last_latitude, track.last_longitude = last
+
+
+def _store(field, model, grouped):
+    """
+    Appends grouped points ({(subject_id, day): points}) to the tracks of one
+    subject type, creating tracks that don't exist yet.
+    """
+    ids = {subject_id for subject_id, _ in grouped}
+    # Pings can outlive their parcel or driver; drop those rather than fail the batch
+    existing_ids = {str(pk) for pk in model.objects.filter(pk__in=ids).values_list("pk", flat=True)}
+    keys = [(subject_id, day) for subject_id, day in grouped if subject_id in existing_ids]
+    tracks = _locked_tracks(field, keys)
+    missing = [key for key in keys if key not in tracks]
+    if missing:
+        # Row locks can't cover tracks that don't exist yet, so create them empty
+        # first; one a concurrent writer just created is skipped, then locked below
+        LocationTrack.objects.bulk_create(
+            [LocationTrack(day=day, **{f"{field}_id": subject_id}) for subject_id, day in missing],
+            ignore_conflicts=True,
+        )
+        tracks.update(_locked_tracks(field, missing))
+    now = timezone.now()
+    for key in keys:
+        track = tracks[key]
+        track.updated_at = now
+        append_points(track, sorted(grouped[key]))
+    LocationTrack.objects.bulk_update(
+        [tracks[key] for key in keys], ["points", "point_count", "last_offset", "last_latitude", "last_longitude", "updated_at"]
+    )
+
+
+def _locked_tracks(field, keys):
+    if not keys:
+        return {}
+    return {
+        (str(getattr(track, f"{field}_id")), track.day): track
+        for track in LocationTrack.objects.select_for_update().filter(
+            **{f"{field}_id__in": {subject_id for subject_id, _ in keys}, "day__in": {day for _, day in keys}}
+        )
+    }
+
+
+def record(pings):
+    """
+    Appends buffered pings to the parcel and driver tracks. A trail sent once
+    for several parcels is stored once on the driver's track.
+    """
+    parcels, drivers = {}, {}
+    for ping in pings:
+        if ping.get("latitude") is None or ping.get("longitude") is None:
+            continue
+        day, point = to_point(ping["ts"], ping["latitude"], ping["longitude"])
+        parcels.setdefault((str(ping["parcel_id"]), day), set()).add(point)
+        if ping.get("driver_id"):
+            drivers.setdefault((str(ping["driver_id"]), day), set()).add(point)
+    if not parcels:
+        return
+    with transaction.atomic():
+        _store("parcel", Parcel, parcels)
+        if drivers:
+            _store("driver", Driver, drivers)
+
+
+def query(start, end, parcel_id=None, driver_id=None, max_points=None):
+    """
+    Returns [(epoch_seconds, latitude, longitude)] between start and end. Only
+    the day rows overlapping the window are loaded.
+    """
+    filters = {"parcel_id": parcel_id} if parcel_id is not None else {"driver_id": driver_id}
+    rows = LocationTrack.objects.filter(day__gte=start.date(), day__lte=end.date(), **filters).order_by("day").values_list(
+        "day", "points"
+    )
+    start_ts, end_ts = start.timestamp(), end.timestamp()
+    track = []
+    for day, blob in rows:
+        base = _day_start(day).timestamp()
+        for offset, lat, lng in decode(blob):
+            ts = base + offset
+            if start_ts <= ts <= end_ts:
+                track.append((int(ts), lat / SCALE, lng / SCALE))
+    if max_points and len(track) > max_points:
+        step = len(track) / max_points
+        track = [track[int(i * step)] for i in range(max_points - 1)] + [track[-1]]
+    return track
+
+
+def downsample(points, resolution):
+    """
+    Keeps the first point of every `resolution`-second bucket.
+    """
+    kept, bucket = [], None
+    for point in points:
+        if point[0] // resolution != bucket:
+            bucket = point[0] // resolution
+            kept.append(point)
+    return kept
+
+
+def compact(today=None, batch_size=500):
+    """
+    Downsamples tracks older than LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS and
+    deletes those past LOCATION_HISTORY_RETENTION_DAYS.
+    Returns (downsampled, deleted).
+    """
+    today = today or timezone.now().date()
+    resolution = settings.LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION
+    deleted, _ = LocationTrack.objects.filter(
+        day__lt=today - timedelta(days=settings.LOCATION_HISTORY_RETENTION_DAYS)
+    ).delete()
+
+    downsampled = 0
+    cutoff = today - timedelta(days=settings.LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS)
+    while True:
+        with transaction.atomic():
+            tracks = list(
+                LocationTrack.objects.select_for_update().filter(day__lt=cutoff, resolution__lt=resolution)[:batch_size]
+            )
+            if not tracks:
+                break
+            for track in tracks:
+                points = downsample(decode(track.points), resolution)
+                track.points = encode(points)
+                track.point_count = len(points)
+                track.resolution = resolution
+                if points:
+                    track.last_offset, track.last_latitude, track.last_longitude = points[-1]
+            LocationTrack.objects.bulk_update(
+                tracks, ["points", "point_count", "resolution", "last_offset", "last_latitude", "last_longitude"]
+            )
+        downsampled += len(tracks)
+    return downsampled, deleted
@@ -0,0 +1,165 @@
+import logging
+import os
+import secrets
+import threading
+import time
+import uuid
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Crockford base32: no I, L, O or U, and in ASCII order so codes sort like their values
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_VALUES = {char: value for value, char in enumerate(ALPHABET)}
+_LOOKALIKES = str.maketrans({"O": "0", "I": "1", "L": "1", "-": None, " ": None})
+
+# Tracking code payload, most significant first: seconds since EPOCH (good
+# until 2160), the generating process's node number, and a per-second
+# sequence. 60 bits make 12 characters; a check character makes 13.
+EPOCH = 1704067200  # 2024-01-01 UTC
+NODE_BITS = 16
+SEQUENCE_BITS = 12
+PAYLOAD_CHARS = 12
+CODE_LENGTH = PAYLOAD_CHARS + 1
+NODE_KEY = "ids:node"
+
+
+# UUIDv7 primary keys
+
+class UUID7Generator:
+    """
+    Time-ordered UUIDs (RFC 9562 version 7): a millisecond timestamp, a
+    12-bit counter that keeps ids from one process increasing within the
+    same millisecond, then 62 random bits. Consecutive inserts land next
+    to each other in the primary key index instead of at random pages.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._millis = 0
+        self._counter = 0
+
+    def allocate(self, count):
+        with self._lock:
+            millis = time.time_ns() // 1_000_000
+            if millis > self._millis:
+                # Start low in the counter so a burst has room before borrowing the next millisecond
+                self._millis, self._counter = millis, secrets.randbits(SEQUENCE_BITS - 1)
+            stamps = []
+            for _ in range(count):
+                if self._counter > 0xFFF:
+                    self._millis, self._counter = self._millis + 1, 0
+                stamps.append((self._millis << 80) | (0x7 << 76) | (self._counter << 64) | (0b10 << 62))
+                self._counter += 1
+        return [uuid.UUID(int=stamp | secrets.randbits(62)) for stamp in stamps]
+
+
+_uuid7 = UUID7Generator()
+
+
+def uuid7():
+    return _uuid7.allocate(1)[0]
+
+
+def uuid7s(count):
+    """
+    A block of `count` increasing UUIDv7s, for bulk creation.
+    """
+    return _uuid7.allocate(count)
+
+
+# Tracking codes
+
+def _check_char(payload):
+    """
+    Luhn mod 32 check character: catches every single wrong character and
+    most swaps of neighbouring ones.
+    """
+    total, factor = 0, 2
+    for char in reversed(payload):
+        addend = factor * _VALUES[char]
+        total += addend // 32 + addend % 32
+        factor = 3 - factor
+    return ALPHABET[-total % 32]
+
+
+def _encode(value):
+    chars = []
+    for _ in range(PAYLOAD_CHARS):
+        value, digit = divmod(value, 32)
+        chars.append(ALPHABET[digit])
+    payload = "".join(reversed(chars))
+    return payload + _check_char(payload)
+
+
+def _allocate_node():
+    """
+    A node number for this process from a shared counter in the cache, so
+    no two running processes share one. Falls back to a random number when
+    the cache is down; the unique index still guards against the rare clash.
+    """
+    try:
+        cache.add(NODE_KEY, secrets.randbits(NODE_BITS), timeout=None)
+        return cache.incr(NODE_KEY) % (1 << NODE_BITS)
+    except Exception as e:
+        logger.warning(f"Could not allocate an id node from the cache, using a random one: {e}")
+        return secrets.randbits(NODE_BITS)
+
+
+class TrackingCodeGenerator:
+    """
+    Unique, time-sortable tracking codes without a database round trip:
+    uniqueness comes from the node number plus a sequence that never
+    repeats within a second. A process that uses up a second's sequence
+    borrows from the next one, and a clock that steps back is ignored.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._node = 0
+        self._second = 0
+        self._sequence = 0
+
+    def allocate(self, count):
+        with self._lock:
+            if self._pid != os.getpid():
+                # New process, or forked from one: take a node of our own
+                self._pid, self._node = os.getpid(), _allocate_node()
+                self._second = self._sequence = 0
+            now = int(time.time()) - EPOCH
+            if now > self._second:
+                self._second, self._sequence = now, 0
+            values = []
+            for _ in range(count):
+                if self._sequence >> SEQUENCE_BITS:
+                    self._second, self._sequence = self._second + 1, 0
+                values.append((((self._second << NODE_BITS) | self._node) << SEQUENCE_BITS) | self._sequence)
+                self._sequence += 1
+        return [_encode(value) for value in values]
+
+
+_tracking_codes = TrackingCodeGenerator()
+
+
+def tracking_code():
+    return _tracking_codes.allocate(1)[0]
+
+
+def tracking_codes(count):
+    """
+    A block of `count` distinct tracking codes, reserved under one lock.
+    """
+    return _tracking_codes.allocate(count)
+
+
+def is_valid_tracking_code(code):
+    return len(code) == CODE_LENGTH and all(char in _VALUES for char in code) and _check_char(code[:-1]) == code[-1]
+
+
+def normalize_tracking_code(code):
+    """
+    The canonical form of a generated code typed by hand (lower case,
+    hyphens, O for 0, I or L for 1), or `code` unchanged when that doesn't
+    give a valid code, as with codes issued before this format.
+    """
+    canonical = code.upper().translate(_LOOKALIKES)
+    return canonical if is_valid_tracking_code(canonical) else code
@@ -0,0 +1,287 @@
+import functools
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache.backends.redis import RedisCache
+from django.db import connections
+from django.urls import URLPattern, URLResolver, get_resolver
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cumulative latency buckets (seconds) for the request histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EXTERNAL_SERVICES = ("stripe", "twilio", "google_maps")
+UNMATCHED = "unmatched"  # Requests that resolved to no view (404s)
+OTHER = "other"
+
+_profile = ContextVar("request_profile", default=None)
+_MISSING = object()
+
+
+class RequestProfile:
+    """
+    What one request spent its time on. Queries are grouped by SQL text
+    (parameters are separate), so an N+1 shows up as one statement run
+    many times.
+    """
+    def __init__(self):
+        self.queries = {}  # sql -> [count, seconds]
+        self.query_count = 0
+        self.db_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.sections = {}  # timed() section or external service -> [count, seconds]
+
+    def add_query(self, sql, seconds):
+        entry = self.queries.setdefault(sql, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        self.query_count += 1
+        self.db_seconds += seconds
+
+    def add_section(self, name, seconds):
+        entry = self.sections.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def top_queries(self, limit):
+        return sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+
+def current():
+    """
+    The profile of the request being served, or None outside one.
+    """
+    return _profile.get()
+
+
+# Timing API
+
+@contextmanager
+def timed(name):
+    """
+    Times a block into the current request's profile, where slow-request
+    logs show it; also works as a decorator (@timed("name")). Free outside
+    requests.
+    """
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_section(name, time.perf_counter() - started)
+
+
+@contextmanager
+def external_call(service):
+    """
+    Times a call to a third-party API. Besides the request profile, calls
+    from any process (web or worker) count toward the shared
+    external.<service>.* counters exported on /metrics.
+    """
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.increment(f"external.{service}.calls")
+        metrics.increment(f"external.{service}.us", int(elapsed * 1_000_000))
+        if failed:
+            metrics.increment(f"external.{service}.errors")
+        profile = _profile.get()
+        if profile is not None:
+            profile.add_section(service, elapsed)
+
+
+# Collectors
+
+class _QueryRecorder:
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.profile.add_query(sql, time.perf_counter() - started)
+
+
+class InstrumentedRedisCache(RedisCache):
+    """
+    Django's Redis cache, counting hits and misses into the request profile.
+    """
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        profile = _profile.get()
+        if profile is not None:
+            if value is _MISSING:
+                profile.cache_misses += 1
+            else:
+                profile.cache_hits += 1
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = super().get_many(keys, version)
+        profile = _profile.get()
+        if profile is not None:
+            profile.cache_hits += len(values)
+            profile.cache_misses += len(keys) - len(values)
+        return values
+
+
+@contextmanager
+def profiling():
+    """
+    Collects a RequestProfile for the block: queries on every database
+    alias, cache hits/misses and timed sections.
+    """
+    profile = RequestProfile()
+    token = _profile.set(profile)
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(_QueryRecorder(profile)))
+            yield profile
+    finally:
+        _profile.reset(token)
+
+
+# Per-view series
+
+@functools.lru_cache(maxsize=1)
+def view_names():
+    """
+    Every view label requests can be recorded under: named URL patterns,
+    one label per namespaced include (e.g. "admin"), plus UNMATCHED/OTHER.
+    """
+    names = []
+
+    def walk(patterns):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                if pattern.namespace:
+                    names.append(pattern.namespace)
+                else:
+                    walk(pattern.url_patterns)
+            elif isinstance(pattern, URLPattern) and pattern.name:
+                names.append(pattern.name)
+
+    walk(get_resolver().url_patterns)
+    return tuple(dict.fromkeys(names + [UNMATCHED, OTHER]))
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return UNMATCHED
+    if match.namespaces:
+        return match.namespaces[0]
+    return match.url_name if match.url_name in view_names() else OTHER
+
+
+def _bucket_label(bound):
+    return f"{bound:g}"
+
+
+def record(view, seconds, status_code, profile):
+    """
+    Adds a finished request to the shared per-view counters.
+    """
+    prefix = f"http.{view}"
+    metrics.increment(f"{prefix}.count")
+    metrics.increment(f"{prefix}.us", int(seconds * 1_000_000))
+    for bound in BUCKETS:
+        if seconds <= bound:
+            metrics.increment(f"{prefix}.le_{_bucket_label(bound)}")
+    if status_code >= 500:
+        metrics.increment(f"{prefix}.errors")
+    metrics.increment(f"{prefix}.db_queries", profile.query_count)
+    metrics.increment(f"{prefix}.db_us", int(profile.db_seconds * 1_000_000))
+    metrics.increment(f"{prefix}.cache_hits", profile.cache_hits)
+    metrics.increment(f"{prefix}.cache_misses", profile.cache_misses)
+
+
+def log_if_slow(request, view, seconds, status_code, profile):
+    if seconds < settings.SLOW_REQUEST_SECONDS:
+        return
+    lines = [
+        f"Slow request {request.method} {request.path} ({view}) -> {status_code} in {seconds * 1000:.0f}ms: "
+        f"{profile.query_count} queries in {profile.db_seconds * 1000:.0f}ms, "
+        f"cache {profile.cache_hits} hits/{profile.cache_misses} misses"
+    ]
+    for name, (count, spent) in sorted(profile.sections.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append(f"  {name}: {count}x {spent * 1000:.1f}ms")
+    for sql, (count, spent) in profile.top_queries(settings.SLOW_REQUEST_TOP_QUERIES):
+        lines.append(f"  {count}x {spent * 1000:.1f}ms {sql[:settings.SLOW_REQUEST_SQL_CHARS]}")
+    logger.warning("\n".join(lines))
+
+
+# Prometheus exposition
+
+def _metric_name(counter):
+    return "logistics_" + "".join(char if char.isalnum() else "_" for char in counter) + "_total"
+
+
+def exposition(counters=()):
+    """
+    Renders the per-view, external-call and given subsystem counters in the
+    Prometheus text format (0.0.4). Values are summed over all processes.
+    """
+    views = view_names()
+    per_view = ("count", "us", "errors", "db_queries", "db_us", "cache_hits", "cache_misses")
+    names = [f"http.{view}.{field}" for view in views for field in per_view]
+    names += [f"http.{view}.le_{_bucket_label(bound)}" for view in views for bound in BUCKETS]
+    names += [f"external.{service}.{field}" for service in EXTERNAL_SERVICES for field in ("calls", "us", "errors")]
+    values = metrics.get_counters(list(names) + list(counters))
+
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+
+    served = [view for view in views if values[f"http.{view}.count"]]
+
+    def per_view_samples(name, field, scale=1):
+        return [f'{name}{{view="{view}"}} {values[f"http.{view}.{field}"] / scale}' for view in served]
+
+    histogram = []
+    for view in served:
+        for bound in BUCKETS:
+            label = _bucket_label(bound)
+            histogram.append(f'logistics_http_request_duration_seconds_bucket{{view="{view}",le="{label}"}} {values[f"http.{view}.le_{label}"]}')
+        histogram.append(f'logistics_http_request_duration_seconds_bucket{{view="{view}",le="+Inf"}} {values[f"http.{view}.count"]}')
+        histogram.append(f'logistics_http_request_duration_seconds_sum{{view="{view}"}} {values[f"http.{view}.us"] / 1e6}')
+        histogram.append(f'logistics_http_request_duration_seconds_count{{view="{view}"}} {values[f"http.{view}.count"]}')
+    family("logistics_http_request_duration_seconds", "histogram", "Request latency by view.", histogram)
+    family("logistics_http_request_errors_total", "counter", "Requests answered with a 5xx status.", per_view_samples("logistics_http_request_errors_total", "errors"))
+    family("logistics_db_queries_total", "counter", "Database queries issued by requests.", per_view_samples("logistics_db_queries_total", "db_queries"))
+    family("logistics_db_query_seconds_total", "counter", "Time requests spent in database queries.", per_view_samples("logistics_db_query_seconds_total", "db_us", 1e6))
+    family("logistics_cache_hits_total", "counter", "Cache reads that found a value.", per_view_samples("logistics_cache_hits_total", "cache_hits"))
+    family("logistics_cache_misses_total", "counter", "Cache reads that found nothing.", per_view_samples("logistics_cache_misses_total", "cache_misses"))
+
+    for field, name, help_text, scale in (
+        ("calls", "logistics_external_calls_total", "Calls to third-party APIs.", 1),
+        ("errors", "logistics_external_call_errors_total", "Third-party API calls that raised.", 1),
+        ("us", "logistics_external_call_seconds_total", "Time spent waiting on third-party APIs.", 1e6),
+    ):
+        family(name, "counter", help_text, [
+            f'{name}{{service="{service}"}} {values[f"external.{service}.{field}"] / scale}' for service in EXTERNAL_SERVICES
+        ])
+
+    for counter in counters:
+        family(_metric_name(counter), "counter", f"Counter {counter}.", [f"{_metric_name(counter)} {values[counter]}"])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from .utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache whose entries also expire after `ttl`
+    seconds, so a missed invalidation can only serve stale data briefly.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class InvalidationBus:
+    """
+    Keeps LocalCache instances in different processes coherent: evictions are
+    published on a Redis pub/sub channel and a daemon thread in every process
+    applies the ones it receives.
+    """
+    def __init__(self, channel, local_cache):
+        self.channel = channel
+        self.local_cache = local_cache
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, keys):
+        keys = list(keys)
+        self.local_cache.delete_many(keys)
+        try:
+            get_redis().publish(self.channel, json.dumps(keys))
+        except Exception as e:
+            logger.warning(f"Could not publish cache invalidation on {self.channel}: {e}")
+
+    def ensure_listening(self):
+        """
+        Starts the listener thread once per process (again after a fork).
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # Anything cached before the fork was never subscribed to invalidations
+            self.local_cache.clear()
+            threading.Thread(target=self._listen, name=f"invalidation:{self.channel}", daemon=True).start()
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            try:
+                pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                backoff = 1
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self.local_cache.delete_many(json.loads(message["data"]))
+            except Exception as e:
+                # While disconnected, invalidations may have been missed
+                self.local_cache.clear()
+                logger.warning(f"Invalidation listener on {self.channel} disconnected: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
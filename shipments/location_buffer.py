@@ -0,0 +1,244 @@
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from . import eta, geo, history, tracking, versioning
+from .models import Parcel
+from .utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+PING_FIELDS = {"current_latitude": "latitude", "current_longitude": "longitude", "current_location": "location"}
+
+
+def make_ping(parcel_id, tracking_code, data, driver_id=None, sender_id=None, ts=None):
+    """
+    A single GPS update as stored in the buffer.
+    """
+    return {
+        "parcel_id": str(parcel_id),
+        "tracking_code": tracking_code,
+        "driver_id": driver_id,
+        "sender_id": sender_id,
+        "latitude": data.get("current_latitude"),
+        "longitude": data.get("current_longitude"),
+        "location": data.get("current_location"),
+        "ts": ts if ts is not None else time.time(),
+    }
+
+
+def assignment_key(parcel_id):
+    return f"parcel-assignment:{parcel_id}"
+
+
+def forget_assignments(parcel_ids):
+    """
+    Drops the cached driver/status answers buffered pings are checked
+    against, once a parcel's assignment or status may have changed.
+    """
+    cache.delete_many([assignment_key(parcel_id) for parcel_id in parcel_ids])
+
+
+def coalesce(pings):
+    """
+    Merges pings into one position per parcel, newest value winning for each
+    field that was actually sent.
+    """
+    latest = {}
+    for ping in sorted(pings, key=lambda ping: ping["ts"]):
+        merged = latest.setdefault(ping["parcel_id"], {})
+        for field, key in PING_FIELDS.items():
+            if ping.get(key) is not None:
+                merged[field] = ping[key]
+    return latest
+
+
+class InMemoryLocationBuffer:
+    """
+    Process-local buffer for tests and single-process setups
+    (LOCATION_BUFFER_BACKEND=memory). Nothing else drains it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._latest = {}
+
+    def append(self, pings):
+        with self._lock:
+            self._pending.extend(pings)
+            for ping in pings:
+                current = self._latest.get(ping["tracking_code"])
+                if current is None or ping["ts"] >= current["ts"]:
+                    self._latest[ping["tracking_code"]] = ping
+
+    def latest(self, tracking_code):
+        with self._lock:
+            return self._latest.get(tracking_code)
+
+    def drain(self, limit):
+        with self._lock:
+            pings, self._pending = self._pending[:limit], self._pending[limit:]
+        return pings, pings
+
+    def ack(self, token):
+        with self._lock:
+            # Flushed positions are now in the database, which answers reads from here on
+            for ping in token:
+                current = self._latest.get(ping["tracking_code"])
+                if current is not None and current["ts"] <= ping["ts"]:
+                    del self._latest[ping["tracking_code"]]
+
+
+class RedisLocationBuffer:
+    """
+    Appends pings to a Redis stream (drained by the flusher through a consumer
+    group) and keeps the newest ping per tracking code under its own key for
+    reads.
+    """
+    STREAM = "locations:stream"
+    GROUP = "location-flusher"
+    CONSUMER = "flusher"
+    LATEST_PREFIX = "locations:latest:"
+
+    def __init__(self, client):
+        self.client = client
+        self._group_ready = False
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.client.xgroup_create(self.STREAM, self.GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def append(self, pings):
+        pipe = self.client.pipeline(transaction=False)
+        for ping in pings:
+            encoded = json.dumps(ping)
+            pipe.xadd(self.STREAM, {"ping": encoded}, maxlen=settings.LOCATION_STREAM_MAXLEN, approximate=True)
+            pipe.set(f"{self.LATEST_PREFIX}{ping['tracking_code']}", encoded, ex=settings.LOCATION_LATEST_TTL)
+        pipe.execute()
+
+    def latest(self, tracking_code):
+        encoded = self.client.get(f"{self.LATEST_PREFIX}{tracking_code}")
+        return json.loads(encoded) if encoded else None
+
+    def drain(self, limit):
+        self._ensure_group()
+        # Entries delivered to a flusher that died before acking are picked up first
+        response = self.client.xreadgroup(self.GROUP, self.CONSUMER, {self.STREAM: "0"}, count=limit)
+        if not response or not response[0][1]:
+            response = self.client.xreadgroup(self.GROUP, self.CONSUMER, {self.STREAM: ">"}, count=limit)
+        entries = response[0][1] if response else []
+        ids, pings = [], []
+        for entry_id, fields in entries:
+            ids.append(entry_id)
+            if fields:
+                pings.append(json.loads(fields[b"ping"]))
+        return pings, ids
+
+    def ack(self, token):
+        if token:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.xack(self.STREAM, self.GROUP, *token)
+            pipe.xdel(self.STREAM, *token)
+            pipe.execute()
+
+
+_memory_buffer = InMemoryLocationBuffer()
+_redis_buffer = None
+_down_until = 0.0
+
+
+def _mark_unavailable(e):
+    global _redis_buffer, _down_until
+    logger.warning(f"Location buffer unavailable, writing pings directly for {settings.LOCATION_BUFFER_RETRY_AFTER}s: {e}")
+    _redis_buffer = None
+    _down_until = time.monotonic() + settings.LOCATION_BUFFER_RETRY_AFTER
+
+
+def get_location_buffer():
+    """
+    Returns the configured buffer, or None while Redis can't be reached, so
+    callers write synchronously instead. A failed connection isn't retried
+    for LOCATION_BUFFER_RETRY_AFTER seconds.
+    """
+    global _redis_buffer
+    if settings.LOCATION_BUFFER_BACKEND == "memory":
+        return _memory_buffer
+    if _redis_buffer is None:
+        if _down_until > time.monotonic():
+            return None
+        try:
+            client = get_redis()
+            client.ping()
+            _redis_buffer = RedisLocationBuffer(client)
+        except Exception as e:
+            _mark_unavailable(e)
+            return None
+    return _redis_buffer
+
+
+def append(pings):
+    """
+    Appends pings to the buffer. Returns False when it is unavailable, in
+    which case the caller has to write them itself.
+    """
+    buffer = get_location_buffer()
+    if buffer is None:
+        return False
+    try:
+        buffer.append(pings)
+    except Exception as e:
+        _mark_unavailable(e)
+        return False
+    return True
+
+
+def flush(buffer=None, batch_size=None):
+    """
+    Drains the buffer and writes the newest position per parcel with one
+    bulk_update per batch. Returns the number of pings consumed.
+    """
+    buffer = buffer or get_location_buffer()
+    if buffer is None:
+        return 0
+    batch_size = batch_size or settings.LOCATION_FLUSH_BATCH_SIZE
+    consumed = 0
+    while True:
+        pings, token = buffer.drain(batch_size)
+        if not token:
+            break
+        # Parcels are grouped by the fields their pings carried so a partial
+        # update never blanks out a field that wasn't sent
+        groups = {}
+        now = timezone.now()
+        for parcel_id, fields in coalesce(pings).items():
+            if "current_latitude" in fields and "current_longitude" in fields:
+                fields["geohash"] = geo.geohash(fields["current_latitude"], fields["current_longitude"])
+            groups.setdefault(tuple(sorted(fields)), []).append(Parcel(id=parcel_id, updated_at=now, **fields))
+        # In direct mode the positions are already saved; pings only feed history
+        if settings.LOCATION_INGEST_MODE == "buffered":
+            for fields, parcels in groups.items():
+                if fields:
+                    Parcel.objects.bulk_update(parcels, list(fields) + ["updated_at"], batch_size=500)
+            eta.refresh({ping["parcel_id"] for ping in pings})
+            tracking.invalidate({ping["tracking_code"] for ping in pings})
+            versioning.touch_dashboards(
+                {ping.get("sender_id") for ping in pings} | {ping.get("driver_id") for ping in pings}
+            )
+        if settings.LOCATION_HISTORY_ENABLED:
+            history.record(pings)
+        buffer.ack(token)
+        consumed += len(pings)
+        if len(token) < batch_size:
+            break
+    if consumed:
+        logger.info(f"Flushed {consumed} location pings")
+    return consumed
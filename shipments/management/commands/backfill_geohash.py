@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from shipments.geo import geohash
+from shipments.models import Driver, Parcel
+
+
+class Command(BaseCommand):
+    help = "Fills the geohash column for parcels and drivers written before it existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        for model, lat_field, lng_field in (
+            (Parcel, "current_latitude", "current_longitude"),
+            (Driver, "last_latitude", "last_longitude"),
+        ):
+            queryset = model.objects.filter(
+                geohash__isnull=True, **{f"{lat_field}__isnull": False, f"{lng_field}__isnull": False}
+            ).only("pk", lat_field, lng_field)
+            updated = 0
+            while True:
+                rows = list(queryset[:batch_size])
+                if not rows:
+                    break
+                for row in rows:
+                    row.geohash = geohash(getattr(row, lat_field), getattr(row, lng_field))
+                model.objects.bulk_update(rows, ["geohash"])
+                updated += len(rows)
+            self.stdout.write(f"{model.__name__}: {updated} rows backfilled")
@@ -0,0 +1,37 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from shipments import dispatch
+from shipments.models import Driver
+
+
+class Command(BaseCommand):
+    help = "Times the auto-dispatch matcher on a synthetic backlog (no database writes)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--parcels", type=int, default=5000)
+        parser.add_argument("--drivers", type=int, default=1000)
+        parser.add_argument("--spread", type=float, default=0.5, help="Degrees of lat/lng the points span")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        lat0, lng0, spread = 6.45, 3.39, options["spread"]  # Centred on Lagos
+
+        def point():
+            return lat0 + rng.random() * spread, lng0 + rng.random() * spread
+
+        parcels = [(i, *point()) for i in range(options["parcels"])]
+        capacity = Driver.MAX_ACTIVE_PARCELS
+        drivers = [(i, *point(), rng.randrange(capacity)) for i in range(options["drivers"])]
+
+        started = time.perf_counter()
+        assignments = dispatch.plan(parcels, drivers, capacity)
+        elapsed = time.perf_counter() - started
+
+        distances = sorted(distance for _, distance in assignments.values())
+        median = distances[len(distances) // 2] if distances else 0
+        self.stdout.write(
+            f"{len(parcels)} parcels, {len(drivers)} drivers: {len(assignments)} assigned in {elapsed * 1000:.1f}ms, "
+            f"median pickup distance {median:.2f}km"
+        )
@@ -0,0 +1,62 @@
+import secrets
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from shipments import ids
+from shipments.models import Parcel, User
+
+RANDOM_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # The previous random 12-character codes
+
+
+def _uuid4_layout(count):
+    return [uuid.uuid4() for _ in range(count)], ["".join(secrets.choice(RANDOM_CODE_ALPHABET) for _ in range(12)) for _ in range(count)]
+
+
+def _uuid7_layout(count):
+    return ids.uuid7s(count), ids.tracking_codes(count)
+
+
+LAYOUTS = {"uuid4": _uuid4_layout, "uuid7": _uuid7_layout}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares parcel insert throughput with random UUID4 ids and codes against UUIDv7 ids and generated codes. "
+        "Run it on PostgreSQL with a large --rows: index fragmentation from random keys grows with the table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=20000)
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        sender = User.objects.create_user(username=f"bench-ids-{uuid.uuid4().hex[:8]}", password=uuid.uuid4().hex)
+        try:
+            for name, layout in LAYOUTS.items():
+                self._run(name, layout, sender, options["rows"], options["batch_size"])
+        finally:
+            Parcel.objects.filter(sender=sender).delete()
+            sender.delete()
+
+    def _run(self, name, layout, sender, rows, batch_size):
+        started = time.perf_counter()
+        parcel_ids, codes = layout(rows)
+        generated = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            with transaction.atomic():
+                Parcel.objects.bulk_create([
+                    Parcel(
+                        id=parcel_id, tracking_code=code, sender=sender, recipient_name="Bench", recipient_address="1 Bench St",
+                        recipient_phone="+1234567890", origin="A", destination="B",
+                    )
+                    for parcel_id, code in zip(parcel_ids[offset:offset + batch_size], codes[offset:offset + batch_size])
+                ])
+        inserted = time.perf_counter() - started
+        self.stdout.write(
+            f"{name}: generated {rows / generated:,.0f} ids+codes/s, inserted {rows} rows in {inserted:.2f}s "
+            f"({rows / inserted:,.0f} rows/s)"
+        )
+        Parcel.objects.filter(sender=sender).delete()
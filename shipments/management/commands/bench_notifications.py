@@ -0,0 +1,57 @@
+import time
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from shipments import notifications
+
+
+class Command(BaseCommand):
+    help = "Measures notification throughput and latency against the fake backend, per-message vs batched."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--latency", type=float, default=0.005, help="Simulated seconds per provider call")
+        parser.add_argument("--duplicates", type=float, default=0.1, help="Fraction of messages repeated")
+
+    def handle(self, *args, **options):
+        for label, batch_size in (("per-message", 1), ("batched", options["batch_size"])):
+            with override_settings(
+                NOTIFY_BACKEND="fake",
+                NOTIFY_QUEUE_BACKEND="memory",
+                NOTIFY_BATCH_SIZE=batch_size,
+                NOTIFY_BATCH_WINDOW=3600,  # Flushed explicitly below
+                NOTIFY_FAKE_LATENCY=options["latency"],
+            ):
+                self._run(label, options)
+
+    def _run(self, label, options):
+        cache.delete_many([f"notify:scheduled:{channel}" for channel in notifications.CHANNELS])
+        notifications.FakeBackend.outbox.clear()
+        total = options["messages"]
+        unique = max(1, int(total * (1 - options["duplicates"])))
+        run = time.time()
+
+        started = time.perf_counter()
+        queued = 0
+        for i in range(total):
+            n = i % unique
+            if i % 2:
+                queued += notifications.notify_sms(f"+1555{n:07d}", f"bench {run} parcel {n}")
+            else:
+                queued += notifications.notify_email("Parcel Update", f"bench {run} parcel {n}", [f"user{n}@example.com"])
+        enqueue_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        sent = sum(notifications.flush(channel) for channel in notifications.CHANNELS)
+        flush_time = time.perf_counter() - started
+        now = time.time()
+        latencies = sorted(now - message["enqueued_at"] for message in notifications.FakeBackend.outbox)
+        p50 = latencies[len(latencies) // 2] if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+
+        self.stdout.write(
+            f"{label:>12}: {total} submitted, {queued} queued ({total - queued} deduplicated), {sent} sent | "
+            f"enqueue {total / enqueue_time:,.0f} msg/s, delivery {sent / flush_time:,.0f} msg/s | "
+            f"latency p50 {p50 * 1000:.1f}ms p99 {p99 * 1000:.1f}ms"
+        )
@@ -0,0 +1,69 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from shipments import payments
+from shipments.models import Parcel, PaymentAttempt, User
+
+
+class Command(BaseCommand):
+    help = "Load-tests the payment pipeline against the local Stripe stub, double-submitting every parcel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--parcels", type=int, default=500)
+        parser.add_argument("--submits", type=int, default=2, help="Concurrent submits per parcel (double clicks)")
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument("--latency", type=float, default=0.2, help="Simulated seconds per gateway call")
+
+    def handle(self, *args, **options):
+        run = uuid.uuid4().hex[:8]
+        sender = User.objects.create_user(username=f"bench-payments-{run}", password=uuid.uuid4().hex)
+        Parcel.objects.bulk_create([
+            Parcel(
+                tracking_code=f"BENCHPAY-{run}-{i}", sender=sender, recipient_name="Bench", recipient_address="1 Bench St",
+                recipient_phone="+1234567890", origin="A", destination="B", price=10,
+            )
+            for i in range(options["parcels"])
+        ])
+        parcel_ids = list(Parcel.objects.filter(sender=sender).values_list("pk", flat=True))
+        payments.StubGateway.intents.clear()
+        try:
+            with override_settings(PAYMENT_GATEWAY="stub", PAYMENT_STUB_LATENCY=options["latency"]):
+                self._run(parcel_ids, options)
+        finally:
+            Parcel.objects.filter(sender=sender).delete()
+            sender.delete()
+
+    def _run(self, parcel_ids, options):
+        def pay(parcel_id):
+            started = time.perf_counter()
+            try:
+                payments.submit(payments.begin(parcel_id, "pm_card_visa"))
+                outcome = "charged"
+            except payments.PaymentInProgress:
+                outcome = "in progress"
+            except payments.PaymentError:
+                outcome = "refused"  # Already paid by the other click
+            finally:
+                connection.close()
+            return outcome, time.perf_counter() - started
+
+        jobs = [parcel_id for parcel_id in parcel_ids for _ in range(options["submits"])]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options["workers"]) as pool:
+            results = list(pool.map(pay, jobs))
+        elapsed = time.perf_counter() - started
+
+        outcomes = {}
+        for outcome, _ in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        latencies = sorted(latency for _, latency in results)
+        paid = Parcel.objects.filter(pk__in=parcel_ids, payment_status="paid").count()
+        attempts = PaymentAttempt.objects.filter(parcel_id__in=parcel_ids).count()
+        self.stdout.write(
+            f"{len(jobs)} submits for {len(parcel_ids)} parcels in {elapsed:.2f}s ({len(jobs) / elapsed:,.0f}/s): {outcomes} | "
+            f"{paid} paid, {attempts} attempts, {len(payments.StubGateway.intents)} charges | "
+            f"latency p50 {latencies[len(latencies) // 2] * 1000:.0f}ms p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f}ms"
+        )
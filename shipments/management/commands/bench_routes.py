@@ -0,0 +1,37 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from shipments import route_planner
+
+
+class Command(BaseCommand):
+    help = "Benchmarks stop ordering (nearest neighbour + 2-opt) over synthetic stop sets."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[50, 100, 200, 500])
+        parser.add_argument("--time-limit", type=float, default=5.0)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        for size in options["sizes"]:
+            points = [(6.45 + rng.random() * 0.3, 3.3 + rng.random() * 0.3) for _ in range(size + 1)]
+
+            started = time.perf_counter()
+            matrix = route_planner.distance_matrix(points)
+            matrix_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            greedy = route_planner.nearest_neighbour(matrix)
+            greedy_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            improved = route_planner.two_opt(greedy, matrix, deadline=time.monotonic() + options["time_limit"])
+            two_opt_ms = (time.perf_counter() - started) * 1000
+
+            greedy_km = route_planner.path_length(greedy, matrix)
+            improved_km = route_planner.path_length(improved, matrix)
+            self.stdout.write(
+                f"{size:>4} stops: matrix {matrix_ms:.1f}ms, nearest neighbour {greedy_ms:.1f}ms ({greedy_km:.1f}km), "
+                f"2-opt {two_opt_ms:.1f}ms ({improved_km:.1f}km, {100 * (1 - improved_km / greedy_km):.1f}% shorter)"
+            )
@@ -0,0 +1,63 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from shipments import fastpath
+from shipments.models import Parcel
+from shipments.serializers import ParcelSerializer
+
+
+class Command(BaseCommand):
+    help = "Compares ParcelSerializer + JSONRenderer with the projection fast path on synthetic pages (no database)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 1000])
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        renderer = JSONRenderer()
+        fast_renderer = fastpath.FastJSONRenderer()
+        self.stdout.write(f"orjson {'available' if fastpath.orjson else 'not installed (stdlib fallback)'}")
+        for size in options["sizes"]:
+            rows = [self._row(rng, i) for i in range(size)]
+            parcels = [Parcel(**{column: row[column] for column in fastpath.PARCEL_LIST.columns}) for row in rows]
+
+            serializer_time = self._time(options["repeat"], lambda: renderer.render(ParcelSerializer(parcels, many=True).data))
+            fast_time = self._time(options["repeat"], lambda: fast_renderer.render(fastpath.PARCEL_LIST.project(rows)))
+            self.stdout.write(
+                f"{size:>5} rows: serializer {serializer_time * 1000:.2f}ms, fast path {fast_time * 1000:.2f}ms "
+                f"({serializer_time / fast_time:.1f}x)"
+            )
+
+    def _time(self, repeat, render):
+        render()  # Warm up
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return (time.perf_counter() - started) / repeat
+
+    def _row(self, rng, i):
+        return {
+            "id": uuid.UUID(int=rng.getrandbits(128)),
+            "tracking_code": f"BENCH{i:08d}",
+            "sender_id": rng.randrange(1, 1000),
+            "recipient_name": "Ada Obi",
+            "recipient_address": f"{i} Marina Road, Lagos",
+            "recipient_phone": "+2348012345678",
+            "origin": "Ikeja",
+            "destination": "Lekki",
+            "status": rng.choice(["pending", "assigned", "in_transit", "delivered"]),
+            "assigned_driver_id": rng.choice([None, rng.randrange(1, 200)]),
+            "current_location": None,
+            "current_latitude": 6.45 + rng.random() * 0.3,
+            "current_longitude": 3.39 + rng.random() * 0.3,
+            "price": (Decimal(rng.randrange(500, 50000)) / 100).quantize(Decimal("0.01")),  # As the column returns it
+            "payment_status": rng.choice(["pending", "paid"]),
+            "created_at": timezone.now() - timedelta(minutes=i),
+        }
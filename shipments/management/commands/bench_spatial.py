@@ -0,0 +1,62 @@
+import bisect
+import random
+import time
+from django.core.management.base import BaseCommand
+from shipments import geo
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares a geohash-prefix + bounding-box nearby query with a full scan over synthetic points. "
+        "The sorted geohash list stands in for the database index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=1_000_000)
+        parser.add_argument("--queries", type=int, default=50)
+        parser.add_argument("--radius-km", type=float, default=5)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        radius = options["radius_km"]
+        # Roughly Nigeria-sized spread so a 5km query touches a realistic share of rows
+        points = [(rng.uniform(4.0, 13.0), rng.uniform(3.0, 14.0)) for _ in range(options["points"])]
+        started = time.perf_counter()
+        index = sorted((geo.geohash(lat, lng), lat, lng) for lat, lng in points)
+        keys = [row[0] for row in index]
+        self.stdout.write(f"Indexed {len(points):,} points in {time.perf_counter() - started:.1f}s")
+
+        queries = [(rng.uniform(5.0, 12.0), rng.uniform(4.0, 13.0)) for _ in range(options["queries"])]
+
+        started = time.perf_counter()
+        scan_hits = [
+            sum(1 for lat, lng in points if geo.haversine_km(q_lat, q_lng, lat, lng) <= radius)
+            for q_lat, q_lng in queries
+        ]
+        scan = (time.perf_counter() - started) / len(queries)
+
+        started = time.perf_counter()
+        index_hits = []
+        scanned = 0
+        for q_lat, q_lng in queries:
+            min_lat, min_lng, max_lat, max_lng = geo.bounding_box(q_lat, q_lng, radius)
+            hits = 0
+            for prefix in geo.covering_prefixes(min_lat, min_lng, max_lat, max_lng):
+                start = bisect.bisect_left(keys, prefix)
+                end = bisect.bisect_left(keys, prefix + "~")  # "~" sorts after every base32 character
+                scanned += end - start
+                for _, lat, lng in index[start:end]:
+                    if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng \
+                            and geo.haversine_km(q_lat, q_lng, lat, lng) <= radius:
+                        hits += 1
+            index_hits.append(hits)
+        indexed = (time.perf_counter() - started) / len(queries)
+
+        if scan_hits != index_hits:
+            self.stderr.write("Result mismatch between full scan and index")
+        self.stdout.write(
+            f"radius {radius}km: full scan {scan * 1000:.1f}ms/query, geohash index {indexed * 1000:.2f}ms/query "
+            f"({scan / indexed:.0f}x), {scanned / len(queries):,.0f} rows examined per query, "
+            f"{sum(index_hits) / len(queries):.0f} hits per query"
+        )
@@ -0,0 +1,47 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from shipments import export
+
+
+def _date(value):
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = "Streams parcels to a file (or stdout) as CSV, NDJSON, Parquet or Arrow without loading them into memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(export.FORMATS), default="csv")
+        parser.add_argument("--output", default="-", help="File path, or - for stdout")
+        parser.add_argument("--status", action="append", help="Repeatable")
+        parser.add_argument("--payment-status")
+        parser.add_argument("--driver", type=int)
+        parser.add_argument("--from", dest="created_from", type=_date, help="Created on or after (YYYY-MM-DD)")
+        parser.add_argument("--to", dest="created_to", type=_date, help="Created on or before (YYYY-MM-DD)")
+        parser.add_argument("--chunk-size", type=int)
+        parser.add_argument("--no-archived", dest="archived", action="store_false", help="Leave out archived parcels")
+
+    def handle(self, *args, **options):
+        if options["format"] not in export.available_formats():
+            raise CommandError(f"The {options['format']} format needs pyarrow installed")
+        parcels = export.parcels(
+            statuses=options["status"], payment_status=options["payment_status"], driver_id=options["driver"],
+            created_from=options["created_from"], created_to=options["created_to"], archived=options["archived"],
+        )
+        chunks = export.stream(parcels, options["format"], options["chunk_size"])
+        written = 0
+        if options["output"] == "-":
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+                written += len(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options["output"], "wb") as output:
+                for chunk in chunks:
+                    output.write(chunk)
+                    written += len(chunk)
+        self.stderr.write(f"Exported {written} bytes as {options['format']}")
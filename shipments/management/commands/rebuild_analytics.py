@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from shipments import analytics
+
+
+class Command(BaseCommand):
+    help = "Recomputes the analytics rollups from the parcels table, e.g. after first deploying them."
+
+    def handle(self, *args, **options):
+        cursor = analytics.rebuild()
+        self.stdout.write(f"Rollups rebuilt; new parcel events are counted from id {cursor + 1}")
@@ -0,0 +1,96 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "metrics"
+
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+_timer = None  # Flushes what an idle process has left pending
+
+
+def _key(name):
+    return f"{METRICS_PREFIX}:{name}"
+
+
+def increment(name, amount=1):
+    """
+    Increments a shared counter stored in the Django cache (Redis), so every
+    worker process reports into the same value. Increments are batched in
+    process and pushed at most every METRICS_FLUSH_INTERVAL seconds, so hot
+    paths don't pay a cache round-trip per event. A timer pushes the last
+    increments of a process that goes idle, and exit pushes the rest.
+    """
+    global _last_flush, _timer
+    with _pending_lock:
+        _pending[name] = _pending.get(name, 0) + amount
+        due = time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL
+        if due:
+            _last_flush = time.monotonic()
+        elif _timer is None:
+            _timer = threading.Timer(settings.METRICS_FLUSH_INTERVAL, _flush_idle)
+            _timer.daemon = True
+            _timer.start()
+    if due:
+        flush()
+
+
+def _flush_idle():
+    global _last_flush, _timer
+    with _pending_lock:
+        _timer = None
+        _last_flush = time.monotonic()
+    flush()
+
+
+def _forget_parent_state():
+    # A forked worker starts with the parent's pending increments, which the
+    # parent reports itself, and without its timer thread
+    global _pending_lock, _timer
+    _pending.clear()
+    _pending_lock = threading.Lock()
+    _timer = None
+
+
+def flush():
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+    for name, amount in pending.items():
+        _incr(name, amount)
+
+
+atexit.register(flush)
+os.register_at_fork(after_in_child=_forget_parent_state)
+
+
+def _incr(name, amount):
+    key = _key(name)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # Counter doesn't exist yet; add() avoids clobbering a concurrent creator
+        if not cache.add(key, amount, timeout=None):
+            cache.incr(key, amount)
+    except Exception as e:
+        logger.warning(f"Could not increment metric {name}: {e}")
+
+
+def get_counters(names):
+    """
+    Returns a {name: value} dict for the given counters, missing ones as 0.
+    """
+    flush()
+    values = cache.get_many([_key(name) for name in names])
+    return {name: values.get(_key(name), 0) for name in names}
+
+
+def reset(names):
+    cache.delete_many([_key(name) for name in names])
@@ -0,0 +1,48 @@
+import time
+from django.conf import settings
+from . import db_router, instrumentation
+
+
+class ReadYourWritesMiddleware:
+    """
+    Pins users to the primary database for a short while after a request of
+    theirs writes, so replica-served reads (e.g. track_parcel right after
+    update_location) don't show them data older than their own change.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        tokens = db_router.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = db_router.end_request(tokens)
+        # DRF sets request.user once it has authenticated the token
+        user = getattr(request, "user", None)
+        if wrote and settings.DATABASE_REPLICAS and user is not None and user.is_authenticated:
+            db_router.pin(user.pk)
+        return response
+
+
+class InstrumentationMiddleware:
+    """
+    Records each request's latency, database queries, cache hits/misses and
+    external-call time into the per-view counters behind /metrics, and logs
+    requests slower than SLOW_REQUEST_SECONDS with their top queries.
+    Streaming responses are timed up to the first byte.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.INSTRUMENTATION_ENABLED:
+            return self.get_response(request)
+        started = time.perf_counter()
+        with instrumentation.profiling() as profile:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+        view = instrumentation.view_label(request)
+        instrumentation.record(view, elapsed, response.status_code, profile)
+        instrumentation.log_if_slow(request, view, elapsed, response.status_code, profile)
+        return response
@@ -1,9 +1,9 @@
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.core.validators import RegexValidator
-import uuid
+from . import geo, ids
 import stripe
 
 phone_validator = RegexValidator(r'^\+?\d{9,15}$', message="Phone number must be 9-15 digits, optionally starting with '+'.")
@@ -33,6 +33,15 @@ class Driver(models.Model):
     phone = models.CharField(max_length=20, unique=True)
     license_number = models.CharField(max_length=50, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Maintained on every assignment change so capacity checks are a locked row read, not a COUNT
+    active_parcels = models.PositiveIntegerField(default=0)
+    last_latitude = models.FloatField(null=True, blank=True)
+    last_longitude = models.FloatField(null=True, blank=True)
+    last_seen_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    geohash = models.CharField(max_length=12, blank=True, null=True, db_index=True)  # Of the last position
+    speed_kmh = models.FloatField(null=True, blank=True)  # Smoothed over recent position updates
+
+    MAX_ACTIVE_PARCELS = 5
 
     def __str__(self):
         return self.name
@@ -47,14 +56,19 @@ class Parcel(models.Model):
         ('confirmed', 'Confirmed'),
         ('cancelled', 'Cancelled'),
     ]
+    ACTIVE_STATUSES = ('assigned', 'in_transit')
+    TRACKED_FIELDS = ('status', 'assigned_driver_id', 'payment_status')  # Changes become ParcelEvents
 
     PAYMENT_STATUS = [
         ('pending', 'Pending'),
         ('paid', 'Paid'),
+        ('failed', 'Failed'),  # The latest attempt failed; the sender can pay again
+        ('refunded', 'Refunded'),
     ]
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    tracking_code = models.CharField(max_length=50, unique=True, db_index=True)
+    # Time-ordered ids and generated codes; see shipments.ids
+    id = models.UUIDField(primary_key=True, default=ids.uuid7, editable=False)
+    tracking_code = models.CharField(max_length=50, unique=True, db_index=True, default=ids.tracking_code)
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_parcels')
     recipient_name = models.CharField(max_length=255)
     recipient_address = models.TextField()
@@ -65,11 +79,299 @@ class Parcel(models.Model):
     assigned_driver = models.ForeignKey(Driver, on_delete=models.SET_NULL, null=True, blank=True, related_name="parcels", db_index=True)
     current_location = models.CharField(max_length=255, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # Queryset .update() calls must set this explicitly
     current_latitude = models.FloatField(null=True, blank=True)
     current_longitude = models.FloatField(null=True, blank=True)
+    # Geocoded recipient address; the delivery stop for route planning
+    destination_latitude = models.FloatField(null=True, blank=True)
+    destination_longitude = models.FloatField(null=True, blank=True)
+    # Recomputed on location updates and periodically; see shipments.eta
+    estimated_arrival = models.DateTimeField(null=True, blank=True)
+    # Kept in step with the coordinates on every write; see shipments.spatial
+    geohash = models.CharField(max_length=12, blank=True, null=True, db_index=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     payment_status = models.CharField(max_length=10, choices=PAYMENT_STATUS, default='pending')    
 
+    class Meta:
+        # Keyset pagination of dashboards walks (created_at, id) within each role's filter
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="parcel_created_id_idx"),
+            models.Index(fields=["sender", "created_at", "id"], name="parcel_sender_created_idx"),
+            models.Index(fields=["assigned_driver", "created_at", "id"], name="parcel_driver_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.tracking_code} - {self.status}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.snapshot_tracked()
+        return instance
+
+    def snapshot_tracked(self):
+        # Read from __dict__ so deferred fields are never loaded just for this
+        self._tracked = {name: self.__dict__[name] for name in self.TRACKED_FIELDS if name in self.__dict__}
+
+    def tracked_changes(self, update_fields=None):
+        """
+        Returns {field: previous value} for tracked fields changed since the
+        parcel was loaded or last saved.
+        """
+        loaded = getattr(self, "_tracked", {})
+        return {
+            name: loaded[name]
+            for name in self.TRACKED_FIELDS
+            if name in loaded and loaded[name] != getattr(self, name)
+            and (update_fields is None or name in update_fields or name.removesuffix("_id") in update_fields)
+        }
+
+    def save(self, *args, **kwargs):
+        self.geohash = geo.geohash(self.current_latitude, self.current_longitude)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"current_latitude", "current_longitude"} & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"geohash"}
+        # The post_save handler writes outbox events; one transaction makes
+        # them commit or roll back together with the parcel
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+
+
+class ArchivedParcel(models.Model):
+    """
+    A parcel moved out of the hot Parcel table by shipments.archive once it
+    had been delivered, confirmed or cancelled for ARCHIVE_AFTER_DAYS. It
+    keeps its id and tracking code, so payment attempts and location tracks
+    still point at it; tracking and exports fall back to this table.
+    """
+    id = models.UUIDField(primary_key=True, editable=False)
+    tracking_code = models.CharField(max_length=50, unique=True)
+    # No database constraints: the archive must not block deleting users or drivers
+    sender = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="archived_parcels")
+    recipient_name = models.CharField(max_length=255)
+    recipient_address = models.TextField()
+    recipient_phone = models.CharField(max_length=15)
+    origin = models.CharField(max_length=255)
+    destination = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=Parcel.STATUS_CHOICES)
+    assigned_driver = models.ForeignKey(
+        Driver, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name="archived_parcels"
+    )
+    current_location = models.CharField(max_length=255, blank=True, null=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()  # Copied as is; not auto_now
+    current_latitude = models.FloatField(null=True, blank=True)
+    current_longitude = models.FloatField(null=True, blank=True)
+    destination_latitude = models.FloatField(null=True, blank=True)
+    destination_longitude = models.FloatField(null=True, blank=True)
+    estimated_arrival = models.DateTimeField(null=True, blank=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    payment_status = models.CharField(max_length=10, choices=Parcel.PAYMENT_STATUS, default='pending')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["created_at", "id"], name="archived_parcel_created_idx")]
+
+    def __str__(self):
+        return f"{self.tracking_code} - {self.status} (archived)"
+
+
+class GeocodeCache(models.Model):
+    """
+    Persistent address -> coordinate cache sitting behind the Redis tier, so
+    repeated addresses never hit the Google Geocoding API.
+    """
+    address_key = models.CharField(max_length=64, unique=True)  # sha256 of the normalized address
+    address = models.TextField()
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.address} ({self.latitude}, {self.longitude})"
+
+
+class LocationTrack(models.Model):
+    """
+    Location history for one parcel or driver over one UTC day. Pings are
+    packed into a delta-encoded varint blob (see shipments.history) rather
+    than stored as a row each.
+    """
+    # May point at an ArchivedParcel; tracks expire with LOCATION_HISTORY_RETENTION_DAYS
+    parcel = models.ForeignKey(
+        Parcel, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name="location_tracks"
+    )
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, null=True, blank=True, related_name="location_tracks")
+    day = models.DateField()
+    points = models.BinaryField(default=bytes)
+    point_count = models.PositiveIntegerField(default=0)
+    # Last packed point, so new pings can be delta-encoded without decoding the blob
+    last_offset = models.IntegerField(default=0)
+    last_latitude = models.IntegerField(default=0)
+    last_longitude = models.IntegerField(default=0)
+    resolution = models.PositiveIntegerField(default=0)  # Seconds per point after downsampling, 0 = raw
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["parcel", "day"], condition=models.Q(parcel__isnull=False), name="unique_parcel_track_day"),
+            models.UniqueConstraint(fields=["driver", "day"], condition=models.Q(driver__isnull=False), name="unique_driver_track_day"),
+        ]
+        indexes = [models.Index(fields=["day", "resolution"])]
+
+    def __str__(self):
+        return f"Track {self.parcel_id or self.driver_id} on {self.day} ({self.point_count} points)"
+
+
+class ParcelEvent(models.Model):
+    """
+    Transactional outbox: written in the same transaction as the parcel
+    change, then delivered by the relay task (shipments.outbox) to
+    notifications, the tracking cache and push subscribers.
+    """
+    KIND_CHOICES = [
+        ('created', 'Created'),
+        ('status_changed', 'Status Changed'),
+        ('driver_assigned', 'Driver Assigned'),
+        ('payment_updated', 'Payment Updated'),
+    ]
+
+    parcel = models.ForeignKey(Parcel, on_delete=models.SET_NULL, null=True, blank=True, related_name="events")
+    tracking_code = models.CharField(max_length=50)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # The relay only ever scans undelivered events in id order
+            models.Index(fields=["id"], condition=models.Q(processed_at__isnull=True), name="parcel_event_pending_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.tracking_code} {self.kind}"
+
+
+class PaymentAttempt(models.Model):
+    """
+    One try at charging a parcel. The idempotency key is derived from the
+    parcel and attempt number, so resubmitting an attempt can never charge
+    twice; a new attempt is only opened once the previous one failed.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),  # Not yet acknowledged by the gateway
+        ('processing', 'Processing'),  # Accepted; the outcome arrives by webhook
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        ('refunded', 'Refunded'),
+    ]
+    OPEN_STATUSES = ('pending', 'processing')
+    SETTLED_STATUSES = ('succeeded', 'refunded')  # Late or replayed gateway events can't undo these
+
+    # Kept when the parcel is archived (same id), so no cascade or database constraint
+    parcel = models.ForeignKey(Parcel, on_delete=models.DO_NOTHING, db_constraint=False, related_name="payment_attempts")
+    number = models.PositiveIntegerField()
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    amount = models.PositiveIntegerField()  # In cents
+    currency = models.CharField(max_length=3, default="usd")
+    payment_method = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    intent_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
+    refunded_amount = models.PositiveIntegerField(default=0)  # In cents; partial refunds leave the status alone
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["parcel", "number"], name="unique_parcel_payment_attempt")]
+
+    def __str__(self):
+        return f"{self.idempotency_key} {self.status}"
+
+
+class StatusDailyRollup(models.Model):
+    """
+    Parcels moving into and out of each status per day, maintained by
+    shipments.analytics from ParcelEvents.
+    """
+    day = models.DateField()
+    status = models.CharField(max_length=20)
+    entered = models.PositiveIntegerField(default=0)
+    left = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["day", "status"], name="unique_status_rollup_day")]
+
+    def __str__(self):
+        return f"{self.day} {self.status}: +{self.entered} -{self.left}"
+
+
+class DriverDailyRollup(models.Model):
+    # No FK constraint and no cascade: throughput history outlives the driver row
+    driver = models.ForeignKey(Driver, on_delete=models.DO_NOTHING, db_constraint=False, related_name="daily_rollups")
+    day = models.DateField()
+    assigned = models.PositiveIntegerField(default=0)
+    delivered = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["driver", "day"], name="unique_driver_rollup_day")]
+        indexes = [models.Index(fields=["day"])]
+
+    def __str__(self):
+        return f"{self.driver_id} {self.day}: {self.assigned} assigned, {self.delivered} delivered"
+
+
+class RevenueDailyRollup(models.Model):
+    """
+    Parcels (and their price) entering each payment status per day.
+    """
+    day = models.DateField()
+    payment_status = models.CharField(max_length=10)
+    parcels = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["day", "payment_status"], name="unique_revenue_rollup_day")]
+
+    def __str__(self):
+        return f"{self.day} {self.payment_status}: {self.amount}"
+
+
+class RollupCursor(models.Model):
+    """
+    The last ParcelEvent id folded into the rollups.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    last_event_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_event_id}"
+
+
+class StripeEvent(models.Model):
+    """
+    A received Stripe webhook event. The unique Stripe id drops the
+    duplicates Stripe sends on retries; shipments.webhooks applies events
+    in batches off the request path.
+    """
+    stripe_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created = models.DateTimeField()  # When Stripe created the event
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created", "id"], condition=models.Q(processed_at__isnull=True), name="stripe_event_pending_idx"),
+        ]
 
     def __str__(self):
-        return f"{self.tracking_code} - {self.status}"
\ No newline at end of file
+        return f"{self.stripe_id} {self.type}"
@@ -0,0 +1,356 @@
+import hashlib
+import json
+import logging
+import smtplib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from . import instrumentation, metrics
+from .utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+EMAIL = "email"
+SMS = "sms"
+CHANNELS = (EMAIL, SMS)
+
+
+def _counter(channel, name):
+    return f"notify.{channel}.{name}"
+
+
+COUNTERS = tuple(
+    _counter(channel, name)
+    for channel in CHANNELS
+    for name in ("enqueued", "deduplicated", "sent", "failed", "batches", "latency_ms_sum")
+)
+
+
+# Queues
+
+class InMemoryQueue:
+    """
+    Process-local queue for tests, benchmarks and Redis-less development.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {channel: [] for channel in CHANNELS}
+
+    def push(self, channel, messages):
+        with self._lock:
+            self._items[channel].extend(messages)
+
+    def pop_batch(self, channel, limit):
+        with self._lock:
+            batch, self._items[channel] = self._items[channel][:limit], self._items[channel][limit:]
+        return batch, None
+
+    def ack(self, channel, token, retry=()):
+        if retry:
+            self.push(channel, retry)
+
+    def requeue_expired(self, channel):
+        return 0
+
+    def length(self, channel):
+        with self._lock:
+            return len(self._items[channel])
+
+    def __len__(self):
+        return sum(len(items) for items in self._items.values())
+
+
+class RedisQueue:
+    """
+    A list per channel. Flushers LMOVE their batch onto a processing list of
+    its own and ack it once every message is sent or requeued, so a worker
+    dying mid-batch loses nothing: after NOTIFY_ACK_TIMEOUT the batch goes
+    back on the queue, at the cost of resending what it had delivered.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def _key(self, channel):
+        return f"notify:queue:{channel}"
+
+    def _processing_key(self, channel, token):
+        return f"notify:processing:{channel}:{token}"
+
+    def _leases_key(self, channel):
+        return f"notify:leases:{channel}"  # Sorted set of batch tokens by ack deadline
+
+    def push(self, channel, messages):
+        self.client.rpush(self._key(channel), *[json.dumps(message) for message in messages])
+
+    def pop_batch(self, channel, limit):
+        token = uuid.uuid4().hex
+        # The lease goes first so a crash straight after the moves can still be recovered
+        self.client.zadd(self._leases_key(channel), {token: time.time() + settings.NOTIFY_ACK_TIMEOUT})
+        pipe = self.client.pipeline(transaction=False)
+        for _ in range(limit):
+            pipe.lmove(self._key(channel), self._processing_key(channel, token), "LEFT", "RIGHT")
+        items = [item for item in pipe.execute() if item is not None]
+        if not items:
+            self.client.zrem(self._leases_key(channel), token)
+            return [], None
+        return [json.loads(item) for item in items], token
+
+    def ack(self, channel, token, retry=()):
+        """
+        Drops a handled batch, putting `retry` back on the queue in the same
+        transaction.
+        """
+        pipe = self.client.pipeline()
+        if retry:
+            pipe.rpush(self._key(channel), *[json.dumps(message) for message in retry])
+        pipe.delete(self._processing_key(channel, token))
+        pipe.zrem(self._leases_key(channel), token)
+        pipe.execute()
+
+    def requeue_expired(self, channel):
+        """
+        Moves batches not acked within NOTIFY_ACK_TIMEOUT back to the head of
+        the queue. Returns the number of messages recovered.
+        """
+        recovered = 0
+        for token in self.client.zrangebyscore(self._leases_key(channel), "-inf", time.time()):
+            if not self.client.zrem(self._leases_key(channel), token):
+                continue  # Another flusher is recovering it
+            processing = self._processing_key(channel, token.decode())
+            while self.client.lmove(processing, self._key(channel), "RIGHT", "LEFT") is not None:
+                recovered += 1
+        return recovered
+
+    def length(self, channel):
+        return self.client.llen(self._key(channel))
+
+
+_memory_queue = InMemoryQueue()
+
+
+def get_queue():
+    if settings.NOTIFY_QUEUE_BACKEND == "memory":
+        return _memory_queue
+    return RedisQueue(get_redis())
+
+
+# Delivery backends
+
+class FakeBackend:
+    """
+    Records messages instead of sending them, optionally sleeping to mimic
+    provider latency. Used for tests and load benchmarks.
+    """
+    outbox = []
+
+    def send_emails(self, messages):
+        self._deliver(messages)
+        return [True] * len(messages)
+
+    def send_sms(self, messages):
+        self._deliver(messages)
+        return [True] * len(messages)
+
+    def _deliver(self, messages):
+        if settings.NOTIFY_FAKE_LATENCY:
+            time.sleep(settings.NOTIFY_FAKE_LATENCY)
+        FakeBackend.outbox.extend(messages)
+
+
+class LiveBackend:
+    """
+    Sends through SMTP and Twilio, reusing one SMTP connection and one pooled
+    HTTP session per worker process instead of connecting per message.
+    """
+    _lock = threading.Lock()
+    _smtp = None
+    _twilio = None
+    _executor = None
+
+    def _smtp_connection(self):
+        with self._lock:
+            if LiveBackend._smtp is None:
+                LiveBackend._smtp = get_connection(fail_silently=False)
+            return LiveBackend._smtp
+
+    def _twilio_client(self):
+        with self._lock:
+            if LiveBackend._twilio is None:
+                from twilio.http.http_client import TwilioHttpClient
+                from twilio.rest import Client
+                LiveBackend._twilio = Client(
+                    settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN,
+                    http_client=TwilioHttpClient(pool_connections=True, timeout=settings.NOTIFY_SMS_TIMEOUT),
+                )
+                LiveBackend._executor = ThreadPoolExecutor(
+                    max_workers=settings.NOTIFY_SMS_WORKERS, thread_name_prefix="sms"
+                )
+            return LiveBackend._twilio
+
+    def send_emails(self, messages):
+        """
+        Sends each message on the shared connection and reports success per
+        message, so one rejected recipient doesn't fail the whole batch.
+        """
+        connection = self._smtp_connection()
+        return [self._send_email(connection, message) for message in messages]
+
+    def _send_email(self, connection, message):
+        email = EmailMessage(message["subject"], message["body"], settings.DEFAULT_FROM_EMAIL, message["to"])
+        for attempt in range(2):
+            try:
+                connection.open()  # No-op while the connection is still up
+                return connection.send_messages([email]) == 1
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                # The server may have dropped an idle connection; reconnect once
+                connection.close()
+                if attempt:
+                    logger.error(f"Email to {message['to']} failed: {e}")
+            except Exception as e:
+                logger.error(f"Email to {message['to']} failed: {e}")
+                return False
+        return False
+
+    def send_sms(self, messages):
+        client = self._twilio_client()
+
+        def send(message):
+            try:
+                with instrumentation.external_call("twilio"):
+                    client.messages.create(body=message["body"], from_=settings.TWILIO_PHONE_NUMBER, to=message["to"])
+                return True
+            except Exception as e:
+                logger.error(f"SMS error to {message['to']}: {e}")
+                return False
+
+        return list(LiveBackend._executor.map(send, messages))
+
+
+def get_backend():
+    return FakeBackend() if settings.NOTIFY_BACKEND == "fake" else LiveBackend()
+
+
+# Public API
+
+def _dedupe_key(channel, message):
+    identity = json.dumps([channel, message["to"], message.get("subject"), message["body"]], sort_keys=True)
+    return f"notify:dedupe:{hashlib.sha1(identity.encode()).hexdigest()}"
+
+
+def _schedule_flush(channel):
+    """
+    Makes sure one flush runs per channel per batch window. Enqueues during
+    the window piggyback on the already scheduled flush.
+    """
+    window = settings.NOTIFY_BATCH_WINDOW
+    if not cache.add(f"notify:scheduled:{channel}", 1, timeout=max(window * 10, 10)):
+        return
+    if settings.NOTIFY_QUEUE_BACKEND == "memory":
+        timer = threading.Timer(window, flush, args=[channel])
+        timer.daemon = True
+        timer.start()
+        return
+    from .tasks import flush_notifications
+    # Each channel has its own queue so email and SMS workers scale independently
+    flush_notifications.apply_async(args=[channel], countdown=window, queue=f"notifications.{channel}")
+
+
+def enqueue(channel, messages):
+    """
+    Queues messages for batched delivery, dropping any identical message to
+    the same recipient already sent within NOTIFY_DEDUPE_WINDOW.
+    """
+    fresh, claimed = [], []
+    now = time.time()
+    for message in messages:
+        key = _dedupe_key(channel, message)
+        if not cache.add(key, 1, timeout=settings.NOTIFY_DEDUPE_WINDOW):
+            metrics.increment(_counter(channel, "deduplicated"))
+            continue
+        claimed.append(key)
+        fresh.append(dict(message, enqueued_at=now, attempts=0))
+    if not fresh:
+        return 0
+    try:
+        get_queue().push(channel, fresh)
+    except Exception:
+        # Release the claims so the caller's retry (e.g. the outbox relay) isn't taken for a duplicate
+        cache.delete_many(claimed)
+        raise
+    metrics.increment(_counter(channel, "enqueued"), len(fresh))
+    _schedule_flush(channel)
+    return len(fresh)
+
+
+def notify_email(subject, body, recipients):
+    recipients = [recipient for recipient in recipients if recipient]
+    if recipients:
+        return enqueue(EMAIL, [{"to": recipients, "subject": subject, "body": body}])
+    return 0
+
+
+def notify_sms(to, body):
+    if to:
+        return enqueue(SMS, [{"to": to, "body": body}])
+    return 0
+
+
+def flush(channel, backend=None):
+    """
+    Sends what a channel had queued when the flush started, in batches of
+    NOTIFY_BATCH_SIZE, acking each batch once handled. Failed messages are
+    requeued for the next flush until NOTIFY_MAX_ATTEMPTS. Returns the
+    number delivered.
+    """
+    cache.delete(f"notify:scheduled:{channel}")  # Later enqueues schedule a new flush
+    backend = backend or get_backend()
+    queue = get_queue()
+    send = backend.send_emails if channel == EMAIL else backend.send_sms
+    recovered = queue.requeue_expired(channel)
+    if recovered:
+        logger.warning(f"Requeued {recovered} unacknowledged {channel} notifications")
+    backlog = queue.length(channel)
+    delivered = 0
+    retried = False
+    while backlog > 0:
+        batch, token = queue.pop_batch(channel, min(settings.NOTIFY_BATCH_SIZE, backlog))
+        if not batch:
+            break
+        backlog -= len(batch)
+        results = send(batch)
+        now = time.time()
+        sent = [message for message, ok in zip(batch, results) if ok]
+        failed = [message for message, ok in zip(batch, results) if not ok]
+        delivered += len(sent)
+        metrics.increment(_counter(channel, "batches"))
+        if sent:
+            metrics.increment(_counter(channel, "sent"), len(sent))
+            latency = sum(now - message["enqueued_at"] for message in sent)
+            metrics.increment(_counter(channel, "latency_ms_sum"), int(latency * 1000))
+        retry = []
+        for message in failed:
+            message["attempts"] += 1
+            if message["attempts"] < settings.NOTIFY_MAX_ATTEMPTS:
+                retry.append(message)
+            else:
+                metrics.increment(_counter(channel, "failed"))
+                logger.error(f"Giving up on {channel} notification to {message['to']}")
+        queue.ack(channel, token, retry)
+        retried = retried or bool(retry)
+    if retried:
+        _schedule_flush(channel)
+    return delivered
+
+
+def stats():
+    counters = metrics.get_counters(COUNTERS)
+    for channel in CHANNELS:
+        sent = counters[_counter(channel, "sent")]
+        counters[_counter(channel, "avg_latency_ms")] = (
+            round(counters[_counter(channel, "latency_ms_sum")] / sent, 1) if sent else None
+        )
+    return counters
@@ -0,0 +1,210 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+from . import analytics, metrics, notifications, push, route_planner, tracking
+from .models import Driver, Parcel, ParcelEvent
+
+logger = logging.getLogger(__name__)
+
+RELAY_LOCK = "outbox:relay"
+
+RELAYED = "outbox.relayed"
+FAILED = "outbox.failed"
+DEAD = "outbox.dead"
+COUNTERS = (RELAYED, FAILED, DEAD)
+
+ROUTE_EVENTS = ("driver_assigned", "status_changed")
+
+
+def _event(parcel, kind, **data):
+    data = {
+        "sender_id": parcel.sender_id,
+        "assigned_driver_id": parcel.assigned_driver_id,
+        "status": parcel.status,
+        "payment_status": parcel.payment_status,
+        "price": str(parcel.price),  # For the revenue rollups
+        **data,
+    }
+    return ParcelEvent(parcel_id=parcel.pk, tracking_code=parcel.tracking_code, kind=kind, data=data)
+
+
+def events_for(parcel, created, update_fields=None):
+    """
+    Builds the outbox events for a parcel save. Must be called before the
+    parcel's tracked snapshot is reset.
+    """
+    if created:
+        return [_event(parcel, "created")]
+    changes = parcel.tracked_changes(update_fields)
+    events = []
+    if "assigned_driver_id" in changes and parcel.assigned_driver_id:
+        data = {"previous_driver_id": changes["assigned_driver_id"]}
+        # Moving to "assigned" is announced by the driver_assigned event
+        if parcel.status == "assigned" and "status" in changes:
+            data["previous_status"] = changes.pop("status")
+        events.append(_event(parcel, "driver_assigned", **data))
+    if "status" in changes:
+        events.append(_event(parcel, "status_changed", previous_status=changes["status"]))
+    if "payment_status" in changes:
+        events.append(_event(parcel, "payment_updated", payment_status=parcel.payment_status))
+    return events
+
+
+def record(parcel, created, update_fields=None):
+    events = events_for(parcel, created, update_fields)
+    if events:
+        ParcelEvent.objects.bulk_create(events)
+    parcel.snapshot_tracked()
+
+
+def record_created(parcels):
+    """
+    Outbox rows for parcels inserted with bulk_create, which sends no signals.
+    """
+    ParcelEvent.objects.bulk_create([_event(parcel, "created") for parcel in parcels])
+
+
+def record_assigned(parcels):
+    """
+    Outbox rows for assignments applied with bulk_update by auto-dispatch.
+    """
+    ParcelEvent.objects.bulk_create([
+        _event(parcel, "driver_assigned", previous_driver_id=None, previous_status="pending") for parcel in parcels
+    ])
+
+
+# Relay
+
+def _phone(user):
+    try:
+        return user.profile.phone_number
+    except ObjectDoesNotExist:
+        return None
+
+
+def _notify(event, parcel, drivers):
+    code = event.tracking_code
+    if event.kind == "driver_assigned":
+        driver = drivers.get(event.data["assigned_driver_id"])
+        if driver is None:
+            return
+        notifications.notify_sms(driver.phone, f"You've been assigned a new parcel: {code}")
+        notifications.notify_sms(_phone(parcel.sender), f"Your parcel {code} is assigned to {driver.name}")
+        notifications.notify_email(
+            "Driver Assigned to Your Parcel",
+            f"Your parcel {code} is now assigned to {driver.name}.",
+            [parcel.sender.email],
+        )
+    elif event.kind == "status_changed":
+        status = event.data["status"]
+        if status == "confirmed":
+            driver = drivers.get(event.data["assigned_driver_id"])
+            if driver is not None:
+                notifications.notify_email(
+                    "Parcel Delivery Confirmed",
+                    f"The customer has confirmed the delivery of parcel {code}.",
+                    [driver.email],
+                )
+            return
+        message = f"Your parcel {code} is now {status}."
+        notifications.notify_sms(_phone(parcel.sender), message)
+        notifications.notify_email("Parcel Update", message, [parcel.sender.email])
+        notifications.notify_sms(parcel.recipient_phone, message)
+
+
+def _deliver(events):
+    """
+    Delivers one batch in id order. Once an event for a parcel fails, that
+    parcel's later events wait for the next run so per-parcel order holds.
+    Returns (delivered events, failed events).
+    """
+    parcels = Parcel.objects.select_related("sender__profile", "assigned_driver").in_bulk(
+        {event.parcel_id for event in events if event.parcel_id}
+    )
+    drivers = Driver.objects.in_bulk(
+        {event.data.get("assigned_driver_id") for event in events if event.data.get("assigned_driver_id")}
+    )
+    delivered, failed, blocked, touched = [], [], set(), {}
+    for event in events:
+        if event.parcel_id in blocked:
+            continue
+        parcel = parcels.get(event.parcel_id)
+        try:
+            if parcel is not None:
+                _notify(event, parcel, drivers)
+                touched[parcel.pk] = parcel
+            delivered.append(event)
+        except Exception as e:
+            logger.warning(f"Outbox event {event.pk} ({event.kind}) for {event.tracking_code} failed: {e}")
+            event.attempts += 1
+            event.last_error = str(e)
+            failed.append(event)
+            blocked.add(event.parcel_id)
+
+    # One cache write and one push per parcel, whatever the number of events
+    for parcel in touched.values():
+        payload = tracking.write_through(parcel)
+        push.publish_parcel(payload, driver_id=parcel.assigned_driver_id)
+    # Stop lists changed for the drivers gaining or losing these parcels
+    route_planner.schedule(
+        {event.data.get("assigned_driver_id") for event in delivered if event.kind in ROUTE_EVENTS}
+        | {event.data.get("previous_driver_id") for event in delivered if event.kind in ROUTE_EVENTS}
+    )
+    return delivered, failed
+
+
+def relay(batch_size=None):
+    """
+    Drains undelivered events in batches. Delivery is at-least-once: an event
+    is marked processed only after its side effects ran, so a crash replays
+    it (notifications dedupe identical messages). Returns the number of
+    events processed.
+    """
+    if not cache.add(RELAY_LOCK, 1, timeout=settings.OUTBOX_RELAY_LOCK_TTL):
+        return 0  # Another relay is running; one at a time keeps per-parcel order
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    processed = 0
+    try:
+        while True:
+            events = list(ParcelEvent.objects.filter(processed_at__isnull=True).order_by("id")[:batch_size])
+            if not events:
+                break
+            delivered, failed = _deliver(events)
+            now = timezone.now()
+            dead = [event for event in failed if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS]
+            for event in dead:
+                # Give up so one poisoned event doesn't block its parcel forever
+                logger.error(f"Dropping outbox event {event.pk} after {event.attempts} attempts: {event.last_error}")
+                event.processed_at = now
+            if delivered:
+                ParcelEvent.objects.filter(id__in=[event.pk for event in delivered]).update(processed_at=now)
+            if failed:
+                ParcelEvent.objects.bulk_update(failed, ["attempts", "last_error", "processed_at"])
+            metrics.increment(RELAYED, len(delivered))
+            metrics.increment(FAILED, len(failed) - len(dead))
+            metrics.increment(DEAD, len(dead))
+            processed += len(delivered) + len(dead)
+            if failed or len(events) < batch_size:
+                break  # Retry failures on the next run rather than spinning on them
+    finally:
+        cache.delete(RELAY_LOCK)
+    return processed
+
+
+def purge():
+    """
+    Deletes delivered events older than OUTBOX_RETENTION_DAYS that the
+    analytics rollups have already counted.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.OUTBOX_RETENTION_DAYS)
+    deleted, _ = ParcelEvent.objects.filter(processed_at__lt=cutoff, id__lte=analytics.cursor_position()).delete()
+    return deleted
+
+
+def stats():
+    counters = metrics.get_counters(COUNTERS)
+    counters["pending"] = ParcelEvent.objects.filter(processed_at__isnull=True).count()
+    return counters
@@ -0,0 +1,285 @@
+import logging
+import threading
+import time
+import uuid
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from . import instrumentation
+from .models import ArchivedParcel, Parcel, PaymentAttempt
+
+logger = logging.getLogger(__name__)
+
+stripe.api_key = settings.STRIPE_API_KEY
+CENTS_PER_DOLLAR = 100
+
+STUB_DECLINED_METHOD = "pm_card_declined"  # Same test method name Stripe uses
+
+
+class PaymentError(Exception):
+    """
+    The payment was refused (declined card, already paid...). Submitting the
+    same attempt again won't change the answer.
+    """
+
+
+class PaymentInProgress(Exception):
+    """
+    Another request is already charging this parcel.
+    """
+
+
+# Gateways
+
+def _intent(intent):
+    return {
+        "id": intent["id"],
+        "status": intent["status"],
+        "client_secret": intent.get("client_secret"),
+        "error": (intent.get("last_payment_error") or {}).get("message", ""),
+    }
+
+
+class StripeGateway:
+    def create_intent(self, attempt, tracking_code):
+        try:
+            with instrumentation.external_call("stripe"):
+                intent = stripe.PaymentIntent.create(
+                    amount=attempt.amount,
+                    currency=attempt.currency,
+                    description=f"Payment for parcel {tracking_code}",
+                    payment_method=attempt.payment_method,
+                    confirm=True,
+                    metadata={"tracking_code": tracking_code, "attempt": attempt.pk},
+                    idempotency_key=attempt.idempotency_key,
+                )
+        except (stripe.error.CardError, stripe.error.InvalidRequestError) as e:
+            raise PaymentError(e.user_message or str(e)) from e
+        # Other StripeErrors (network, rate limits) propagate; the attempt stays resubmittable
+        return _intent(intent)
+
+
+class StubGateway:
+    """
+    Local stand-in for Stripe for load tests: honours idempotency keys,
+    takes PAYMENT_STUB_LATENCY seconds per call and declines
+    STUB_DECLINED_METHOD.
+    """
+    intents = {}  # idempotency key -> intent, shared like Stripe's key store
+    lock = threading.Lock()
+
+    def create_intent(self, attempt, tracking_code):
+        if settings.PAYMENT_STUB_LATENCY:
+            time.sleep(settings.PAYMENT_STUB_LATENCY)
+        with self.lock:
+            intent = self.intents.get(attempt.idempotency_key)
+            if intent is None:
+                intent_id = f"pi_stub_{uuid.uuid4().hex[:24]}"
+                declined = attempt.payment_method == STUB_DECLINED_METHOD
+                intent = {
+                    "id": intent_id,
+                    "status": "requires_payment_method" if declined else "succeeded",
+                    "client_secret": f"{intent_id}_secret",
+                    "last_payment_error": {"message": "Your card was declined."} if declined else None,
+                    "amount": attempt.amount,
+                    "metadata": {"tracking_code": tracking_code, "attempt": attempt.pk},
+                }
+                self.intents[attempt.idempotency_key] = intent
+        if intent["status"] == "requires_payment_method":
+            raise PaymentError(intent["last_payment_error"]["message"])
+        return _intent(intent)
+
+
+def gateway():
+    return StubGateway() if settings.PAYMENT_GATEWAY == "stub" else StripeGateway()
+
+
+# Attempts
+
+def begin(parcel_id, payment_method):
+    """
+    Returns the parcel's attempt to submit: the open one if a previous
+    request left it unconfirmed, otherwise a new one. The parcel row lock
+    serializes concurrent requests, so double submits share an attempt.
+    """
+    with transaction.atomic():
+        parcel = Parcel.objects.select_for_update().get(pk=parcel_id)
+        if parcel.payment_status == "paid":
+            raise PaymentError("Parcel is already paid for.")
+        latest = parcel.payment_attempts.order_by("-number").first()
+        if latest is not None and latest.status == "processing":
+            raise PaymentInProgress("The payment is awaiting confirmation.")
+        if latest is not None and latest.status == "pending":
+            return latest
+        number = latest.number + 1 if latest else 1
+        return PaymentAttempt.objects.create(
+            parcel=parcel,
+            number=number,
+            idempotency_key=f"parcel-{parcel.pk}-attempt-{number}",
+            amount=int(parcel.price * CENTS_PER_DOLLAR),
+            payment_method=payment_method,
+        )
+
+
+def submit(attempt):
+    """
+    Sends an attempt to the gateway and records the answer. Returns
+    (attempt, intent). Safe to repeat after a crash or network error: the
+    idempotency key makes the gateway replay its first answer.
+    """
+    lock = f"payment:submitting:{attempt.pk}"
+    if not cache.add(lock, 1, timeout=settings.PAYMENT_SUBMIT_LOCK_TTL):
+        raise PaymentInProgress("The payment is already being processed.")
+    try:
+        tracking_code = Parcel.objects.values_list("tracking_code", flat=True).get(pk=attempt.parcel_id)
+        try:
+            intent = gateway().create_intent(attempt, tracking_code)
+        except PaymentError as e:
+            fail(attempt.pk, str(e))
+            raise
+        return record_intent(attempt.pk, intent), intent
+    finally:
+        cache.delete(lock)
+
+
+def record_intent(attempt_id, intent):
+    """
+    Applies a gateway answer (from submit() or a webhook) to an attempt.
+    Whichever arrives first wins; the other finds the attempt settled.
+    """
+    if intent["status"] == "succeeded":
+        return complete(attempt_id, intent["id"])
+    if intent["status"] in ("requires_payment_method", "canceled"):
+        return fail(attempt_id, intent.get("error") or "Payment failed", intent["id"])
+    with transaction.atomic():
+        attempt = PaymentAttempt.objects.select_for_update().get(pk=attempt_id)
+        if attempt.status == "pending":
+            attempt.status = "processing"  # e.g. requires_action: the customer still has to confirm
+            attempt.intent_id = intent["id"]
+            attempt.save(update_fields=["status", "intent_id", "updated_at"])
+    return attempt
+
+
+def _set_parcel_payment(parcel_id, payment_status, only_from=None):
+    """
+    Moves a parcel's payment_status under a row lock. save() records the
+    payment_updated outbox event that notifies the sender.
+    """
+    parcel = Parcel.objects.select_for_update().filter(pk=parcel_id).first()
+    if parcel is None:
+        # Archived parcels can still be refunded; the archive has no outbox events
+        archived = ArchivedParcel.objects.filter(pk=parcel_id).exclude(payment_status=payment_status)
+        if only_from:
+            archived = archived.filter(payment_status__in=only_from)
+        archived.update(payment_status=payment_status)
+        return
+    if parcel.payment_status == payment_status or (only_from and parcel.payment_status not in only_from):
+        return
+    parcel.payment_status = payment_status
+    parcel.save(update_fields=["payment_status", "updated_at"])
+
+
+def complete(attempt_id, intent_id=None):
+    with transaction.atomic():
+        attempt = PaymentAttempt.objects.select_for_update().get(pk=attempt_id)
+        if attempt.status in PaymentAttempt.SETTLED_STATUSES:
+            return attempt
+        attempt.status = "succeeded"
+        attempt.intent_id = intent_id or attempt.intent_id
+        attempt.error = ""
+        attempt.save(update_fields=["status", "intent_id", "error", "updated_at"])
+        _set_parcel_payment(attempt.parcel_id, "paid")
+    logger.info(f"Payment {attempt.idempotency_key} succeeded")
+    return attempt
+
+
+def fail(attempt_id, error, intent_id=None):
+    with transaction.atomic():
+        attempt = PaymentAttempt.objects.select_for_update().get(pk=attempt_id)
+        if attempt.status in PaymentAttempt.SETTLED_STATUSES or attempt.status == "failed":
+            return attempt
+        attempt.status = "failed"
+        attempt.intent_id = intent_id or attempt.intent_id
+        attempt.error = error
+        attempt.save(update_fields=["status", "intent_id", "error", "updated_at"])
+        # A late failure of an older attempt says nothing about the parcel
+        if not PaymentAttempt.objects.filter(parcel_id=attempt.parcel_id, number__gt=attempt.number).exists():
+            _set_parcel_payment(attempt.parcel_id, "failed", only_from=("pending",))
+    logger.info(f"Payment {attempt.idempotency_key} failed: {error}")
+    return attempt
+
+
+def _attempt_for(intent_id, metadata):
+    """
+    The attempt an intent (or one of its charges) belongs to: by intent id,
+    or by the attempt id in its metadata when the gateway's answer hasn't
+    been recorded yet.
+    """
+    attempt_id = PaymentAttempt.objects.filter(intent_id=intent_id).values_list("pk", flat=True).first() if intent_id else None
+    if attempt_id is None and metadata.get("attempt"):
+        attempt_id = PaymentAttempt.objects.filter(pk=metadata["attempt"]).values_list("pk", flat=True).first()
+    return attempt_id
+
+
+def refund(intent_id, amount_refunded, fully, metadata=None):
+    """
+    Applies a charge.refunded webhook. Only full refunds change the payment
+    status. Refund amounts are cumulative, so replays and out-of-order
+    deliveries settle on the largest. Returns False when nothing matches.
+    """
+    metadata = metadata or {}
+    attempt_id = _attempt_for(intent_id, metadata)
+    with transaction.atomic():
+        if attempt_id is None:
+            # Charged before attempts were recorded
+            parcel_id = Parcel.objects.filter(tracking_code=metadata.get("tracking_code")).values_list("pk", flat=True).first()
+            if parcel_id is None:
+                return False
+            if fully:
+                _set_parcel_payment(parcel_id, "refunded")
+            return True
+        attempt = PaymentAttempt.objects.select_for_update().get(pk=attempt_id)
+        attempt.refunded_amount = max(attempt.refunded_amount, amount_refunded)
+        attempt.intent_id = attempt.intent_id or intent_id
+        if fully:
+            attempt.status = "refunded"
+        attempt.save(update_fields=["refunded_amount", "intent_id", "status", "updated_at"])
+        if fully:
+            _set_parcel_payment(attempt.parcel_id, "refunded")
+    logger.info(f"Refund of {amount_refunded} applied to {attempt.idempotency_key}")
+    return True
+
+
+def handle_intent_event(intent):
+    """
+    Applies a payment_intent.* webhook. Intents created before attempts
+    were recorded are matched by tracking code instead. Returns False when
+    the intent matches nothing.
+    """
+    intent = dict(intent)
+    metadata = intent.get("metadata") or {}
+    attempt_id = _attempt_for(intent["id"], metadata)
+    if attempt_id is not None:
+        record_intent(attempt_id, _intent(intent))
+        return True
+    if intent["status"] != "succeeded" or "tracking_code" not in metadata:
+        return False
+    parcel_id = Parcel.objects.filter(tracking_code=metadata["tracking_code"]).values_list("pk", flat=True).first()
+    if parcel_id is None:
+        return False
+    with transaction.atomic():
+        # A replayed success must not undo a refund
+        _set_parcel_payment(parcel_id, "paid", only_from=("pending", "failed"))
+    return True
+
+
+def describe(attempt, intent=None):
+    return {
+        "attempt": attempt.number,
+        "status": attempt.status,
+        "amount": attempt.amount,
+        "currency": attempt.currency,
+        "error": attempt.error or None,
+        "client_secret": intent["client_secret"] if intent else None,
+    }
@@ -1,3 +1,5 @@
+import hmac
+from django.conf import settings
 from rest_framework.permissions import BasePermission
 
 class IsAdmin(BasePermission):
@@ -11,3 +13,9 @@ class IsDriver(BasePermission):
 class IsCustomer(BasePermission):
     def has_permission(self, request, view):
         return request.user.is_authenticated and request.user.role == "customer"
+
+# For Prometheus scrapers: "Authorization: Token <METRICS_TOKEN>"
+class HasMetricsToken(BasePermission):
+    def has_permission(self, request, view):
+        token = settings.METRICS_TOKEN
+        return bool(token) and hmac.compare_digest(request.headers.get("Authorization", ""), f"Token {token}")
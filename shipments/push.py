@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import re
+import time
+from asgiref.sync import async_to_sync
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPE = "parcel.update"  # Dispatched to the consumer's parcel_update handler
+_unsafe = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def tracking_group(tracking_code):
+    return f"track.{_unsafe.sub('_', tracking_code)}"[:99]
+
+
+def driver_group(driver_id):
+    return f"driver.{driver_id}"
+
+
+def _channel_layer():
+    from channels.layers import get_channel_layer
+    return get_channel_layer()
+
+
+def publish(groups, kind, data):
+    """
+    Fans a message out to every subscriber of the given groups through the
+    channel layer. Subscribers are served from this message alone, so a push
+    never causes database reads. Failures are logged, never raised.
+    """
+    layer = _channel_layer()
+    if layer is None:
+        return
+    message = {"type": MESSAGE_TYPE, "kind": kind, "data": data, "sent_at": time.time()}
+    try:
+        for group in groups:
+            async_to_sync(layer.group_send)(group, message)
+    except Exception as e:
+        logger.warning(f"Could not publish {kind} update to {groups}: {e}")
+
+
+def publish_parcel(payload, driver_id=None):
+    """
+    Pushes a full tracking payload after a state transition.
+    """
+    groups = [tracking_group(payload["tracking_code"])]
+    if driver_id:
+        groups.append(driver_group(driver_id))
+    publish(groups, "status", payload)
+
+
+def publish_locations(pings):
+    """
+    Pushes the newest position per parcel; a driver's group gets one message
+    per ping batch rather than one per parcel.
+    """
+    latest = {}
+    for ping in pings:
+        current = latest.get(ping["tracking_code"])
+        if current is None or ping["ts"] >= current["ts"]:
+            latest[ping["tracking_code"]] = ping
+    drivers = {}
+    for tracking_code, ping in latest.items():
+        data = {
+            "tracking_code": tracking_code,
+            "current_latitude": ping.get("latitude"),
+            "current_longitude": ping.get("longitude"),
+            "current_location": ping.get("location"),
+            "ts": ping["ts"],
+        }
+        publish([tracking_group(tracking_code)], "location", data)
+        if ping.get("driver_id"):
+            drivers.setdefault(ping["driver_id"], []).append(data)
+    for driver_id, positions in drivers.items():
+        publish([driver_group(driver_id)], "location", {"parcels": positions})
+
+
+def merge_positions(old, new):
+    """
+    Combines two unsent driver-group location messages ({"parcels": [...]}),
+    keeping the newest position of each parcel.
+    """
+    positions = {position["tracking_code"]: position for position in old["data"]["parcels"]}
+    for position in new["data"]["parcels"]:
+        current = positions.get(position["tracking_code"])
+        if current is None or position["ts"] >= current["ts"]:
+            positions[position["tracking_code"]] = position
+    return dict(new, data=dict(new["data"], parcels=list(positions.values())))
+
+
+class Coalescer:
+    """
+    Per-connection outbox that keeps only the newest message of each kind.
+    A slow client never builds up a queue: while it's busy, newer updates
+    replace older unsent ones, and sends are spaced by PUSH_MIN_INTERVAL.
+    """
+    def __init__(self, min_interval=None):
+        self.min_interval = settings.PUSH_MIN_INTERVAL if min_interval is None else min_interval
+        self._pending = {}
+        self._ready = asyncio.Event()
+        self._last_sent = 0.0
+        self.dropped = 0
+
+    def put(self, key, message, merge=None):
+        """
+        Queues `message`, replacing an unsent one with the same key, or
+        combining the two with merge(old, new) when given.
+        """
+        pending = self._pending.get(key)
+        if pending is not None:
+            if merge is not None:
+                message = merge(pending, message)
+            else:
+                self.dropped += 1
+        self._pending[key] = message
+        self._ready.set()
+
+    async def next_batch(self, timeout=None):
+        """
+        Waits for pending messages and returns them, or [] on timeout.
+        """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        wait = self._last_sent + self.min_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)  # Anything arriving meanwhile is merged into this batch
+        batch = list(self._pending.values())
+        self._pending.clear()
+        self._ready.clear()
+        self._last_sent = time.monotonic()
+        return batch
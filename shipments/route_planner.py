@@ -0,0 +1,182 @@
+import hashlib
+import logging
+import math
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import geo
+from .local_cache import MISSING, LocalCache
+from .models import Driver, Parcel
+
+logger = logging.getLogger(__name__)
+
+# Stop-to-stop matrices by parcel set; a driver's stops rarely change between plans
+_matrices = LocalCache(settings.ROUTE_MATRIX_CACHE_SIZE, settings.ROUTE_CACHE_TTL)
+
+
+def route_key(driver_id):
+    return f"route:driver:{driver_id}"
+
+
+def distance_matrix(points):
+    """
+    Pairwise distances in km between (lat, lng) points, on an equirectangular
+    projection centred on the points (city-scale accuracy, no trig per pair).
+    """
+    if not points:
+        return []
+    cos_lat = math.cos(math.radians(sum(lat for lat, _ in points) / len(points)))
+    projected = [(lng * cos_lat * geo.KM_PER_DEGREE, lat * geo.KM_PER_DEGREE) for lat, lng in points]
+    hypot = math.hypot
+    return [[hypot(x1 - x2, y1 - y2) for x2, y2 in projected] for x1, y1 in projected]
+
+
+def path_length(path, matrix):
+    return sum(matrix[a][b] for a, b in zip(path, path[1:]))
+
+
+def nearest_neighbour(matrix, start=0):
+    path = [start]
+    remaining = set(range(len(matrix))) - {start}
+    while remaining:
+        row = matrix[path[-1]]
+        closest = min(remaining, key=row.__getitem__)
+        path.append(closest)
+        remaining.remove(closest)
+    return path
+
+
+def two_opt(path, matrix, deadline=None):
+    """
+    Improves an open path (first node fixed, no return leg) by reversing
+    segments while that shortens it, until no move helps or the deadline passes.
+    """
+    path = list(path)
+    n = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            a, b = path[i - 1], path[i]
+            row_a = matrix[a]
+            d_ab = row_a[b]
+            row_b = matrix[b]
+            for j in range(i + 1, n):
+                c = path[j]
+                if j + 1 < n:
+                    d = path[j + 1]
+                    delta = row_a[c] + row_b[d] - d_ab - matrix[c][d]
+                else:
+                    delta = row_a[c] - d_ab  # Reversing the tail only changes its first edge
+                if delta < -1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    improved = True
+                    b = path[i]
+                    d_ab = row_a[b]
+                    row_b = matrix[b]
+            if deadline is not None and time.monotonic() > deadline:
+                return path
+    return path
+
+
+def plan(start, stops, stops_key=None, time_limit=None):
+    """
+    Orders `stops` ([(lat, lng)]) for a driver at `start` ((lat, lng) or
+    None to begin at the first stop). Returns (order, distance_km) where
+    order indexes into `stops`. `stops_key` memoizes the stop matrix.
+    """
+    if not stops:
+        return [], 0.0
+    matrix = _matrices.get(stops_key) if stops_key else MISSING
+    if matrix is MISSING:
+        matrix = distance_matrix(stops)
+        if stops_key:
+            _matrices.set(stops_key, matrix)
+
+    if start is not None:
+        # Node 0 is the driver; only its row/column is computed per plan
+        from_start = distance_matrix([start] + list(stops))[0]
+        full = [from_start] + [[from_start[i + 1]] + row for i, row in enumerate(matrix)]
+    else:
+        full = matrix
+
+    time_limit = settings.ROUTE_OPTIMIZE_TIME_LIMIT if time_limit is None else time_limit
+    path = two_opt(nearest_neighbour(full), full, deadline=time.monotonic() + time_limit)
+    distance = path_length(path, full)
+    order = [node - 1 for node in path[1:]] if start is not None else path
+    return order, distance
+
+
+def _stops_key(rows):
+    identity = "|".join(f"{row['id']}:{row['destination_latitude']}:{row['destination_longitude']}" for row in rows)
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def driver_route(driver_id, refresh=False):
+    """
+    Returns the planned stop order for a driver's active parcels, reusing the
+    stored plan while the set of parcels is unchanged.
+    """
+    rows = list(
+        Parcel.objects.filter(assigned_driver_id=driver_id, status__in=Parcel.ACTIVE_STATUSES)
+        .order_by("id")
+        .values("id", "tracking_code", "status", "recipient_address", "destination_latitude", "destination_longitude")
+    )
+    routable, unrouted = [], []
+    for row in rows:
+        geocoded = row["destination_latitude"] is not None and row["destination_longitude"] is not None
+        (routable if geocoded else unrouted).append(row)
+    stops_key = _stops_key(rows)
+    cached = cache.get(route_key(driver_id))
+    if not refresh and cached and cached["stops_key"] == stops_key:
+        return cached
+
+    start = Driver.objects.filter(pk=driver_id).values_list("last_latitude", "last_longitude").first()
+    if start is None or None in start:
+        start = None
+    started = time.perf_counter()
+    order, distance = plan(start, [(row["destination_latitude"], row["destination_longitude"]) for row in routable], stops_key)
+
+    stops = []
+    previous = start
+    for index in order:
+        row = routable[index]
+        point = (row["destination_latitude"], row["destination_longitude"])
+        stops.append({
+            "parcel_id": str(row["id"]),
+            "tracking_code": row["tracking_code"],
+            "status": row["status"],
+            "address": row["recipient_address"],
+            "latitude": point[0],
+            "longitude": point[1],
+            "leg_km": round(geo.haversine_km(*previous, *point), 3) if previous else 0.0,
+        })
+        previous = point
+    route = {
+        "driver": driver_id,
+        "stops": stops,
+        # Not geocoded yet; the driver sees them but they aren't sequenced
+        "unrouted": [row["tracking_code"] for row in unrouted],
+        "distance_km": round(distance, 3),
+        "stops_key": stops_key,
+        "computed_at": time.time(),
+        "compute_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    cache.set(route_key(driver_id), route, timeout=settings.ROUTE_CACHE_TTL)
+    return route
+
+
+def schedule(driver_ids):
+    """
+    Queues a background re-plan for drivers whose assignments changed,
+    collapsing bursts into one run per driver per ROUTE_PLAN_DEBOUNCE.
+    """
+    from .tasks import plan_driver_route
+    for driver_id in {driver_id for driver_id in driver_ids if driver_id}:
+        if not cache.add(f"route:scheduled:{driver_id}", 1, timeout=settings.ROUTE_PLAN_DEBOUNCE):
+            continue
+        try:
+            plan_driver_route.apply_async(args=[driver_id], countdown=settings.ROUTE_PLAN_DEBOUNCE)
+        except Exception as e:
+            cache.delete(f"route:scheduled:{driver_id}")
+            logger.warning(f"Could not queue route planning for driver {driver_id}: {e}")
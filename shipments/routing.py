@@ -0,0 +1,7 @@
+from django.urls import path
+from .consumers import ParcelUpdatesConsumer
+
+websocket_urlpatterns = [
+    path('ws/track/<str:tracking_code>/', ParcelUpdatesConsumer.as_asgi()),
+    path('ws/drivers/<int:driver_id>/', ParcelUpdatesConsumer.as_asgi()),
+]
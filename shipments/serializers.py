@@ -1,4 +1,8 @@
+import time
+from django.db import transaction
 from rest_framework import serializers
+from . import ids, outbox
+from .geo import geohash
 from .models import Driver, Parcel
 
 
@@ -10,8 +14,8 @@ class DriverSerializer(serializers.ModelSerializer):
 
 
 class ParcelSerializer(serializers.ModelSerializer):
-    current_latitude = serializers.FloatField(min_value=-90, max_value=90, allow_null=True)
-    current_longitude = serializers.FloatField(min_value=-180, max_value=180, allow_null=True)
+    current_latitude = serializers.FloatField(min_value=-90, max_value=90, allow_null=True, required=False)
+    current_longitude = serializers.FloatField(min_value=-180, max_value=180, allow_null=True, required=False)
     
     class Meta:
         model = Parcel
@@ -24,6 +28,54 @@ class ParcelSerializer(serializers.ModelSerializer):
         read_only_fields = ["tracking_code", "created_at", "sender"]
 
 
+# 📦 Bulk Parcel Serializers (validates a chunk of rows, keeps per-row errors)
+class ParcelBulkListSerializer(serializers.ListSerializer):
+    def to_internal_value(self, data):
+        """
+        Validates every row instead of failing the whole chunk on the first bad
+        one. Valid rows become validated_data; the rest are kept in row_errors
+        keyed by their index in the chunk.
+        """
+        self.valid_indexes = []
+        self.row_errors = {}
+        validated = []
+        for index, item in enumerate(data):
+            try:
+                validated.append(self.child.run_validation(item))
+                self.valid_indexes.append(index)
+            except serializers.ValidationError as exc:
+                self.row_errors[index] = exc.detail
+        return validated
+
+    def create(self, validated_data):
+        # Ids and codes come from one reserved block each, so they can't collide
+        count = len(validated_data)
+        parcels = [
+            Parcel(
+                id=parcel_id,
+                tracking_code=code,
+                # bulk_create skips save(), so the geohash is filled in here
+                geohash=geohash(attrs.get("current_latitude"), attrs.get("current_longitude")),
+                **attrs
+            )
+            for parcel_id, code, attrs in zip(ids.uuid7s(count), ids.tracking_codes(count), validated_data)
+        ]
+        with transaction.atomic():
+            parcels = Parcel.objects.bulk_create(parcels)
+            outbox.record_created(parcels)
+        return parcels
+
+
+class ParcelBulkSerializer(ParcelSerializer):
+    current_latitude = serializers.FloatField(min_value=-90, max_value=90, allow_null=True, required=False)
+    current_longitude = serializers.FloatField(min_value=-180, max_value=180, allow_null=True, required=False)
+
+    class Meta(ParcelSerializer.Meta):
+        list_serializer_class = ParcelBulkListSerializer
+        # Bulk rows only describe the shipment; assignment and payment go through their own endpoints
+        read_only_fields = ParcelSerializer.Meta.read_only_fields + ["status", "assigned_driver", "payment_status"]
+
+
 # 🔍 Parcel Tracking Serializer (Only shows relevant tracking fields)
 class ParcelTrackSerializer(serializers.ModelSerializer):
     class Meta:
@@ -33,10 +85,56 @@ class ParcelTrackSerializer(serializers.ModelSerializer):
 
 # 📍 Update Location Serializer (Allows partial updates)
 class ParcelUpdateLocationSerializer(serializers.ModelSerializer):
+    current_latitude = serializers.FloatField(min_value=-90, max_value=90, allow_null=True, required=False)
+    current_longitude = serializers.FloatField(min_value=-180, max_value=180, allow_null=True, required=False)
+
     class Meta:
         model = Parcel
         fields = ["current_latitude", "current_longitude", "current_location"]
 
 
+class LocationPointSerializer(serializers.Serializer):
+    current_latitude = serializers.FloatField(min_value=-90, max_value=90)
+    current_longitude = serializers.FloatField(min_value=-180, max_value=180)
+    timestamp = serializers.DateTimeField()
+
+
+# 🚚 Driver Location Serializer (one position, or a short trail, for all active parcels)
+class DriverLocationSerializer(serializers.Serializer):
+    current_latitude = serializers.FloatField(min_value=-90, max_value=90, required=False)
+    current_longitude = serializers.FloatField(min_value=-180, max_value=180, required=False)
+    current_location = serializers.CharField(max_length=255, required=False, allow_blank=True, allow_null=True)
+    points = LocationPointSerializer(many=True, required=False, min_length=1, max_length=50)
+
+    def validate(self, attrs):
+        has_position = "current_latitude" in attrs and "current_longitude" in attrs
+        if not has_position and not attrs.get("points"):
+            raise serializers.ValidationError("Send current_latitude/current_longitude or a list of points.")
+        return attrs
+
+    def trail(self):
+        """
+        Returns the positions oldest first as {"data": fields, "ts": epoch};
+        the last one is the driver's current position.
+        """
+        attrs = self.validated_data
+        location = {"current_location": attrs["current_location"]} if "current_location" in attrs else {}
+        if attrs.get("points"):
+            trail = sorted(attrs["points"], key=lambda point: point["timestamp"])
+            points = [
+                {
+                    "data": {"current_latitude": point["current_latitude"], "current_longitude": point["current_longitude"]},
+                    "ts": point["timestamp"].timestamp(),
+                }
+                for point in trail
+            ]
+            points[-1]["data"].update(location)
+            return points
+        return [{
+            "data": {"current_latitude": attrs["current_latitude"], "current_longitude": attrs["current_longitude"], **location},
+            "ts": time.time(),
+        }]
+
+
 class PaymentSerializer(serializers.Serializer):
     payment_method_id = serializers.CharField(required=True)
\ No newline at end of file
@@ -1,31 +1,42 @@
 # logistics/signals.py
-from django.db.models.signals import post_save
+from celery.signals import worker_process_shutdown
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django.core.cache import cache
+from django.db import transaction
 from .models import Parcel
-from .tasks import send_email_async, send_sms_async
+from . import dispatch, location_buffer, metrics, outbox, tracking, versioning
 
 
 @receiver(post_save, sender=Parcel)
-def notify_parcel_update(sender, instance, update_fields, **kwargs):
-    if update_fields and ('status' in update_fields or 'assigned_driver' in update_fields):
-        cache.delete(instance.tracking_code)
-        # Notify sender
-        if instance.sender.profile.phone_number:
-            sms_message = f"Your parcel {instance.tracking_code} is now {instance.status}."
-            send_sms_async.delay(instance.sender.profile.phone_number, sms_message)
-        send_email_async.delay(
-            "Parcel Update",
-            f"Your parcel {instance.tracking_code} is now {instance.status}.",
-            [instance.sender.email]
-        )
-
-        # Notify recipient (if status changes)
-        if 'status' in update_fields and instance.recipient_phone:
-            sms_message = f"Your parcel {instance.tracking_code} is now {instance.status}."
-            send_sms_async.delay(instance.recipient_phone, sms_message)
-
-        # Notify driver (if assigned)
-        if 'assigned_driver' in update_fields and instance.assigned_driver and instance.assigned_driver.phone_number:
-            sms_message = f"You've been assigned parcel {instance.tracking_code}."
-            send_sms_async.delay(instance.assigned_driver.phone_number, sms_message)
\ No newline at end of file
+def update_tracking_cache(sender, instance, **kwargs):
+    # Write-through on every save (not only update_fields saves), once the change is committed.
+    # Pushes go out from the outbox relay.
+    def refresh():
+        tracking.write_through(instance)
+        versioning.touch_dashboards([instance.sender_id, instance.assigned_driver_id])
+        location_buffer.forget_assignments([instance.pk])
+    transaction.on_commit(refresh)
+
+
+@receiver(post_delete, sender=Parcel)
+def drop_tracking_cache(sender, instance, **kwargs):
+    if instance.assigned_driver_id and instance.status in Parcel.ACTIVE_STATUSES:
+        dispatch.release_load(instance.assigned_driver_id)
+    def drop():
+        tracking.invalidate([instance.tracking_code])
+        versioning.touch_dashboards([instance.sender_id, instance.assigned_driver_id])
+        location_buffer.forget_assignments([instance.pk])
+    transaction.on_commit(drop)
+
+
+@receiver(post_save, sender=Parcel)
+def record_parcel_events(sender, instance, created, update_fields, **kwargs):
+    # Runs inside Parcel.save()'s transaction; the relay task sends the notifications
+    dispatch.sync_driver_load(instance, created, update_fields)
+    outbox.record(instance, created, update_fields)
+
+
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    # Prefork children exit without running atexit handlers
+    metrics.flush()
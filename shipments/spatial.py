@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.db.models import Q
+from . import geo
+from .models import Driver, Parcel
+
+
+def _within(queryset, lat_field, lng_field, lat, lng, radius_km):
+    """
+    Narrows a queryset to a circle: geohash prefixes pick the index range,
+    a bounding box trims the cell corners in SQL.
+    """
+    box = geo.bounding_box(lat, lng, radius_km)
+    prefix_match = Q()
+    for prefix in geo.covering_prefixes(*box):
+        prefix_match |= Q(geohash__startswith=prefix)
+    min_lat, min_lng, max_lat, max_lng = box
+    return queryset.filter(prefix_match).filter(**{
+        f"{lat_field}__range": (min_lat, max_lat),
+        f"{lng_field}__range": (min_lng, max_lng),
+    })
+
+
+def _refine(rows, lat_key, lng_key, lat, lng, radius_km, limit):
+    """
+    Exact haversine pass over the prefiltered rows, closest first.
+    """
+    results = []
+    for row in rows:
+        distance = geo.haversine_km(lat, lng, row[lat_key], row[lng_key])
+        if distance <= radius_km:
+            row["distance_km"] = round(distance, 3)
+            results.append(row)
+    results.sort(key=lambda row: row["distance_km"])
+    return results[:limit]
+
+
+def nearby_parcels(lat, lng, radius_km, statuses=None, limit=None):
+    queryset = Parcel.objects.all()
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    rows = _within(queryset, "current_latitude", "current_longitude", lat, lng, radius_km).values(
+        "id", "tracking_code", "status", "assigned_driver_id", "current_location", "current_latitude", "current_longitude",
+    )[:settings.SPATIAL_MAX_CANDIDATES]
+    return _refine(rows, "current_latitude", "current_longitude", lat, lng, radius_km, limit or settings.SPATIAL_MAX_RESULTS)
+
+
+def nearby_drivers(lat, lng, radius_km, available_only=False, limit=None):
+    queryset = Driver.objects.filter(last_seen_at__isnull=False)
+    if available_only:
+        queryset = queryset.filter(active_parcels__lt=Driver.MAX_ACTIVE_PARCELS)
+    rows = _within(queryset, "last_latitude", "last_longitude", lat, lng, radius_km).values(
+        "pk", "name", "active_parcels", "last_latitude", "last_longitude", "last_seen_at",
+    )[:settings.SPATIAL_MAX_CANDIDATES]
+    return _refine(rows, "last_latitude", "last_longitude", lat, lng, radius_km, limit or settings.SPATIAL_MAX_RESULTS)
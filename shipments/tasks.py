@@ -1,16 +1,211 @@
 from celery import shared_task
-from .utils import send_email_notification, send_sms
+from django.utils import timezone
 
-@shared_task(bind=True, max_retries=3)
-def send_email_async(self, subject, message, recipient_list):
+@shared_task
+def send_email_async(subject, message, recipient_list):
+    """
+    Kept for already queued jobs; new code enqueues through shipments.notifications.
+    """
+    from . import notifications
+    notifications.notify_email(subject, message, recipient_list)
+
+@shared_task
+def send_sms_async(to, message):
+    from . import notifications
+    notifications.notify_sms(to, message)
+
+@shared_task(ignore_result=True)
+def flush_notifications(channel):
+    """
+    Delivers everything queued on a notification channel. Routed to the
+    notifications.<channel> queue so each channel gets its own worker pool.
+    """
+    from . import notifications
+    notifications.flush(channel)
+
+@shared_task(bind=True, max_retries=5)
+def geocode_parcel(self, parcel_id):
+    """
+    Fills in a parcel's destination coordinates (and its position, if none was
+    reported yet) from the recipient address after creation, so the create
+    request never waits on the Geocoding API.
+    """
+    from .geo import geohash
+    from .geocoding import geocode
+    from .models import Parcel
+
+    row = Parcel.objects.filter(id=parcel_id).values_list("recipient_address", "tracking_code", "sender_id").first()
+    if row is None:
+        return
+    address, tracking_code, sender_id = row
     try:
-        send_email_notification(subject, message, recipient_list)
+        lat, lng = geocode(address)
     except Exception as e:
-        self.retry(exc=e, countdown=5)  # Retry after 5 seconds, up to 3 times
+        raise self.retry(exc=e, countdown=2 ** self.request.retries * 5)  # Back off: 5s, 10s, 20s...
+    if lat is not None and lng is not None:
+        now = timezone.now()
+        Parcel.objects.filter(id=parcel_id).update(destination_latitude=lat, destination_longitude=lng, updated_at=now)
+        # Only fill a current position the driver hasn't already reported
+        Parcel.objects.filter(id=parcel_id, current_latitude__isnull=True).update(
+            current_latitude=lat, current_longitude=lng, geohash=geohash(lat, lng), updated_at=now
+        )
+        from . import tracking, versioning
+        tracking.invalidate([tracking_code])
+        versioning.touch_dashboards([sender_id])
+
+@shared_task(bind=True, max_retries=5)
+def geocode_parcels(self, parcel_ids):
+    """
+    Batch variant used by bulk ingestion: each distinct address is resolved
+    once and all parcels sharing it are updated together.
+    """
+    from .geo import geohash
+    from .geocoding import geocode
+    from .models import Parcel
+
+    by_address = {}
+    for parcel_id, address, tracking_code, sender_id in Parcel.objects.filter(
+        id__in=parcel_ids, destination_latitude__isnull=True
+    ).values_list("id", "recipient_address", "tracking_code", "sender_id"):
+        by_address.setdefault(address, []).append((parcel_id, tracking_code, sender_id))
+
+    pending = []
+    updated = []
+    for address, rows in by_address.items():
+        ids = [parcel_id for parcel_id, _, _ in rows]
+        try:
+            lat, lng = geocode(address)
+        except Exception:
+            pending.extend(str(parcel_id) for parcel_id in ids)
+            continue
+        if lat is not None and lng is not None:
+            now = timezone.now()
+            Parcel.objects.filter(id__in=ids).update(destination_latitude=lat, destination_longitude=lng, updated_at=now)
+            Parcel.objects.filter(id__in=ids, current_latitude__isnull=True).update(
+                current_latitude=lat, current_longitude=lng, geohash=geohash(lat, lng), updated_at=now
+            )
+            updated.extend(rows)
+
+    if updated:
+        from . import tracking, versioning
+        tracking.invalidate([tracking_code for _, tracking_code, _ in updated])
+        versioning.touch_dashboards({sender_id for _, _, sender_id in updated})
+
+    if pending:
+        # Only the addresses that failed transiently are retried
+        raise self.retry(args=[pending], countdown=2 ** self.request.retries * 5)
+
+@shared_task
+def purge_geocode_cache():
+    from .geocoding import purge_expired
+    return purge_expired()
+
+@shared_task
+def flush_location_buffer():
+    from .location_buffer import flush
+    return flush()
+
+@shared_task
+def compact_location_history():
+    from .history import compact
+    return compact()
+
+@shared_task(ignore_result=True)
+def relay_parcel_events():
+    from .outbox import relay
+    return relay()
 
-@shared_task(bind=True, max_retries=3)
-def send_sms_async(self, to, message):
+@shared_task
+def purge_parcel_events():
+    from .outbox import purge
+    return purge()
+
+@shared_task
+def revalidate_tracking_cache(tracking_code):
+    from .tracking import revalidate
+    revalidate(tracking_code)
+
+@shared_task(ignore_result=True)
+def auto_dispatch_parcels():
+    from .dispatch import auto_assign
+    return auto_assign()
+
+@shared_task
+def recount_driver_loads():
+    from .dispatch import recount_active_parcels
+    return recount_active_parcels()
+
+@shared_task(ignore_result=True)
+def plan_driver_route(driver_id):
+    """
+    Re-plans a driver's stop order after their assignments changed, so the
+    route endpoint serves a stored plan.
+    """
+    from django.core.cache import cache
+    from .route_planner import driver_route
+    cache.delete(f"route:scheduled:{driver_id}")
+    driver_route(driver_id, refresh=True)
+
+@shared_task(ignore_result=True)
+def recompute_etas():
+    """
+    Refreshes ETAs for the whole active fleet, so estimates keep moving when
+    a driver stops sending positions. Only estimates that shifted are written.
+    """
+    from django.conf import settings
+    from . import eta, tracking, versioning
+    changed = eta.refresh(min_change=settings.ETA_MIN_CHANGE)
+    if changed:
+        tracking.invalidate([code for code, _, _ in changed])
+        versioning.touch_dashboards({sender for _, sender, _ in changed} | {driver for _, _, driver in changed})
+    return len(changed)
+
+@shared_task(ignore_result=True)
+def roll_up_analytics():
+    """
+    Folds new parcel events into the daily analytics rollups.
+    """
+    from . import analytics
+    return analytics.roll_up()
+
+@shared_task(bind=True, max_retries=5, ignore_result=True)
+def submit_payment(self, attempt_id):
+    """
+    Charges a payment attempt for PAYMENT_ASYNC requests. Gateway outages
+    are retried with the same idempotency key; the webhook (or the
+    gateway's answer here, whichever comes first) settles the attempt.
+    """
+    import stripe
+    from . import payments
+    from .models import PaymentAttempt
+
+    attempt = PaymentAttempt.objects.filter(pk=attempt_id, status="pending").first()
+    if attempt is None:
+        return  # Already settled or handed over to the webhook
     try:
-        send_sms(to, message)
-    except Exception as e:
-        self.retry(exc=e, countdown=5)
\ No newline at end of file
+        payments.submit(attempt)
+    except (payments.PaymentError, payments.PaymentInProgress):
+        return
+    except stripe.error.StripeError as e:
+        raise self.retry(exc=e, countdown=2 ** self.request.retries * 5)
+
+@shared_task(ignore_result=True)
+def process_stripe_events():
+    """
+    Applies received Stripe webhook events; the webhook only stores them.
+    """
+    from . import webhooks
+    return webhooks.process()
+
+@shared_task
+def purge_stripe_events():
+    from .webhooks import purge
+    return purge()
+
+@shared_task(ignore_result=True)
+def archive_parcels():
+    """
+    Moves long-finished parcels out of the hot Parcel table.
+    """
+    from . import archive
+    return archive.archive_parcels()
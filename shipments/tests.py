@@ -1,7 +1,25 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import smtplib
+import time
+from datetime import timedelta
+from unittest import mock
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
-from .models import User, Profile, Parcel, Driver
+from .models import User, Profile, Parcel, ArchivedParcel, ParcelEvent, Driver, GeocodeCache, LocationTrack, StatusDailyRollup, DriverDailyRollup, RevenueDailyRollup, PaymentAttempt, StripeEvent
 from django.urls import reverse
+from django.utils import timezone
+from django.core.cache import cache
+from . import analytics, archive, db_router, dispatch, eta, export, fastpath, geo, geocoding, history, ids, instrumentation, location_buffer, metrics, notifications, outbox, payments, push, route_planner, tracking, webhooks
+from .local_cache import MISSING, LocalCache
+from .pagination import KeysetPagination
+from .serializers import ParcelSerializer
+from .utils import get_redis
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
 
 class ParcelTests(TestCase):
     def setUp(self):
@@ -22,12 +40,14 @@ class ParcelTests(TestCase):
         }, format='json')
         self.assertEqual(response.status_code, 201)
         self.assertEqual(Parcel.objects.count(), 2)
+        self.assertTrue(ids.is_valid_tracking_code(response.data["tracking_code"]))
 
     def test_track_parcel(self):
         response = self.client.get(reverse('track-parcel', kwargs={'tracking_code': 'TEST123'}))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['tracking_code'], 'TEST123')
 
+    @override_settings(PAYMENT_GATEWAY="stub")
     def test_process_payment(self):
         self.client.login(username="testuser", password="testpass")
         response = self.client.post(
@@ -37,4 +57,1185 @@ class ParcelTests(TestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.parcel.refresh_from_db()
-        self.assertEqual(self.parcel.payment_status, "paid")
\ No newline at end of file
+        self.assertEqual(self.parcel.payment_status, "paid")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class GeocodingCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_normalize_address(self):
+        self.assertEqual(geocoding.normalize_address("  12, Main St.\nLagos "), "12 main st lagos")
+        self.assertEqual(geocoding.address_key("12 Main St"), geocoding.address_key("12, MAIN st."))
+
+    @mock.patch("shipments.geocoding.get_coordinates", return_value=(6.5, 3.4))
+    def test_repeated_address_hits_cache(self, get_coordinates):
+        self.assertEqual(geocoding.geocode("12 Main St"), (6.5, 3.4))
+        self.assertEqual(geocoding.geocode("12, MAIN st."), (6.5, 3.4))
+        get_coordinates.assert_called_once()
+        self.assertEqual(GeocodeCache.objects.count(), 1)
+        stats = geocoding.cache_stats()
+        self.assertEqual(stats[geocoding.MISSES], 1)
+        self.assertEqual(stats[geocoding.HITS_REDIS], 1)
+
+
+class BulkParcelTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="merchant", password="testpass", role="customer")
+        self.client.force_authenticate(user=self.user)
+
+    def test_ndjson_upload_reports_each_row(self):
+        body = "\n".join([
+            '{"recipient_name": "Jane", "recipient_address": "456 St", "recipient_phone": "+0987654321", "origin": "A", "destination": "B", "price": "15.00"}',
+            '{"recipient_name": "Bad"}',
+            'not json',
+        ])
+        response = self.client.post(reverse('parcel-bulk-create'), data=body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["created"], 1)
+        self.assertEqual([r["status"] for r in response.data["results"]], ["created", "error", "error"])
+        self.assertTrue(Parcel.objects.filter(tracking_code=response.data["results"][0]["tracking_code"]).exists())
+
+    def test_csv_upload(self):
+        body = (
+            "recipient_name,recipient_address,recipient_phone,origin,destination,price\n"
+            "Jane,456 St,+0987654321,A,B,15.00\n"
+            "John,789 St,+1234567890,A,C,9.50\n"
+        )
+        response = self.client.post(reverse('parcel-bulk-create'), data=body, content_type="text/csv")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Parcel.objects.filter(sender=self.user).count(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, LOCATION_INGEST_MODE="buffered", LOCATION_BUFFER_BACKEND="memory")
+class BufferedLocationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        sender = User.objects.create_user(username="sender", password="testpass", role="customer")
+        self.driver_user = User.objects.create_user(username="driver", password="testpass", role="driver")
+        driver = Driver.objects.create(user=self.driver_user, name="Driver1", email="driver@test.com", phone="+0987654321", license_number="DRV123")
+        self.parcel = Parcel.objects.create(
+            tracking_code="BUF123", sender=sender, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B", assigned_driver=driver, status="assigned"
+        )
+        self.client.force_authenticate(user=self.driver_user)
+        patcher = mock.patch.object(location_buffer, "_memory_buffer", location_buffer.InMemoryLocationBuffer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ping_is_buffered_then_flushed(self):
+        url = reverse('update-location', kwargs={'parcel_id': self.parcel.id})
+        response = self.client.patch(url, {"current_latitude": 6.5, "current_longitude": 3.4}, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.client.patch(url, {"current_latitude": 6.6, "current_longitude": 3.5}, format='json')
+
+        self.parcel.refresh_from_db()
+        self.assertIsNone(self.parcel.current_latitude)
+        response = self.client.get(reverse('track-parcel', kwargs={'tracking_code': 'BUF123'}))
+        self.assertEqual(response.data["current_latitude"], 6.6)
+
+        self.assertEqual(location_buffer.flush(), 2)
+        self.parcel.refresh_from_db()
+        self.assertEqual((self.parcel.current_latitude, self.parcel.current_longitude), (6.6, 3.5))
+
+    @override_settings(LOCATION_BUFFER_BACKEND="redis")
+    def test_unreachable_redis_saves_directly(self):
+        url = reverse('update-location', kwargs={'parcel_id': self.parcel.id})
+        with mock.patch.object(location_buffer, "_redis_buffer", None), mock.patch.object(location_buffer, "_down_until", 0.0), \
+                mock.patch.object(location_buffer, "get_redis", side_effect=ConnectionError("down")) as get_redis:
+            response = self.client.patch(url, {"current_latitude": 6.5, "current_longitude": 3.4}, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.client.patch(url, {"current_latitude": 6.6, "current_longitude": 3.5}, format='json')
+        self.parcel.refresh_from_db()
+        self.assertEqual(self.parcel.current_latitude, 6.6)
+        self.assertEqual(get_redis.call_count, 1)  # The failure is remembered for LOCATION_BUFFER_RETRY_AFTER
+
+    def test_assignment_changes_apply_to_the_next_ping(self):
+        url = reverse('update-location', kwargs={'parcel_id': self.parcel.id})
+        self.assertEqual(self.client.patch(url, {"current_latitude": 6.5, "current_longitude": 3.4}, format='json').status_code, 202)
+        other = User.objects.create_user(username="relief", password="testpass", role="driver")
+        self.parcel.assigned_driver = Driver.objects.create(user=other, name="Relief", email="relief@test.com", phone="+0987654322", license_number="DRV124")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parcel.save()
+        self.assertEqual(self.client.patch(url, {"current_latitude": 6.6, "current_longitude": 3.5}, format='json').status_code, 404)
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.patch(url, {"current_latitude": 6.6, "current_longitude": 3.5}, format='json').status_code, 202)
+        self.parcel.status = "delivered"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parcel.save()
+        self.assertEqual(self.client.patch(url, {"current_latitude": 6.7, "current_longitude": 3.6}, format='json').status_code, 404)
+
+    def test_other_driver_is_rejected(self):
+        other = User.objects.create_user(username="other", password="testpass", role="driver")
+        self.client.force_authenticate(user=other)
+        url = reverse('update-location', kwargs={'parcel_id': self.parcel.id})
+        response = self.client.patch(url, {"current_latitude": 6.5, "current_longitude": 3.4}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, LOCATION_BUFFER_BACKEND="memory")
+class DriverLocationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        sender = User.objects.create_user(username="sender", password="testpass", role="customer")
+        self.driver_user = User.objects.create_user(username="driver", password="testpass", role="driver")
+        driver = Driver.objects.create(user=self.driver_user, name="Driver1", email="driver@test.com", phone="+0987654321", license_number="DRV123")
+        for code, status in [("ACT1", "assigned"), ("ACT2", "in_transit"), ("DONE1", "delivered")]:
+            Parcel.objects.create(
+                tracking_code=code, sender=sender, recipient_name="John", recipient_address="123 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B", assigned_driver=driver, status=status
+            )
+        self.client.force_authenticate(user=self.driver_user)
+        patcher = mock.patch.object(location_buffer, "_memory_buffer", location_buffer.InMemoryLocationBuffer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_position_applies_to_active_parcels_only(self):
+        response = self.client.patch(reverse('driver-update-location'), {"current_latitude": 6.5, "current_longitude": 3.4}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["updated"], 2)
+        self.assertEqual(Parcel.objects.filter(current_latitude=6.5).count(), 2)
+        self.assertIsNone(Parcel.objects.get(tracking_code="DONE1").current_latitude)
+
+    def test_direct_parcel_update_is_pushed(self):
+        parcel = Parcel.objects.get(tracking_code="ACT1")
+        with mock.patch.object(push, "publish_locations") as publish, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                reverse('update-location', kwargs={'parcel_id': parcel.id}), {"current_latitude": 6.5, "current_longitude": 3.4}, format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+        [pings], _ = publish.call_args
+        self.assertEqual((pings[0]["tracking_code"], pings[0]["latitude"]), ("ACT1", 6.5))
+
+    def test_trail_uses_newest_point(self):
+        response = self.client.patch(reverse('driver-update-location'), {"points": [
+            {"current_latitude": 6.7, "current_longitude": 3.7, "timestamp": "2025-01-01T10:00:10Z"},
+            {"current_latitude": 6.6, "current_longitude": 3.6, "timestamp": "2025-01-01T10:00:00Z"},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Parcel.objects.get(tracking_code="ACT1").current_latitude, 6.7)
+
+    def test_trail_is_recorded_in_history(self):
+        self.client.patch(reverse('driver-update-location'), {"points": [
+            {"current_latitude": 6.6, "current_longitude": 3.6, "timestamp": "2025-01-01T10:00:00Z"},
+            {"current_latitude": 6.7, "current_longitude": 3.7, "timestamp": "2025-01-01T10:00:10Z"},
+        ]}, format='json')
+        location_buffer.flush()
+
+        parcel = Parcel.objects.get(tracking_code="ACT1")
+        response = self.client.get(
+            reverse('parcel-location-history', kwargs={'parcel_id': parcel.id}),
+            {"start": "2025-01-01T00:00:00Z", "end": "2025-01-02T00:00:00Z"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([point[1:] for point in response.data["points"]], [(6.6, 3.6), (6.7, 3.7)])
+        # The shared trail is stored once for the driver, not once per parcel
+        self.assertEqual(LocationTrack.objects.get(driver_id=self.driver_user.pk).point_count, 2)
+
+
+class LocationHistoryEncodingTests(TestCase):
+    def test_round_trip(self):
+        points = [(0, 6_500_000, 3_400_000), (5, 6_500_010, 3_399_990), (3600, -1_000_000, 179_999_999)]
+        self.assertEqual(history.decode(history.encode(points)), points)
+
+    def test_append_out_of_order_merges(self):
+        track = LocationTrack(day=None)
+        history.append_points(track, [(10, 1, 1), (20, 2, 2)])
+        history.append_points(track, [(30, 3, 3)])
+        history.append_points(track, [(15, 4, 4)])
+        self.assertEqual(history.decode(track.points), [(10, 1, 1), (15, 4, 4), (20, 2, 2), (30, 3, 3)])
+        self.assertEqual(track.point_count, 4)
+
+    def test_track_created_concurrently_is_appended_to(self):
+        sender = User.objects.create_user(username="racer", password="testpass")
+        parcel = Parcel.objects.create(
+            tracking_code="RACE1", sender=sender, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B"
+        )
+        history.record([location_buffer.make_ping(parcel.pk, "RACE1", {"current_latitude": 6.5, "current_longitude": 3.4}, ts=1_700_000_000)])
+        # As if another writer created the day's track after this one looked for it
+        locked_tracks, calls = history._locked_tracks, []
+
+        def first_lookup_misses(field, keys):
+            calls.append(field)
+            return {} if len(calls) == 1 else locked_tracks(field, keys)
+
+        with mock.patch.object(history, "_locked_tracks", side_effect=first_lookup_misses):
+            history.record([location_buffer.make_ping(parcel.pk, "RACE1", {"current_latitude": 6.6, "current_longitude": 3.5}, ts=1_700_000_010)])
+        self.assertEqual(LocationTrack.objects.get(parcel=parcel).point_count, 2)
+
+    def test_downsample_keeps_one_point_per_bucket(self):
+        points = [(0, 0, 0), (30, 1, 1), (61, 2, 2), (119, 3, 3), (120, 4, 4)]
+        self.assertEqual(history.downsample(points, 60), [(0, 0, 0), (61, 2, 2), (120, 4, 4)])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TrackingCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        tracking.local_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="testuser", password="testpass", role="customer")
+        Profile.objects.create(user=self.user, phone_number="+1234567890")
+        self.parcel = Parcel.objects.create(
+            tracking_code="TRK123", sender=self.user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B"
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_status_change_is_written_through(self):
+        url = reverse('track-parcel', kwargs={'tracking_code': 'TRK123'})
+        self.assertEqual(self.client.get(url).data["status"], "pending")
+        self.parcel.status = "cancelled"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parcel.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data["status"], "cancelled")
+
+    def test_unknown_code_is_negatively_cached(self):
+        url = reverse('track-parcel', kwargs={'tracking_code': 'NOPE'})
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    @override_settings(TRACKING_CACHE_TTL=-1)
+    def test_stale_entry_is_served_while_revalidating(self):
+        tracking.write_through(self.parcel)
+        with mock.patch("shipments.tasks.revalidate_tracking_cache.delay") as delay:
+            self.assertEqual(tracking.get("TRK123")["status"], "pending")
+            self.assertEqual(tracking.get("TRK123")["status"], "pending")
+        delay.assert_called_once_with("TRK123")
+
+
+class LocalCacheTests(TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        local = LocalCache(max_entries=2, ttl=60)
+        local.set("a", 1)
+        local.set("b", 2)
+        local.get("a")
+        local.set("c", 3)
+        self.assertIs(local.get("b"), MISSING)
+        self.assertEqual((local.get("a"), local.get("c")), (1, 3))
+
+    def test_entries_expire(self):
+        local = LocalCache(max_entries=2, ttl=0)
+        local.set("a", 1)
+        self.assertIs(local.get("a"), MISSING)
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_tracking_write_evicts_local_copy(self):
+        user = User.objects.create_user(username="l1user", password="testpass", role="customer")
+        parcel = Parcel.objects.create(
+            tracking_code="L1CODE", sender=user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B"
+        )
+        with mock.patch("shipments.local_cache.get_redis"):
+            tracking.write_through(parcel)
+            self.assertEqual(tracking.get("L1CODE")["status"], "pending")
+            parcel.status = "cancelled"
+            tracking.write_through(parcel)
+            self.assertEqual(tracking.get("L1CODE")["status"], "cancelled")
+
+
+@override_settings(CACHES=LOCMEM_CACHE, TRACKING_L1_ENABLED=False)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="poller", password="testpass", role="customer")
+        Profile.objects.create(user=self.user, phone_number="+1234567890")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parcel = Parcel.objects.create(
+                tracking_code="ETAG1", sender=self.user, recipient_name="John", recipient_address="123 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B"
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def test_track_answers_304_until_parcel_changes(self):
+        url = reverse('track-parcel', kwargs={'tracking_code': 'ETAG1'})
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.parcel.status = "cancelled"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parcel.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_dashboard_304_skips_parcel_query(self):
+        url = reverse('dashboard')
+        etag = self.client.get(url)["ETag"]
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # A different page is a different representation
+        self.assertEqual(self.client.get(url, {"page_size": 5}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Parcel.objects.create(
+                tracking_code="ETAG2", sender=self.user, recipient_name="Jane", recipient_address="456 St",
+                recipient_phone="+1234567890", origin="City A", destination="City C"
+            )
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class PushCoalescerTests(SimpleTestCase):
+    async def test_newer_update_replaces_unsent_one(self):
+        coalescer = push.Coalescer(min_interval=0)
+        coalescer.put("location:TRK", {"lat": 1})
+        coalescer.put("location:TRK", {"lat": 2})
+        coalescer.put("status:TRK", {"status": "in_transit"})
+        self.assertEqual(await coalescer.next_batch(timeout=1), [{"lat": 2}, {"status": "in_transit"}])
+        self.assertEqual(coalescer.dropped, 1)
+        self.assertEqual(await coalescer.next_batch(timeout=0.01), [])
+
+    async def test_driver_positions_are_merged_per_parcel(self):
+        coalescer = push.Coalescer(min_interval=0)
+        first = {"kind": "location", "data": {"parcels": [{"tracking_code": "A", "ts": 1}, {"tracking_code": "B", "ts": 1}]}}
+        second = {"kind": "location", "data": {"parcels": [{"tracking_code": "A", "ts": 2}]}}
+        coalescer.put("location:parcels", first, merge=push.merge_positions)
+        coalescer.put("location:parcels", second, merge=push.merge_positions)
+        [message] = await coalescer.next_batch(timeout=1)
+        self.assertEqual(message["data"]["parcels"], [{"tracking_code": "A", "ts": 2}, {"tracking_code": "B", "ts": 1}])
+        self.assertEqual(coalescer.dropped, 0)
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+    async def test_location_fan_out_reaches_group(self):
+        from channels.layers import get_channel_layer
+        from asgiref.sync import sync_to_async
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(push.tracking_group("TRK1"), channel)
+        ping = location_buffer.make_ping("p1", "TRK1", {"current_latitude": 6.5, "current_longitude": 3.4}, ts=1.0)
+        await sync_to_async(push.publish_locations)([ping])
+        message = await layer.receive(channel)
+        self.assertEqual((message["kind"], message["data"]["current_latitude"]), ("location", 6.5))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class DashboardCursorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="pager", password="testpass", role="customer")
+        for i in range(5):
+            Parcel.objects.create(
+                tracking_code=f"PAGE{i}", sender=self.user, recipient_name="John", recipient_address="123 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B"
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def test_cursor_pages_cover_every_parcel_once(self):
+        seen = []
+        response = self.client.get(reverse('dashboard'), {"pagination": "cursor", "page_size": 2})
+        while True:
+            self.assertNotIn("count", response.data)
+            seen.extend(row["tracking_code"] for row in response.data["results"])
+            if not response.data["next"]:
+                break
+            response = self.client.get(response.data["next"])
+        self.assertEqual(sorted(seen), [f"PAGE{i}" for i in range(5)])
+        self.assertEqual(len(seen), 5)
+
+    def test_customer_rows_hide_recipient_details(self):
+        response = self.client.get(reverse('dashboard'), {"pagination": "cursor"})
+        self.assertIsNone(response.data["results"][0]["recipient_phone"])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse('dashboard'), {"cursor": "garbage"}).status_code, 404)
+        cursor = KeysetPagination().encode_cursor(timezone.now(), "not-a-uuid")
+        self.assertEqual(self.client.get(reverse('dashboard'), {"cursor": cursor}).status_code, 404)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHE, NOTIFY_BACKEND="fake", NOTIFY_QUEUE_BACKEND="memory",
+    NOTIFY_BATCH_WINDOW=3600, NOTIFY_BATCH_SIZE=2,
+)
+class NotificationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        notifications.FakeBackend.outbox.clear()
+        self.queue = notifications.InMemoryQueue()
+        patcher = mock.patch.object(notifications, "_memory_queue", self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_identical_messages_are_sent_once(self):
+        self.assertEqual(notifications.notify_sms("+1234567890", "Parcel X is now assigned."), 1)
+        self.assertEqual(notifications.notify_sms("+1234567890", "Parcel X is now assigned."), 0)
+        notifications.notify_sms("+1234567891", "Parcel X is now assigned.")
+        self.assertEqual(notifications.flush(notifications.SMS), 2)
+        self.assertEqual(notifications.stats()["notify.sms.deduplicated"], 1)
+
+    def test_failed_push_does_not_dedupe_the_retry(self):
+        with mock.patch.object(self.queue, "push", side_effect=ConnectionError("redis down")):
+            with self.assertRaises(ConnectionError):
+                notifications.notify_sms("+1234567890", "Parcel X is now assigned.")
+        self.assertEqual(notifications.notify_sms("+1234567890", "Parcel X is now assigned."), 1)
+        self.assertEqual(notifications.flush(notifications.SMS), 1)
+        self.assertEqual(len(notifications.FakeBackend.outbox), 1)
+
+    def test_flush_sends_in_batches(self):
+        backend = mock.Mock(send_emails=mock.Mock(side_effect=lambda batch: [True] * len(batch)))
+        for i in range(5):
+            notifications.notify_email("Parcel Update", f"Parcel {i}", [f"user{i}@example.com"])
+        self.assertEqual(notifications.flush(notifications.EMAIL, backend=backend), 5)
+        self.assertEqual([len(call.args[0]) for call in backend.send_emails.call_args_list], [2, 2, 1])
+
+    @override_settings(NOTIFY_MAX_ATTEMPTS=2)
+    def test_failed_messages_are_retried_then_dropped(self):
+        backend = mock.Mock(send_sms=mock.Mock(return_value=[False]))
+        notifications.notify_sms("+1234567890", "Parcel X is now assigned.")
+        notifications.flush(notifications.SMS, backend=backend)
+        self.assertEqual(len(self.queue), 1)
+        notifications.flush(notifications.SMS, backend=backend)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(notifications.stats()["notify.sms.failed"], 1)
+
+    def test_email_failures_are_per_message(self):
+        def send_messages(emails):
+            if emails[0].to == ["bad@example.com"]:
+                raise smtplib.SMTPRecipientsRefused({"bad@example.com": (550, b"No such user")})
+            return 1
+
+        connection = mock.Mock(send_messages=mock.Mock(side_effect=send_messages))
+        messages = [{"to": [to], "subject": "Parcel Update", "body": "Hi"} for to in ("a@example.com", "bad@example.com", "b@example.com")]
+        with mock.patch.object(notifications.LiveBackend, "_smtp", connection):
+            self.assertEqual(notifications.LiveBackend().send_emails(messages), [True, False, True])
+        connection.close.assert_not_called()
+
+    def test_unacked_redis_batch_is_requeued(self):
+        queue = notifications.RedisQueue(get_redis())
+        queue.client.delete(queue._key("test"), queue._leases_key("test"))
+        queue.push("test", [{"n": 1}, {"n": 2}, {"n": 3}])
+        with override_settings(NOTIFY_ACK_TIMEOUT=-1):  # The worker "dies" holding the batch
+            batch, _ = queue.pop_batch("test", 2)
+        self.assertEqual((batch, queue.length("test")), ([{"n": 1}, {"n": 2}], 1))
+        self.assertEqual(queue.requeue_expired("test"), 2)
+        batch, token = queue.pop_batch("test", 3)
+        self.assertEqual(batch, [{"n": 1}, {"n": 2}, {"n": 3}])
+        queue.ack("test", token, retry=[{"n": 3}])
+        self.assertEqual((queue.length("test"), queue.requeue_expired("test")), (1, 0))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, NOTIFY_BACKEND="fake", NOTIFY_QUEUE_BACKEND="memory", NOTIFY_BATCH_WINDOW=3600)
+class OutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.queue = notifications.InMemoryQueue()
+        for patcher in (
+            mock.patch.object(notifications, "_memory_queue", self.queue),
+            mock.patch.object(push, "publish_parcel"),
+            mock.patch.object(route_planner, "schedule"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username="shipper", password="testpass", email="shipper@test.com")
+        Profile.objects.create(user=self.user, phone_number="+1234567890")
+        self.driver = Driver.objects.create(user=User.objects.create_user(username="courier", password="testpass", role="driver"), name="Courier", email="courier@test.com", phone="+1987654321", license_number="DRV900")
+        self.parcel = Parcel.objects.create(
+            tracking_code="OUTBOX1", sender=self.user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567899", origin="City A", destination="City B"
+        )
+
+    def test_changes_are_recorded_as_events(self):
+        self.parcel.assigned_driver = self.driver
+        self.parcel.status = "assigned"
+        self.parcel.save()
+        self.parcel.payment_status = "paid"
+        self.parcel.save()
+        kinds = list(ParcelEvent.objects.order_by("id").values_list("kind", flat=True))
+        self.assertEqual(kinds, ["created", "driver_assigned", "payment_updated"])
+
+    def test_rolled_back_changes_leave_no_events(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.parcel.status = "in_transit"
+                self.parcel.save()
+                raise RuntimeError
+        self.assertFalse(ParcelEvent.objects.filter(kind="status_changed").exists())
+
+    def test_relay_delivers_and_marks_events(self):
+        self.parcel.status = "in_transit"
+        self.parcel.save()
+        self.assertEqual(outbox.relay(), 2)
+        self.assertFalse(ParcelEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertEqual(len(self.queue), 3)  # Sender SMS and email, recipient SMS
+        push.publish_parcel.assert_called_once()
+
+    def test_failed_event_holds_back_later_events_of_its_parcel(self):
+        self.parcel.status = "in_transit"
+        self.parcel.save()
+        self.parcel.status = "delivered"
+        self.parcel.save()
+        with mock.patch.object(outbox, "_notify", side_effect=[None, ConnectionError("redis down")]):
+            self.assertEqual(outbox.relay(), 1)  # Only "created"
+        pending = ParcelEvent.objects.filter(processed_at__isnull=True).order_by("id")
+        self.assertEqual([event.attempts for event in pending], [1, 0])
+        self.assertEqual(outbox.relay(), 2)
+
+
+class DispatchPlanTests(SimpleTestCase):
+    def test_nearest_driver_wins_within_capacity(self):
+        parcels = [("p1", 6.50, 3.40), ("p2", 6.50, 3.412), ("p3", 6.60, 3.50)]
+        drivers = [("near", 6.50, 3.405, 3), ("far", 6.60, 3.49, 0)]
+        assignments = dispatch.plan(parcels, drivers, capacity=4, max_km=50, candidates=2)
+        self.assertEqual(assignments["p1"][0], "near")
+        self.assertEqual(assignments["p2"][0], "far")  # "near" only had room for one more
+        self.assertEqual(assignments["p3"][0], "far")
+
+    def test_drivers_out_of_range_are_ignored(self):
+        assignments = dispatch.plan([("p1", 6.5, 3.4)], [("d1", 9.0, 7.0, 0)], capacity=5, max_km=25, candidates=3)
+        self.assertEqual(assignments, {})
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class DispatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user(username="depot", password="testpass")
+        self.driver = Driver.objects.create(
+            user=User.objects.create_user(username="rider", password="testpass", role="driver"),
+            name="Rider", email="rider@test.com", phone="+1987654322", license_number="DRV901",
+            last_latitude=6.5, last_longitude=3.4, last_seen_at=timezone.now(),
+        )
+
+    def _parcel(self, code, **fields):
+        return Parcel.objects.create(
+            tracking_code=code, sender=self.sender, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B",
+            current_latitude=6.51, current_longitude=3.41, **fields
+        )
+
+    def test_active_counter_follows_assignment_and_delivery(self):
+        parcel = self._parcel("LOAD1")
+        parcel.assigned_driver = self.driver
+        parcel.status = "assigned"
+        parcel.save()
+        self.driver.refresh_from_db()
+        self.assertEqual(self.driver.active_parcels, 1)
+        parcel.status = "delivered"
+        parcel.save()
+        self.driver.refresh_from_db()
+        self.assertEqual(self.driver.active_parcels, 0)
+
+    def test_auto_assign_fills_up_to_capacity(self):
+        for i in range(Driver.MAX_ACTIVE_PARCELS + 2):
+            self._parcel(f"AUTO{i}")
+        with self.captureOnCommitCallbacks(execute=True):
+            summary = dispatch.auto_assign()
+        self.assertEqual(summary["assigned"], Driver.MAX_ACTIVE_PARCELS)
+        self.driver.refresh_from_db()
+        self.assertEqual(self.driver.active_parcels, Driver.MAX_ACTIVE_PARCELS)
+        self.assertEqual(Parcel.objects.filter(status="pending").count(), 2)
+        self.assertEqual(ParcelEvent.objects.filter(kind="driver_assigned").count(), Driver.MAX_ACTIVE_PARCELS)
+        # The oldest parcels go first
+        self.assertFalse(Parcel.objects.filter(tracking_code="AUTO0", status="pending").exists())
+
+
+class GeohashTests(SimpleTestCase):
+    def test_known_value(self):
+        self.assertEqual(geo.geohash(57.64911, 10.40744, 11), "u4pruydqqvj")
+
+    def test_covering_prefixes_contain_points_in_radius(self):
+        box = geo.bounding_box(6.5, 3.4, 5)
+        prefixes = geo.covering_prefixes(*box)
+        inside = geo.geohash(6.53, 3.42)
+        self.assertTrue(any(inside.startswith(prefix) for prefix in prefixes))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class NearbyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin = User.objects.create_user(username="ops", password="testpass", role="admin")
+        self.client.force_authenticate(user=self.admin)
+        for code, lat, lng in [("NEAR1", 6.501, 3.401), ("NEAR2", 6.52, 3.42), ("FAR1", 7.5, 4.5)]:
+            Parcel.objects.create(
+                tracking_code=code, sender=self.admin, recipient_name="John", recipient_address="123 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B",
+                current_latitude=lat, current_longitude=lng,
+            )
+
+    def test_geohash_follows_coordinates(self):
+        parcel = Parcel.objects.get(tracking_code="NEAR1")
+        self.assertEqual(parcel.geohash, geo.geohash(6.501, 3.401))
+        parcel.current_latitude, parcel.current_longitude = 7.0, 4.0
+        parcel.save(update_fields=["current_latitude", "current_longitude"])
+        parcel.refresh_from_db()
+        self.assertEqual(parcel.geohash, geo.geohash(7.0, 4.0))
+
+    def test_nearby_parcels_closest_first(self):
+        response = self.client.get(reverse('nearby-parcels'), {"lat": 6.5, "lng": 3.4, "radius_km": 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["tracking_code"] for row in response.data["results"]], ["NEAR1", "NEAR2"])
+
+    def test_radius_is_bounded(self):
+        response = self.client.get(reverse('nearby-parcels'), {"lat": 6.5, "lng": 3.4, "radius_km": 5000})
+        self.assertEqual(response.status_code, 400)
+
+
+class RoutePlannerTests(SimpleTestCase):
+    def test_two_opt_untangles_crossing_path(self):
+        points = [(0, 0), (0, 0.01), (0.01, 0), (0.01, 0.01)]
+        matrix = route_planner.distance_matrix(points)
+        crossed = [0, 3, 1, 2]
+        improved = route_planner.two_opt(crossed, matrix)
+        self.assertEqual(improved[0], 0)
+        self.assertLess(route_planner.path_length(improved, matrix), route_planner.path_length(crossed, matrix))
+
+    def test_plan_visits_every_stop_once(self):
+        stops = [(6.5 + i * 0.003, 3.4 + (i % 5) * 0.004) for i in range(40)]
+        order, distance = route_planner.plan((6.49, 3.39), stops, time_limit=1)
+        self.assertEqual(sorted(order), list(range(40)))
+        self.assertGreater(distance, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class DriverRouteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        user = User.objects.create_user(username="router", password="testpass", role="driver")
+        self.driver = Driver.objects.create(
+            user=user, name="Router", email="router@test.com", phone="+1987654323", license_number="DRV902",
+            last_latitude=6.50, last_longitude=3.40,
+        )
+        for code, lat in [("STOP3", 6.53), ("STOP1", 6.51), ("STOP2", 6.52), ("NOGEO", None)]:
+            Parcel.objects.create(
+                tracking_code=code, sender=user, recipient_name="John", recipient_address="123 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B",
+                assigned_driver=self.driver, status="assigned",
+                destination_latitude=lat, destination_longitude=3.40 if lat else None,
+            )
+        self.client.force_authenticate(user=user)
+
+    def test_route_orders_stops_from_driver_position(self):
+        response = self.client.get(reverse('driver-route', kwargs={'driver_id': self.driver.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([stop["tracking_code"] for stop in response.data["stops"]], ["STOP1", "STOP2", "STOP3"])
+        self.assertEqual(response.data["unrouted"], ["NOGEO"])
+
+    def test_plan_is_reused_until_stops_change(self):
+        first = route_planner.driver_route(self.driver.pk)
+        self.assertEqual(route_planner.driver_route(self.driver.pk)["computed_at"], first["computed_at"])
+        Parcel.objects.filter(tracking_code="STOP2").update(status="delivered")
+        self.assertEqual(len(route_planner.driver_route(self.driver.pk)["stops"]), 2)
+
+    def test_other_drivers_cannot_read_route(self):
+        self.client.force_authenticate(user=User.objects.create_user(username="nosy", password="testpass", role="driver"))
+        response = self.client.get(reverse('driver-route', kwargs={'driver_id': self.driver.pk}))
+        self.assertEqual(response.status_code, 403)
+
+
+class ETAEstimateTests(SimpleTestCase):
+    def test_speed_is_smoothed_from_consecutive_positions(self):
+        previous = {"lat": 6.5, "lng": 3.4, "ts": 0, "speed": None}
+        one_km_north = 6.5 + 1 / geo.KM_PER_DEGREE
+        self.assertAlmostEqual(eta.update_speed(previous, one_km_north, 3.4, 60), 60, delta=0.5)
+        with override_settings(ETA_SPEED_ALPHA=0.5):
+            smoothed = eta.update_speed(dict(previous, speed=20), one_km_north, 3.4, 60)
+        self.assertAlmostEqual(smoothed, 40, delta=0.5)
+
+    def test_route_order_accumulates_distance_and_stops(self):
+        now = timezone.now()
+        destinations = {"a": (6.51, 3.4), "b": (6.52, 3.4)}
+        route = {"stops": [{"parcel_id": "b"}, {"parcel_id": "a"}]}
+        etas = eta.estimate((6.50, 3.4), destinations, 30, route=route, now=now)
+        self.assertLess(etas["b"], etas["a"])  # "b" is first on the route even though "a" is closer
+        direct = eta.estimate((6.50, 3.4), destinations, 30, now=now)
+        self.assertLess(direct["a"], direct["b"])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, TRACKING_L1_ENABLED=False)
+class ETARefreshTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="eta", password="testpass", role="driver")
+        self.driver = Driver.objects.create(
+            user=user, name="Eta", email="eta@test.com", phone="+1987654324", license_number="DRV903",
+            last_latitude=6.50, last_longitude=3.40, speed_kmh=30,
+        )
+        self.parcel = Parcel.objects.create(
+            tracking_code="ETA1", sender=user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B",
+            assigned_driver=self.driver, status="in_transit", destination_latitude=6.60, destination_longitude=3.40,
+        )
+
+    def test_refresh_stores_estimate_served_by_tracking(self):
+        self.assertEqual(eta.refresh([self.parcel.id]), [("ETA1", self.parcel.sender_id, self.driver.pk)])
+        self.parcel.refresh_from_db()
+        minutes = (self.parcel.estimated_arrival - timezone.now()).total_seconds() / 60
+        # ~11.1km straight line x road factor at 30 km/h
+        self.assertAlmostEqual(minutes, 11.1 * 1.3 * 2, delta=2)
+        self.assertEqual(tracking.build_payload(self.parcel)["estimated_arrival"], self.parcel.estimated_arrival.isoformat())
+
+    def test_small_changes_are_not_rewritten(self):
+        eta.refresh([self.parcel.id])
+        self.assertEqual(eta.refresh([self.parcel.id], min_change=60), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, ANALYTICS_SETTLE_SECONDS=0)
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username="analyst", password="testpass", role="admin")
+        self.user = User.objects.create_user(username="seller", password="testpass")
+        self.driver = Driver.objects.create(
+            user=User.objects.create_user(username="hauler", password="testpass", role="driver"),
+            name="Hauler", email="hauler@test.com", phone="+1987654325", license_number="DRV904",
+        )
+        self.parcel = Parcel.objects.create(
+            tracking_code="STATS1", sender=self.user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B", price="25.00",
+        )
+        self.today = timezone.localdate()
+
+    def deliver(self):
+        self.parcel.assigned_driver = self.driver
+        self.parcel.status = "assigned"
+        self.parcel.save()
+        self.parcel.status = "delivered"
+        self.parcel.payment_status = "paid"
+        self.parcel.save()
+
+    def test_events_are_rolled_up_once(self):
+        self.deliver()
+        self.assertEqual(analytics.roll_up(), 4)
+        self.assertEqual(analytics.roll_up(), 0)
+        statuses = {row.status: (row.entered, row.left) for row in StatusDailyRollup.objects.filter(day=self.today)}
+        self.assertEqual(statuses, {"pending": (1, 1), "assigned": (1, 1), "delivered": (1, 0)})
+        driver = DriverDailyRollup.objects.get(driver=self.driver, day=self.today)
+        self.assertEqual((driver.assigned, driver.delivered), (1, 1))
+        paid = RevenueDailyRollup.objects.get(day=self.today, payment_status="paid")
+        self.assertEqual((paid.parcels, str(paid.amount)), (1, "25.00"))
+        self.assertEqual(analytics.status_report(self.today, self.today)["current"], {"pending": 0, "assigned": 0, "delivered": 1})
+
+    def test_rebuild_matches_current_state(self):
+        self.deliver()
+        analytics.rebuild()
+        self.assertEqual(analytics.roll_up(), 0)  # Existing events are already reflected
+        self.assertEqual(analytics.status_report(self.today, self.today)["current"], {"pending": 0, "delivered": 1})
+        self.assertEqual(DriverDailyRollup.objects.get(driver=self.driver).delivered, 1)
+
+    def test_reports_are_admin_only_and_validate_range(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get(reverse("analytics-revenue")).status_code, 403)
+        client.force_authenticate(self.admin)
+        self.assertEqual(client.get(reverse("analytics-statuses"), {"from": "2025-02-01", "to": "2025-01-01"}).status_code, 400)
+        analytics.roll_up()
+        response = client.get(reverse("analytics-revenue"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["totals"]["pending"]["parcels"], 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(username="finance", password="testpass", role="admin")
+        self.user = User.objects.create_user(username="exporter", password="testpass")
+        for code, status in (("EXP1", "pending"), ("EXP2", "delivered"), ("EXP3", "delivered")):
+            Parcel.objects.create(
+                tracking_code=code, sender=self.user, recipient_name="Jane, Doe", recipient_address="1 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B", status=status, price="12.50",
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def download(self, **params):
+        response = self.client.get(reverse("export-parcels"), params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_csv_streams_filtered_rows_in_chunks(self):
+        chunks = list(export.stream(export.parcels(), "csv", chunk_size=2))
+        self.assertEqual(len(chunks), 2)
+        lines = self.download(status="delivered").splitlines()
+        self.assertEqual(lines[0].split(","), export.HEADER)
+        self.assertEqual(len(lines), 3)
+        self.assertIn('"Jane, Doe"', lines[1])
+
+    def test_ndjson_rows_are_json_objects(self):
+        rows = [json.loads(line) for line in self.download(output="ndjson").splitlines()]
+        self.assertEqual([row["tracking_code"] for row in rows], ["EXP1", "EXP2", "EXP3"])
+        self.assertEqual(rows[0]["price"], "12.50")
+
+    def test_rejects_bad_parameters_and_non_admins(self):
+        self.assertEqual(self.client.get(reverse("export-parcels"), {"output": "xlsx"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("export-parcels"), {"from": "yesterday"}).status_code, 400)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(reverse("export-parcels")).status_code, 403)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, ARCHIVE_AFTER_DAYS=30)
+class ArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        tracking.local_cache.clear()
+        self.user = User.objects.create_user(username="archivist", password="testpass")
+        for code, status in (("ARC1", "delivered"), ("ARC2", "in_transit"), ("ARC3", "cancelled")):
+            Parcel.objects.create(
+                tracking_code=code, sender=self.user, recipient_name="John", recipient_address="123 St",
+                recipient_phone="+1234567890", origin="City A", destination="City B", status=status, price="20.00",
+            )
+        # ARC1 and ARC2 finished/moved 40 days ago; ARC3 was cancelled recently
+        Parcel.objects.filter(tracking_code__in=["ARC1", "ARC2"]).update(updated_at=timezone.now() - timedelta(days=40))
+        self.parcel = Parcel.objects.get(tracking_code="ARC1")
+        self.attempt = PaymentAttempt.objects.create(
+            parcel=self.parcel, number=1, idempotency_key="arc-1", amount=2000, payment_method="pm_card_visa",
+            status="succeeded", intent_id="pi_arc",
+        )
+
+    def test_only_old_terminal_parcels_are_moved(self):
+        self.assertEqual(archive.archive_parcels(batch_size=1), 1)
+        self.assertEqual(sorted(Parcel.objects.values_list("tracking_code", flat=True)), ["ARC2", "ARC3"])
+        archived = ArchivedParcel.objects.get(pk=self.parcel.pk)
+        self.assertEqual((archived.tracking_code, archived.status, archived.updated_at), ("ARC1", "delivered", self.parcel.updated_at))
+        self.assertTrue(PaymentAttempt.objects.filter(pk=self.attempt.pk, parcel_id=self.parcel.pk).exists())
+
+    def test_tracking_and_exports_fall_back_to_the_archive(self):
+        archive.archive_parcels()
+        cache.clear()
+        self.assertEqual(tracking.get("ARC1")["status"], "delivered")
+        codes = [row[1] for row in export.parcels()]
+        self.assertEqual(sorted(codes), ["ARC1", "ARC2", "ARC3"])
+        self.assertNotIn("ARC1", [row[1] for row in export.parcels(archived=False)])
+
+    def test_archived_parcel_can_still_be_refunded(self):
+        archive.archive_parcels()
+        self.assertTrue(payments.refund("pi_arc", 2000, True))
+        self.assertEqual(ArchivedParcel.objects.get(pk=self.parcel.pk).payment_status, "refunded")
+
+    def test_rebuild_counts_archived_parcels(self):
+        archive.archive_parcels()
+        analytics.rebuild()
+        day = timezone.localdate(self.parcel.updated_at)
+        self.assertEqual(StatusDailyRollup.objects.get(day=day, status="delivered").entered, 1)
+        self.assertEqual(sum(StatusDailyRollup.objects.filter(status="pending").values_list("entered", flat=True)), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class IdGenerationTests(SimpleTestCase):
+    def test_uuid7_blocks_are_increasing_version_7(self):
+        parcel_ids = ids.uuid7s(5000)
+        self.assertEqual(parcel_ids, sorted(parcel_ids))
+        self.assertEqual(len(set(parcel_ids)), 5000)
+        self.assertEqual({parcel_id.version for parcel_id in parcel_ids}, {7})
+
+    def test_tracking_codes_are_unique_sorted_and_checked(self):
+        # More than one second's sequence, so the block borrows ahead
+        codes = ids.tracking_codes(5000)
+        self.assertEqual(codes, sorted(codes))
+        self.assertEqual(len(set(codes)), 5000)
+        self.assertEqual({len(code) for code in codes}, {ids.CODE_LENGTH})
+        self.assertTrue(all(ids.is_valid_tracking_code(code) for code in codes))
+        self.assertLess(codes[0], ids.tracking_code())
+
+    def test_check_character_catches_typos(self):
+        code = ids.tracking_code()
+        for index in range(len(code)):
+            typo = code[:index] + ("1" if code[index] != "1" else "2") + code[index + 1:]
+            self.assertFalse(ids.is_valid_tracking_code(typo))
+        self.assertEqual(ids.normalize_tracking_code("-".join([code[:6], code[6:]]).lower().replace("0", "o")), code)
+        self.assertEqual(ids.normalize_tracking_code("TRK123"), "TRK123")  # Older codes pass through
+
+
+@override_settings(CACHES=LOCMEM_CACHE, PAYMENT_GATEWAY="stub", PAYMENT_ASYNC=False)
+class PaymentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        payments.StubGateway.intents.clear()
+        self.user = User.objects.create_user(username="payer", password="testpass")
+        self.parcel = Parcel.objects.create(
+            tracking_code="PAY1", sender=self.user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B", price="19.99",
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("process-payment", kwargs={"parcel_id": self.parcel.id})
+
+    def test_resubmitting_an_attempt_charges_once(self):
+        attempt = payments.begin(self.parcel.pk, "pm_card_visa")
+        self.assertEqual(attempt.idempotency_key, f"parcel-{self.parcel.pk}-attempt-1")
+        self.assertEqual(attempt.amount, 1999)
+        self.assertEqual(payments.begin(self.parcel.pk, "pm_card_visa"), attempt)  # Double submit shares it
+        payments.submit(attempt)
+        payments.submit(attempt)  # e.g. a retry after a lost response
+        self.assertEqual(len(payments.StubGateway.intents), 1)
+        self.parcel.refresh_from_db()
+        self.assertEqual(self.parcel.payment_status, "paid")
+        self.assertEqual(self.client.post(self.url, {"payment_method_id": "pm_card_visa"}, format="json").status_code, 400)
+
+    def test_declined_attempt_allows_a_new_one(self):
+        response = self.client.post(self.url, {"payment_method_id": payments.STUB_DECLINED_METHOD}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url, {"payment_method_id": "pm_card_visa"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["attempt"], 2)
+        self.assertEqual(list(PaymentAttempt.objects.order_by("number").values_list("status", flat=True)), ["failed", "succeeded"])
+
+    @override_settings(PAYMENT_ASYNC=True)
+    def test_async_mode_answers_before_charging(self):
+        with mock.patch("shipments.views.submit_payment.delay") as delay:
+            response = self.client.post(self.url, {"payment_method_id": "pm_card_visa"}, format="json")
+        self.assertEqual(response.status_code, 202)
+        attempt = PaymentAttempt.objects.get()
+        delay.assert_called_once_with(attempt.pk)
+        self.assertEqual(self.client.get(reverse("payment-status", kwargs={"parcel_id": self.parcel.id})).data["latest_attempt"]["status"], "pending")
+
+        # The webhook settles it and a late duplicate changes nothing
+        intent = {"id": "pi_async", "status": "succeeded", "metadata": {"attempt": str(attempt.pk)}}
+        self.assertTrue(payments.handle_intent_event(intent))
+        self.assertTrue(payments.handle_intent_event(intent))
+        attempt.refresh_from_db()
+        self.assertEqual((attempt.status, attempt.intent_id), ("succeeded", "pi_async"))
+        self.assertEqual(ParcelEvent.objects.filter(kind="payment_updated").count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, STRIPE_WEBHOOK_SECRET="whsec_test")
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="refundee", password="testpass")
+        self.parcel = Parcel.objects.create(
+            tracking_code="HOOK1", sender=self.user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B", price="10.00",
+        )
+        self.attempt = payments.begin(self.parcel.pk, "pm_card_visa")
+        self.client = APIClient()
+        self.created = int(time.time())
+
+    def post(self, event_id, event_type, obj, created=None):
+        payload = json.dumps({
+            "id": event_id, "type": event_type, "created": created or self.created, "data": {"object": obj},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(b"whsec_test", f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse("stripe-webhook"), payload, content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}",
+        )
+
+    def intent(self, status, error=None):
+        return {
+            "id": "pi_hook", "object": "payment_intent", "status": status,
+            "metadata": {"tracking_code": "HOOK1", "attempt": str(self.attempt.pk)},
+            "last_payment_error": {"message": error} if error else None,
+        }
+
+    def test_retried_deliveries_are_stored_once(self):
+        for _ in range(3):
+            self.assertEqual(self.post("evt_1", "payment_intent.succeeded", self.intent("succeeded")).status_code, 200)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+        self.parcel.refresh_from_db()
+        self.assertEqual(self.parcel.payment_status, "pending")  # Applied by the worker, not the request
+        self.assertEqual(webhooks.process(), 1)
+        self.parcel.refresh_from_db()
+        self.assertEqual(self.parcel.payment_status, "paid")
+        self.assertEqual(webhooks.process(), 0)
+
+    def test_refund_wins_over_a_late_success(self):
+        charge = {
+            "id": "ch_hook", "object": "charge", "payment_intent": "pi_hook", "amount_refunded": 1000,
+            "refunded": True, "metadata": {"tracking_code": "HOOK1", "attempt": str(self.attempt.pk)},
+        }
+        self.post("evt_refund", "charge.refunded", charge, created=self.created - 10)
+        self.post("evt_paid", "payment_intent.succeeded", self.intent("succeeded"))
+        self.assertEqual(webhooks.process(), 2)
+        self.parcel.refresh_from_db()
+        self.attempt.refresh_from_db()
+        self.assertEqual(self.parcel.payment_status, "refunded")
+        self.assertEqual((self.attempt.status, self.attempt.refunded_amount), ("refunded", 1000))
+
+    def test_failed_payment_lets_the_sender_retry(self):
+        self.post("evt_failed", "payment_intent.payment_failed", self.intent("requires_payment_method", "Insufficient funds"))
+        self.post("evt_ignored", "customer.created", {"id": "cus_1"})
+        webhooks.process()
+        self.parcel.refresh_from_db()
+        self.attempt.refresh_from_db()
+        self.assertEqual(self.parcel.payment_status, "failed")
+        self.assertEqual((self.attempt.status, self.attempt.error), ("failed", "Insufficient funds"))
+        self.assertEqual(payments.begin(self.parcel.pk, "pm_card_visa").number, 2)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class FastPathTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="lister", password="testpass", role="customer")
+        self.driver = Driver.objects.create(
+            user=User.objects.create_user(username="lister-driver", password="testpass", role="driver"),
+            name="Lister", email="lister@test.com", phone="+1987654326", license_number="DRV905",
+        )
+        self.parcel = Parcel.objects.create(
+            tracking_code="FAST1", sender=self.user, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B", price="42.50",
+            assigned_driver=self.driver, status="assigned", current_latitude=6.5, current_longitude=3.4,
+        )
+
+    def test_projection_renders_like_the_serializer(self):
+        parcel = Parcel.objects.get(pk=self.parcel.pk)
+        expected = json.loads(JSONRenderer().render(ParcelSerializer([parcel], many=True).data))
+        rows = fastpath.PARCEL_LIST.values(Parcel.objects.filter(pk=parcel.pk))
+        self.assertEqual(json.loads(fastpath.FastJSONRenderer().render(fastpath.PARCEL_LIST.project(rows))), expected)
+        with mock.patch.object(fastpath, "orjson", None):
+            self.assertEqual(json.loads(fastpath.FastJSONRenderer().render(fastpath.PARCEL_LIST.project(rows))), expected)
+
+    def test_list_and_dashboard_use_role_projections(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        listed = client.get(reverse("parcel-list-create")).json()["results"]
+        self.assertEqual(listed[0]["price"], "42.50")
+        self.assertEqual(listed[0]["assigned_driver"], self.driver.pk)
+
+        row = client.get(reverse("dashboard")).json()["results"][0]
+        self.assertIsNone(row["recipient_address"])  # Customers don't see recipients' details
+        self.assertEqual(row["assigned_driver"], "Lister")
+        client.force_authenticate(self.driver.user)
+        row = client.get(reverse("dashboard")).json()["results"][0]
+        self.assertEqual(row["recipient_address"], "123 St")
+
+
+@override_settings(CACHES=LOCMEM_CACHE, DATABASE_REPLICAS=["replica1"])
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = db_router.PrimaryReplicaRouter()
+        self.user = mock.Mock(is_authenticated=True, pk=7)
+        patcher = mock.patch.object(db_router, "_usable", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_opted_in_reads_go_to_a_replica(self):
+        tokens = db_router.start_request()
+        self.assertEqual(self.router.db_for_read(Parcel), "default")
+        with db_router.replica_reads(self.user):
+            self.assertEqual(self.router.db_for_read(Parcel), "replica1")
+            self.assertEqual(self.router.db_for_write(Parcel), "default")
+            self.assertEqual(self.router.db_for_read(Parcel), "default")  # Reads after a write see it
+        self.assertTrue(db_router.end_request(tokens))
+
+    @override_settings(DATABASE_REPLICAS=["replica1", "replica2", "replica3"])
+    def test_block_reads_stay_on_one_replica(self):
+        tokens = db_router.start_request()
+        with mock.patch.object(db_router, "replica_alias", wraps=db_router.replica_alias) as replica_alias:
+            with db_router.replica_reads(self.user):
+                aliases = {self.router.db_for_read(Parcel) for _ in range(20)}
+        self.assertEqual(len(aliases), 1)
+        self.assertEqual(replica_alias.call_count, 1)
+        db_router.end_request(tokens)
+
+    def test_pinned_user_reads_from_the_primary(self):
+        self.assertEqual(db_router.read_alias(self.user), "replica1")
+        db_router.pin(self.user.pk)
+        self.assertEqual(db_router.read_alias(self.user), "default")
+        tokens = db_router.start_request()
+        with db_router.replica_reads(self.user):
+            self.assertEqual(self.router.db_for_read(Parcel), "default")
+        db_router.end_request(tokens)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, DATABASE_REPLICAS=["replica1"])
+class ReadYourWritesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.customer = User.objects.create_user(username="reader", password="testpass", role="customer")
+        self.driver_user = User.objects.create_user(username="writer", password="testpass", role="driver")
+        driver = Driver.objects.create(user=self.driver_user, name="Writer", email="writer@test.com", phone="+1987654327", license_number="DRV906")
+        Parcel.objects.create(
+            tracking_code="RYW1", sender=self.customer, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B", assigned_driver=driver, status="assigned"
+        )
+        # replica1 isn't a real connection; reads inside the test transaction use the primary anyway
+        for patcher in (
+            mock.patch.object(location_buffer, "_memory_buffer", location_buffer.InMemoryLocationBuffer()),
+            mock.patch.object(db_router, "_usable", return_value=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_writing_request_pins_its_user(self):
+        self.client.force_authenticate(user=self.customer)
+        self.client.get(reverse("track-parcel", kwargs={"tracking_code": "RYW1"}))
+        self.assertFalse(db_router.is_pinned(self.customer.pk))
+
+        self.client.force_authenticate(user=self.driver_user)
+        response = self.client.patch(reverse("driver-update-location"), {"current_latitude": 6.5, "current_longitude": 3.4}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(db_router.is_pinned(self.driver_user.pk))
+        self.assertFalse(db_router.is_pinned(self.customer.pk))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, METRICS_FLUSH_INTERVAL=0.2)
+class MetricsTests(SimpleTestCase):
+    def test_idle_process_flushes_its_last_increments(self):
+        if metrics._timer is not None:
+            metrics._timer.join()  # Let a timer started by another test run out
+        metrics.flush()
+        metrics.reset(["idle.events"])
+        with mock.patch.object(metrics, "_last_flush", time.monotonic()):
+            metrics.increment("idle.events", 3)  # Not due yet, so only pending
+            timer = metrics._timer
+            self.assertIsNone(cache.get(metrics._key("idle.events")))
+            timer.join()
+        self.assertEqual(cache.get(metrics._key("idle.events")), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, METRICS_TOKEN="scrape-me")
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        metrics.flush()  # Drop increments left pending by other tests
+        cache.clear()
+        tracking.local_cache.clear()
+        self.client = APIClient()
+        self.admin = User.objects.create_user(username="observer", password="testpass", role="admin")
+        Parcel.objects.create(
+            tracking_code="OBS1", sender=self.admin, recipient_name="John", recipient_address="123 St",
+            recipient_phone="+1234567890", origin="City A", destination="City B"
+        )
+
+    def scrape(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token scrape-me")
+        response = self.client.get(reverse("prometheus-metrics"))
+        self.client.credentials()
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.force_authenticate(self.admin)
+        self.client.get(reverse("track-parcel", kwargs={"tracking_code": "OBS1"}))
+        self.client.force_authenticate(None)
+        body = self.scrape()
+        self.assertIn('logistics_http_request_duration_seconds_count{view="track-parcel"} 1', body)
+        self.assertIn('logistics_http_request_duration_seconds_bucket{view="track-parcel",le="+Inf"} 1', body)
+        self.assertIn('logistics_cache_misses_total{view="track-parcel"}', body)
+        queries = next(line for line in body.splitlines() if line.startswith('logistics_db_queries_total{view="track-parcel"}'))
+        self.assertGreater(float(queries.split()[-1]), 0)
+
+    def test_external_calls_are_counted(self):
+        with self.assertRaises(RuntimeError):
+            with instrumentation.external_call("stripe"):
+                raise RuntimeError("gateway down")
+        body = self.scrape()
+        self.assertIn('logistics_external_calls_total{service="stripe"} 1', body)
+        self.assertIn('logistics_external_call_errors_total{service="stripe"} 1', body)
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_log_their_top_queries(self):
+        self.client.force_authenticate(self.admin)
+        with self.assertLogs("shipments.instrumentation", "WARNING") as logs:
+            self.client.get(reverse("track-parcel", kwargs={"tracking_code": "OBS1"}))
+        self.assertIn("(track-parcel)", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+    def test_metrics_need_the_token_or_an_admin(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token wrong")
+        self.assertIn(self.client.get(reverse("prometheus-metrics")).status_code, (401, 403))
+        self.client.credentials()
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.get(reverse("prometheus-metrics")).status_code, 200)
@@ -0,0 +1,203 @@
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import metrics
+from .local_cache import MISSING, InvalidationBus, LocalCache
+from .models import ArchivedParcel, Parcel
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "tracking"
+SCHEMA_VERSION = 3  # Bump when the payload shape changes so old entries are never read
+TERMINAL_STATUSES = ("delivered", "confirmed", "cancelled")
+
+# Counters exported through shipments.metrics
+HITS = "tracking.hits"
+STALE_HITS = "tracking.stale_hits"
+MISSES = "tracking.misses"
+LOADS = "tracking.loads"
+COLLAPSED = "tracking.collapsed_misses"
+COUNTERS = (HITS, STALE_HITS, MISSES, LOADS, COLLAPSED)
+
+
+# Process-local tier in front of the Django cache for hot tracking codes
+local_cache = LocalCache(settings.TRACKING_L1_MAX_ENTRIES, settings.TRACKING_L1_TTL)
+invalidation_bus = InvalidationBus(settings.TRACKING_INVALIDATION_CHANNEL, local_cache)
+
+
+def cache_key(tracking_code):
+    return f"{NAMESPACE}:v{SCHEMA_VERSION}:{tracking_code}"
+
+
+def _lock_key(tracking_code):
+    return f"{NAMESPACE}:lock:{tracking_code}"
+
+
+def build_payload(parcel):
+    return {
+        "tracking_code": parcel.tracking_code,
+        "status": parcel.status,
+        "assigned_driver": parcel.assigned_driver.name if parcel.assigned_driver else "Not Assigned",
+        "current_location": parcel.current_location,
+        "current_latitude": parcel.current_latitude,
+        "current_longitude": parcel.current_longitude,
+        "updated_at": parcel.updated_at.timestamp() if parcel.updated_at else None,
+        "estimated_arrival": (
+            parcel.estimated_arrival.isoformat()
+            if parcel.estimated_arrival and parcel.status in Parcel.ACTIVE_STATUSES else None
+        ),
+    }
+
+
+def _fresh_ttl(payload):
+    if payload is None:
+        return settings.TRACKING_CACHE_NOT_FOUND_TTL
+    if payload["status"] in TERMINAL_STATUSES:
+        return settings.TRACKING_CACHE_TERMINAL_TTL
+    return settings.TRACKING_CACHE_TTL
+
+
+def _entry(payload):
+    ttl = _fresh_ttl(payload)
+    return {"payload": payload, "fresh_until": time.time() + ttl}, ttl + settings.TRACKING_CACHE_STALE_TTL
+
+
+def _load_many(tracking_codes):
+    parcels = Parcel.objects.select_related("assigned_driver").filter(tracking_code__in=tracking_codes)
+    payloads = {parcel.tracking_code: build_payload(parcel) for parcel in parcels}
+    # Codes missing from the hot table may belong to archived parcels
+    missing = [code for code in tracking_codes if code not in payloads]
+    if missing:
+        archived = ArchivedParcel.objects.select_related("assigned_driver").filter(tracking_code__in=missing)
+        payloads.update((parcel.tracking_code, build_payload(parcel)) for parcel in archived)
+    return payloads
+
+
+def _get_entry(tracking_code):
+    key = cache_key(tracking_code)
+    if settings.TRACKING_L1_ENABLED:
+        invalidation_bus.ensure_listening()
+        entry = local_cache.get(key)
+        if entry is not MISSING:
+            return entry
+    entry = cache.get(key)
+    if entry is not None and settings.TRACKING_L1_ENABLED:
+        local_cache.set(key, entry)
+    return entry
+
+
+def _evict_local(keys):
+    if settings.TRACKING_L1_ENABLED:
+        invalidation_bus.publish(keys)
+
+
+def store(tracking_code, payload):
+    entry, timeout = _entry(payload)
+    cache.set(cache_key(tracking_code), entry, timeout=timeout)
+    _evict_local([cache_key(tracking_code)])
+
+
+def write_through(parcel):
+    """
+    Replaces the cached payload with the parcel's current state. Called on
+    every Parcel save so readers never see a status older than the database.
+    """
+    payload = build_payload(parcel)
+    store(parcel.tracking_code, payload)
+    return payload
+
+
+def refresh(tracking_codes):
+    """
+    Reloads payloads for parcels changed by queryset updates, in one query.
+    """
+    tracking_codes = list(tracking_codes)
+    if not tracking_codes:
+        return
+    payloads = _load_many(tracking_codes)
+    entries = {}
+    timeout = 0
+    for code in tracking_codes:
+        entry, entry_timeout = _entry(payloads.get(code))
+        entries[cache_key(code)] = entry
+        timeout = max(timeout, entry_timeout)
+    cache.set_many(entries, timeout=timeout)
+    _evict_local(list(entries))
+
+
+def invalidate(tracking_codes):
+    keys = [cache_key(code) for code in tracking_codes]
+    if keys:
+        cache.delete_many(keys)
+        _evict_local(keys)
+
+
+def _load_single_flight(tracking_code):
+    """
+    Loads a missing payload with at most one database query across workers:
+    the caller that wins the lock loads and stores it, the others wait for
+    the stored value.
+    """
+    lock = _lock_key(tracking_code)
+    if cache.add(lock, 1, timeout=settings.TRACKING_CACHE_LOCK_TTL):
+        try:
+            metrics.increment(LOADS)
+            payload = _load_many([tracking_code]).get(tracking_code)
+            store(tracking_code, payload)
+            return payload
+        finally:
+            cache.delete(lock)
+
+    metrics.increment(COLLAPSED)
+    deadline = time.monotonic() + settings.TRACKING_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.02)
+        entry = _get_entry(tracking_code)
+        if entry is not None:
+            return entry["payload"]
+    # The loader is taking too long; don't leave this request hanging on it
+    metrics.increment(LOADS)
+    return _load_many([tracking_code]).get(tracking_code)
+
+
+def get(tracking_code):
+    """
+    Returns the tracking payload for a code, or None if no such parcel exists.
+    """
+    entry = _get_entry(tracking_code)
+    if entry is None:
+        metrics.increment(MISSES)
+        return _load_single_flight(tracking_code)
+
+    if entry["fresh_until"] >= time.time():
+        metrics.increment(HITS)
+        return entry["payload"]
+
+    # Stale: serve it while a single background job revalidates
+    metrics.increment(STALE_HITS)
+    if not settings.TRACKING_CACHE_STALE_WHILE_REVALIDATE:
+        return _load_single_flight(tracking_code)
+    if cache.add(_lock_key(tracking_code), 1, timeout=settings.TRACKING_CACHE_LOCK_TTL):
+        from .tasks import revalidate_tracking_cache
+        try:
+            revalidate_tracking_cache.delay(tracking_code)
+        except Exception as e:
+            cache.delete(_lock_key(tracking_code))
+            logger.warning(f"Could not queue tracking revalidation for {tracking_code}: {e}")
+    return entry["payload"]
+
+
+def revalidate(tracking_code):
+    try:
+        refresh([tracking_code])
+    finally:
+        cache.delete(_lock_key(tracking_code))
+
+
+def cache_stats():
+    stats = metrics.get_counters(COUNTERS)
+    lookups = stats[HITS] + stats[STALE_HITS] + stats[MISSES]
+    stats["hit_rate"] = round((stats[HITS] + stats[STALE_HITS]) / lookups, 4) if lookups else None
+    stats["local"] = local_cache.stats()  # This worker process only
+    return stats
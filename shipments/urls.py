@@ -1,8 +1,15 @@
 from django.urls import path
 
+from .consumers import track_parcel_events, driver_events
+
 from .views import (
     ParcelListCreateView, ParcelDetailView,
-    DriverListCreateView, DriverDetailView, assign_driver, process_payment, update_location, track_parcel, confirm_delivery, user_dashboard, stripe_webhook
+    DriverListCreateView, DriverDetailView, assign_driver, process_payment, update_location, track_parcel, confirm_delivery, user_dashboard, stripe_webhook,
+    geocode_cache_stats, bulk_create_parcels, update_driver_location,
+    parcel_location_history, driver_location_history, tracking_cache_stats,
+    notification_stats, outbox_stats, auto_dispatch, nearby_parcels, nearby_drivers,
+    driver_route, analytics_statuses, analytics_revenue, analytics_drivers,
+    export_parcels, payment_status, stripe_event_stats, prometheus_metrics,
 )
 
 urlpatterns = [
@@ -10,20 +17,47 @@ urlpatterns = [
     # Driver Routes
     path('drivers/', DriverListCreateView.as_view(), name='driver-list-create'),
     path('drivers/<int:pk>/', DriverDetailView.as_view(), name='driver-detail'),
+    path('drivers/me/location/', update_driver_location, name='driver-update-location'),
+    path('drivers/nearby/', nearby_drivers, name='nearby-drivers'),
+    path('drivers/<int:driver_id>/history/', driver_location_history, name='driver-location-history'),
+    path('drivers/<int:driver_id>/events/', driver_events, name='driver-events'),
+    path('drivers/<int:driver_id>/route/', driver_route, name='driver-route'),
 
     # Parcel Routes
     path('parcels/', ParcelListCreateView.as_view(), name='parcel-list-create'),
+    path('parcels/bulk/', bulk_create_parcels, name='parcel-bulk-create'),
+    path('parcels/nearby/', nearby_parcels, name='nearby-parcels'),
+    path('parcels/export/', export_parcels, name='export-parcels'),
     path('parcels/<uuid:pk>/', ParcelDetailView.as_view(), name='parcel-detail'),
     path('parcels/<str:tracking_code>/track/', track_parcel, name='track-parcel'),
+    path('parcels/<str:tracking_code>/events/', track_parcel_events, name='track-parcel-events'),
     path('parcels/<uuid:parcel_id>/pay/', process_payment, name='process-payment'),
+    path('parcels/<uuid:parcel_id>/payment/', payment_status, name='payment-status'),
     path('parcels/<uuid:parcel_id>/update-location/', update_location, name='update-location'),
+    path('parcels/<uuid:parcel_id>/history/', parcel_location_history, name='parcel-location-history'),
     path('parcels/confirm/<str:tracking_code>/', confirm_delivery, name='confirm_delivery'),
 
     # Assignment and Dashboard
     path('parcels/<uuid:parcel_id>/assign-driver/<int:driver_id>/', assign_driver, name='assign-driver'),
+    path('dispatch/auto/', auto_dispatch, name='auto-dispatch'),
     path('dashboard/', user_dashboard, name='dashboard'),
 
+    # Geocoding
+    path('geocoding/stats/', geocode_cache_stats, name='geocode-cache-stats'),
+    path('tracking/stats/', tracking_cache_stats, name='tracking-cache-stats'),
+    path('notifications/stats/', notification_stats, name='notification-stats'),
+    path('outbox/stats/', outbox_stats, name='outbox-stats'),
+
+    # Analytics
+    path('analytics/statuses/', analytics_statuses, name='analytics-statuses'),
+    path('analytics/revenue/', analytics_revenue, name='analytics-revenue'),
+    path('analytics/drivers/', analytics_drivers, name='analytics-drivers'),
+
     # Stripe
     path('stripe-webhook/', stripe_webhook, name='stripe-webhook'),
+    path('stripe-webhook/stats/', stripe_event_stats, name='stripe-event-stats'),
+
+    # Monitoring
+    path('metrics/', prometheus_metrics, name='prometheus-metrics'),
 
 ]
@@ -4,20 +4,36 @@ from threading import Thread
 from django.conf import settings
 from django.core.mail import send_mail
 from twilio.rest import Client
+from . import instrumentation
 
 logger = logging.getLogger(__name__)  # Logging for errors
 
+_redis_client = None
+
+
+def get_redis():
+    """
+    Shared redis-py client for features that need more than the cache API
+    (streams, pub/sub). Connections are pooled by the client itself.
+    """
+    global _redis_client
+    if _redis_client is None:
+        import redis
+        _redis_client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=settings.REDIS_SOCKET_TIMEOUT)
+    return _redis_client
+
 def send_sms(to, message):
     """
     Sends an SMS message using Twilio API.
     """
     client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
     try:
-        client.messages.create(
-            body=message,
-            from_=settings.TWILIO_PHONE_NUMBER,
-            to=to
-        )
+        with instrumentation.external_call("twilio"):
+            client.messages.create(
+                body=message,
+                from_=settings.TWILIO_PHONE_NUMBER,
+                to=to
+            )
         logger.info(f"SMS sent to {to}")
         return True
     except Exception as e:
@@ -26,14 +42,20 @@ def send_sms(to, message):
     
 
 
-def get_coordinates(address):
+def get_coordinates(address, timeout=None, raise_errors=False):
+    """
+    Looks up an address with the Google Geocoding API. Network errors are
+    logged and reported as (None, None) unless raise_errors is set, which lets
+    callers tell "not found" apart from "try again later".
+    """
     base_url = "https://maps.googleapis.com/maps/api/geocode/json"
     params = {
         "address": address,
         "key": settings.GOOGLE_MAPS_API_KEY
     }
     try:
-        response = requests.get(base_url, params=params)
+        with instrumentation.external_call("google_maps"):
+            response = requests.get(base_url, params=params, timeout=timeout or settings.GEOCODING_TIMEOUT)
         response.raise_for_status()  # Raises an error for failed requests
         data = response.json()
 
@@ -46,6 +68,8 @@ def get_coordinates(address):
             return None, None
     except requests.RequestException as e:
         logger.error(f"Google Maps API error for {address}: {e}")
+        if raise_errors:
+            raise
 
     return None, None
 
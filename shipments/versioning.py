@@ -0,0 +1,68 @@
+import hashlib
+import time
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+# Admins see every parcel, so they share one stamp that moves on any change
+ALL_PARCELS_STAMP = "dashboard:stamp:all"
+
+
+def _user_stamp_key(user_id):
+    return f"dashboard:stamp:user:{user_id}"
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def touch_dashboards(user_ids):
+    """
+    Moves the dashboard version stamp of every user whose dashboard shows a
+    changed parcel (its sender and assigned driver), plus the admin stamp.
+    """
+    now = _now_ms()
+    keys = {_user_stamp_key(user_id) for user_id in user_ids if user_id is not None}
+    keys.add(ALL_PARCELS_STAMP)
+    cache.set_many({key: now for key in keys}, timeout=None)
+
+
+def dashboard_stamp(user):
+    """
+    Returns the current stamp (epoch milliseconds) for a user's dashboard.
+    """
+    key = ALL_PARCELS_STAMP if user.role == "admin" else _user_stamp_key(user.pk)
+    stamp = cache.get(key)
+    if stamp is None:
+        # Unknown state (first request, or evicted): start a new version now
+        stamp = _now_ms()
+        if not cache.add(key, stamp, timeout=None):
+            stamp = cache.get(key, stamp)
+    return stamp
+
+
+def dashboard_etag(user, stamp, query_string):
+    variant = hashlib.md5(query_string.encode("utf-8")).hexdigest()[:8]
+    return quote_etag(f"dash-{user.pk}-{user.role}-{stamp}-{variant}")
+
+
+def tracking_etag(tracking_code, updated_at, position_ts=None):
+    version = f"{updated_at:.3f}" if position_ts is None else f"{updated_at:.3f}-{position_ts:.3f}"
+    return quote_etag(f"track-{tracking_code}-{version}")
+
+
+def not_modified(request, etag, last_modified):
+    """
+    Returns a 304 response when the client's If-None-Match/If-Modified-Since
+    already match, otherwise None. `last_modified` is an epoch timestamp.
+    """
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+
+
+def add_validators(response, etag, last_modified):
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    # Clients may keep the body but must revalidate; responses differ per user
+    response["Cache-Control"] = "private, no-cache"
+    response["Vary"] = "Authorization"
+    return response
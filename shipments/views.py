@@ -1,27 +1,31 @@
 from rest_framework import generics, permissions
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework import status
 from rest_framework.pagination import PageNumberPagination
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.core.mail import send_mail
+from django.http import HttpResponse, StreamingHttpResponse
 from .models import Parcel, Driver
 from .serializers import*
-from .utils import send_sms,get_coordinates, send_email_notification
-from .tasks import send_email_async
-from .permissions import IsCustomer, IsAdmin, IsDriver
+from .utils import send_sms
+from .permissions import HasMetricsToken, IsCustomer, IsAdmin, IsDriver
+from .pagination import KeysetPagination
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
 from django.conf import settings
-from .tasks import send_email_async, send_sms_async
+from .tasks import geocode_parcel, submit_payment
+from . import analytics, bulk, db_router, dispatch, eta, export, fastpath, geo, geocoding, history, ids, instrumentation, location_buffer, notifications, outbox, payments, push, route_planner, spatial, tracking, versioning, webhooks
 from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import timedelta
+import json
 import stripe
 
-stripe.api_key = settings.STRIPE_API_KEY
-CENTS_PER_DOLLAR = 100
-
 import logging
 logger = logging.getLogger(__name__)
 
@@ -32,6 +36,9 @@ class StandardPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 100
 
+# Read-only parcel responses are rendered with orjson when it's installed
+FAST_RENDERERS = [fastpath.FastJSONRenderer, BrowsableAPIRenderer]
+
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     def validate(self, attrs):
         data = super().validate(attrs)
@@ -44,22 +51,23 @@ class CustomTokenObtainPairView(TokenObtainPairView):
 
 @api_view(["POST"])
 def stripe_webhook(request):
+    """
+    Verifies and stores the event, then answers at once; the
+    process_stripe_events task applies it. Retried deliveries of an event
+    already stored are acknowledged and dropped.
+    """
     payload = request.body
     sig_header = request.META.get("HTTP_STRIPE_SIGNATURE")
     endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
 
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
-    except stripe.error.SignatureVerificationError as e:
+        stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
         logger.error(f"Stripe webhook signature verification failed: {e}")
         return Response({"error": "Invalid signature"}, status=400)
 
-    if event["type"] == "payment_intent.succeeded":
-        payment_intent = event["data"]["object"]
-        tracking_code = payment_intent["metadata"]["tracking_code"]
-        Parcel.objects.filter(tracking_code=tracking_code).update(payment_status="paid")
-        logger.info(f"Payment succeeded for parcel {tracking_code}")
-
+    # Store the raw body as sent, rather than the SDK's object
+    webhooks.ingest(json.loads(payload))
     return Response({"message": "Webhook received"}, status=200)
 
 
@@ -68,18 +76,28 @@ def stripe_webhook(request):
 class ParcelListCreateView(generics.ListCreateAPIView):
     serializer_class = ParcelSerializer
     permission_classes = [permissions.IsAuthenticated, IsCustomer]
+    renderer_classes = FAST_RENDERERS
 
     def get_queryset(self):
-        return Parcel.objects.filter(sender=self.request.user).select_related('sender', 'assigned_driver')
+        return Parcel.objects.filter(sender=self.request.user).order_by("-created_at", "-id")
+
+    def list(self, request, *args, **kwargs):
+        """
+        Pages are projected from .values() rows rather than run through
+        ParcelSerializer, which is only used to validate creates. Reads may
+        be served by a replica.
+        """
+        with db_router.replica_reads(request.user):
+            parcels = fastpath.PARCEL_LIST.values(self.get_queryset())
+            page = self.paginate_queryset(parcels)
+            if page is not None:
+                return self.get_paginated_response(fastpath.PARCEL_LIST.project(page))
+            return Response(fastpath.PARCEL_LIST.project(parcels))
     
     def perform_create(self, serializer):
         parcel = serializer.save(sender=self.request.user)
-        # Get recipient address coordinates
-        lat, lng = get_coordinates(parcel.recipient_address)
-        if lat and lng:
-            parcel.current_latitude = lat
-            parcel.current_longitude = lng
-            parcel.save()
+        # Geocode the recipient address in the background once the row is committed
+        transaction.on_commit(lambda: geocode_parcel.delay(str(parcel.id)))
     
         # subject = "Parcel Created Successfully"
         # message = f"Your parcel with tracking code {parcel.tracking_code} has been created."
@@ -92,6 +110,23 @@ class ParcelListCreateView(generics.ListCreateAPIView):
 
 
 
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated, IsCustomer])
+def bulk_create_parcels(request):
+    """
+    Creates parcels from a streamed CSV (text/csv) or NDJSON
+    (application/x-ndjson) body. Rows are validated and inserted in chunks;
+    the response reports the outcome of every row.
+    """
+    try:
+        report = bulk.ingest(request.stream, request.content_type, request.user)
+    except bulk.UnsupportedFormat as e:
+        return Response({"error": str(e)}, status=415)
+    except UnicodeDecodeError:
+        return Response({"error": "Upload must be UTF-8 encoded."}, status=400)
+    return Response(report, status=201 if report["created"] else 400)
+
+
 # Retrieve, Update, Delete Parcels
 class ParcelDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ParcelSerializer
@@ -121,30 +156,34 @@ class ParcelDetailView(generics.RetrieveUpdateDestroyAPIView):
 @permission_classes([permissions.IsAdminUser, IsAdmin])
 def assign_driver(request, parcel_id, driver_id):
     with transaction.atomic():
-        parcel = get_object_or_404(Parcel, id=parcel_id)
-        driver = get_object_or_404(Driver, id=driver_id)
+        parcel = get_object_or_404(Parcel.objects.select_for_update(), id=parcel_id)
+        # Locking the driver row serializes concurrent assignments to the same driver
+        driver = get_object_or_404(Driver.objects.select_for_update(), pk=driver_id)
         if parcel.assigned_driver:
             return Response({"error": "Parcel already assigned."}, status=400)
-        # Check driver availability (e.g., max 5 active parcels)
-        active_parcels = Parcel.objects.filter(assigned_driver=driver, status__in=["assigned", "in_transit"]).count()
-        if active_parcels >= 5:
+        if driver.active_parcels >= Driver.MAX_ACTIVE_PARCELS:
             return Response({"error": "Driver has too many active parcels."}, status=400)
         parcel.assigned_driver = driver
         parcel.status = "assigned"
-        parcel.save()
-
-    if driver.phone:
-        send_sms_async.delay(driver.phone, f"You've been assigned a new parcel: {parcel.tracking_code}")
-    if parcel.sender.profile.phone_number:
-        send_sms_async.delay(parcel.sender.profile.phone_number, f"Your parcel {parcel.tracking_code} is assigned to {driver.name}")
-    send_email_async.delay(
-        "Driver Assigned to Your Parcel",
-        f"Your parcel {parcel.tracking_code} is now assigned to {driver.name}.",
-        [parcel.sender.email]
-    )
+        parcel.save()  # Notifications go out through the parcel's driver_assigned event
+
     return Response({"message": "Driver assigned successfully"}, status=200)
 
 
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def auto_dispatch(request):
+    """
+    Assigns the pending backlog to the nearest drivers with spare capacity.
+    Optional body: {"limit": <max parcels>}.
+    """
+    try:
+        limit = int(request.data.get("limit") or 0) or None
+    except (TypeError, ValueError):
+        return Response({"error": "limit must be an integer"}, status=400)
+    return Response(dispatch.auto_assign(limit=limit), status=200)
+
+
 # Create and View Drivers
 class DriverListCreateView(generics.ListCreateAPIView):
     queryset = Driver.objects.all()
@@ -161,98 +200,101 @@ class DriverDetailView(generics.RetrieveUpdateDestroyAPIView):
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 def process_payment(request, parcel_id):
-    parcel = get_object_or_404(Parcel, id=parcel_id)
-    if parcel.payment_status == "paid":
-        return Response({"error": "Parcel is already paid for."}, status=400)
-    
+    """
+    Charges a parcel. Repeated submits while a charge is in flight get a 409
+    instead of a second charge. With PAYMENT_ASYNC the charge runs on a
+    worker and this answers 202; poll the payment status endpoint.
+    """
+    parcel = get_object_or_404(Parcel.objects.only("id", "tracking_code"), id=parcel_id)
     serializer = PaymentSerializer(data=request.data)
     if not serializer.is_valid():
         return Response(serializer.errors, status=400)
 
     try:
-        intent = stripe.PaymentIntent.create(
-            amount=int(parcel.price * CENTS_PER_DOLLAR),
-            currency="usd",
-            description=f"Payment for parcel {parcel.tracking_code}",
-            payment_method=serializer.validated_data["payment_method_id"],
-            confirm=True,
-            metadata={"tracking_code": parcel.tracking_code}  # Ensure tracking_code is passed
-        )
-
-        parcel.payment_status = "paid"
-        parcel.save()
-
-        # send_email_notification(
-        #     "Payment Successful for Your Parcel",
-        #     f"Your payment of ${parcel.price} for parcel {parcel.tracking_code} was successful.",
-        #     [parcel.sender.email]  # Changed from parcel.user.email
-        # )
-        # if parcel.sender.profile.phone_number:  # Changed from parcel.user.profile.phone_number
-        #     send_sms(
-        #         parcel.sender.profile.phone_number,
-        #         f"Payment of ${parcel.price} for {parcel.tracking_code} received."
-        #     )
-
-        return Response({"message": "Payment successful", "client_secret": intent.client_secret}, status=200)
-    except stripe.error.CardError as e:
-        logger.error(f"Card error for parcel {parcel.tracking_code}: {e.user_message}")
-        return Response({"error": f"Card error: {e.user_message}"}, status=400)
+        attempt = payments.begin(parcel.pk, serializer.validated_data["payment_method_id"])
+        if settings.PAYMENT_ASYNC:
+            submit_payment.delay(attempt.pk)
+            return Response({"message": "Payment submitted", **payments.describe(attempt)}, status=202)
+        attempt, intent = payments.submit(attempt)
+    except payments.PaymentInProgress as e:
+        return Response({"error": str(e)}, status=409)
+    except payments.PaymentError as e:
+        logger.info(f"Payment refused for parcel {parcel.tracking_code}: {e}")
+        return Response({"error": f"Card error: {e}"}, status=400)
     except stripe.error.StripeError as e:
+        # The attempt stays pending; retrying resubmits it under the same idempotency key
         logger.error(f"Stripe error for parcel {parcel.tracking_code}: {str(e)}")
         return Response({"error": f"Payment error: {str(e)}"}, status=400)
     except Exception as e:
         logger.error(f"Unexpected error in process_payment for parcel {parcel.tracking_code}: {e}")
         return Response({"error": "Server error. Please try again."}, status=500)
 
-
-@api_view(['PATCH'])
-@permission_classes([permissions.IsAuthenticated, IsDriver])
-def update_location(request, parcel_id):
-    parcel = get_object_or_404(Parcel, id=parcel_id, assigned_driver__user=request.user)
-    serializer = ParcelUpdateLocationSerializer(parcel, data=request.data, partial=True)
-    if serializer.is_valid():
-        serializer.save()
-        cache.delete(parcel.tracking_code)  # Invalidate cache
-        return Response({"message": "Location updated", "data": serializer.data}, status=200)
-    return Response(serializer.errors, status=400)
+    if attempt.status == "succeeded":
+        return Response({"message": "Payment successful", **payments.describe(attempt, intent)}, status=200)
+    # e.g. 3D Secure: the client confirms with the secret and the webhook settles it
+    return Response({"message": "Payment requires confirmation", **payments.describe(attempt, intent)}, status=202)
 
 
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
-def track_parcel(request, tracking_code):
-    cached_data = cache.get(tracking_code)
-    if cached_data:
-        return Response(cached_data, status=200)
+def payment_status(request, parcel_id):
+    """
+    The parcel's payment status and its latest attempt. Sender and admins only.
+    """
+    parcel = get_object_or_404(Parcel.objects.only("id", "sender_id", "payment_status"), id=parcel_id)
+    if request.user.role != "admin" and request.user.pk != parcel.sender_id:
+        return Response({"error": "Not allowed"}, status=403)
+    attempt = parcel.payment_attempts.order_by("-number").first()
+    return Response({
+        "payment_status": parcel.payment_status,
+        "latest_attempt": payments.describe(attempt) if attempt else None,
+    }, status=200)
 
-    parcel = get_object_or_404(Parcel, tracking_code=tracking_code)
-    data = {
-        "tracking_code": parcel.tracking_code,
-        "status": parcel.status,
-        "assigned_driver": parcel.assigned_driver.name if parcel.assigned_driver else "Not Assigned",
-    }
 
-    # Cache for 1 hour, or less if status is dynamic
-    cache_timeout = 3600 if parcel.status in ["delivered", "confirmed", "cancelled"] else 300
-    cache.set(tracking_code, data, timeout=cache_timeout)
-    return Response(data, status=200)
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+@renderer_classes(FAST_RENDERERS)
+@db_router.reads_from_replica
+def track_parcel(request, tracking_code):
+    tracking_code = ids.normalize_tracking_code(tracking_code)  # Accept hand-typed variants
+    data = tracking.get(tracking_code)
+    if data is None:
+        return Response({"detail": "Not found."}, status=404)
+
+    # Positions still waiting in the location buffer are newer than the database
+    ping = None
+    if settings.LOCATION_INGEST_MODE == "buffered":
+        buffer = location_buffer.get_location_buffer()
+        ping = buffer.latest(tracking_code) if buffer is not None else None
+
+    # Answer polling clients from the version stamp before building the body
+    updated_at = data["updated_at"] or 0
+    position_ts = ping["ts"] if ping else None
+    etag = versioning.tracking_etag(tracking_code, updated_at, position_ts)
+    last_modified = max(updated_at, position_ts or 0)
+    not_modified = versioning.not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    if ping:
+        data = dict(data)
+        for field, key in location_buffer.PING_FIELDS.items():
+            if ping.get(key) is not None:
+                data[field] = ping[key]
+    return versioning.add_validators(Response(data, status=200), etag, last_modified)
 
 
 @api_view(["PATCH"])
 @permission_classes([permissions.IsAuthenticated, IsCustomer])
 def confirm_delivery(request, tracking_code):
     try:
-        parcel = Parcel.objects.get(tracking_code=tracking_code, sender=request.user)
+        parcel = Parcel.objects.get(tracking_code=ids.normalize_tracking_code(tracking_code), sender=request.user)
 
         if parcel.status != "delivered":
             return Response({"error": "Parcel has not been marked as delivered yet"}, status=400)
 
         parcel.status = "confirmed"
-        parcel.save()
-
-        
-        subject = "Parcel Delivery Confirmed"
-        message = f"The customer has confirmed the delivery of parcel {tracking_code}."
-        send_email_notification(subject, message, [parcel.assigned_driver.email])
+        parcel.save()  # The status_changed event emails the driver
 
         return Response({"message": "Delivery confirmed successfully"}, status=200)
 
@@ -263,32 +305,39 @@ def confirm_delivery(request, tracking_code):
 
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
+@renderer_classes(FAST_RENDERERS)
+@db_router.reads_from_replica
 def user_dashboard(request):
     user = request.user
+    # The stamp moves whenever any parcel on this dashboard changes, so a
+    # matching ETag means the page can be answered without querying parcels
+    stamp = versioning.dashboard_stamp(user)
+    etag = versioning.dashboard_etag(user, stamp, request.META.get("QUERY_STRING", ""))
+    not_modified = versioning.not_modified(request, etag, stamp / 1000)
+    if not_modified is not None:
+        return not_modified
+
     if user.role == "admin":
-        parcels = Parcel.objects.all().select_related('sender', 'assigned_driver')
+        parcels = Parcel.objects.all()
     elif user.role == "driver":
-        parcels = Parcel.objects.filter(assigned_driver__user=user).select_related('sender')
+        parcels = Parcel.objects.filter(assigned_driver_id=user.pk)
     else:
-        parcels = Parcel.objects.filter(sender=user).select_related('assigned_driver')
+        parcels = Parcel.objects.filter(sender=user)
 
-    paginator = StandardPagination()
+    # Fetch only the columns this role's dashboard shows, as dicts rather than model instances
+    projection = fastpath.dashboard_projection(user.role)
+    parcels = projection.values(parcels, "id", "created_at")  # Keyset pagination reads both
+
+    if request.query_params.get("pagination") == "cursor" or "cursor" in request.query_params:
+        paginator = KeysetPagination()
+    else:
+        paginator = StandardPagination()
+        parcels = parcels.order_by("-created_at", "-id")  # Stable pages
     result_page = paginator.paginate_queryset(parcels, request)
 
-    data = [
-        {
-            "tracking_code": parcel.tracking_code,
-            "recipient_name": parcel.recipient_name,
-            "recipient_address": parcel.recipient_address if user.role in ["admin", "driver"] else None,
-            "recipient_phone": parcel.recipient_phone if user.role in ["admin", "driver"] else None,
-            "status": parcel.status,
-            "current_latitude": parcel.current_latitude,
-            "current_longitude": parcel.current_longitude,
-            "assigned_driver": parcel.assigned_driver.name if parcel.assigned_driver else None,
-        }
-        for parcel in result_page
-    ]
-    return paginator.get_paginated_response(data)
+    data = projection.project(result_page)
+    return versioning.add_validators(paginator.get_paginated_response(data), etag, stamp / 1000)
+
 
 @api_view(['PATCH'])
 @permission_classes([permissions.IsAuthenticated, IsDriver])
@@ -296,18 +345,399 @@ def update_location(request, parcel_id):
     """
     Update the current location of a parcel.
     Only the assigned driver can update the location.
+    In buffered ingestion mode the ping is appended to the location buffer and
+    written to the database later by the flusher, or saved right away while
+    the buffer is unavailable.
     Args:
         request: HTTP request with latitude/longitude data
         parcel_id: UUID of the parcel
     Returns:
         200: Location updated successfully
+        202: Location accepted into the buffer
         400: Invalid data
         404: Parcel not found or unauthorized
     """
-    parcel = get_object_or_404(Parcel, id=parcel_id, assigned_driver__user=request.user)
+    if settings.LOCATION_INGEST_MODE == "buffered":
+        serializer = ParcelUpdateLocationSerializer(data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        assignment = _assignment(parcel_id, request.user)
+        if assignment is None:
+            return Response({"detail": "Not found."}, status=404)
+        tracking_code, sender_id = assignment
+        ping = location_buffer.make_ping(
+            parcel_id, tracking_code, serializer.validated_data, driver_id=request.user.pk, sender_id=sender_id
+        )
+        if location_buffer.append([ping]):
+            push.publish_locations([ping])
+            return Response({"message": "Location accepted", "data": serializer.data}, status=202)
+
+    # Driver's primary key is its user id, so no join on assigned_driver__user is needed
+    parcel = get_object_or_404(Parcel, id=parcel_id, assigned_driver_id=request.user.pk)
     serializer = ParcelUpdateLocationSerializer(parcel, data=request.data, partial=True)
     if serializer.is_valid():
-        serializer.save()
-        cache.delete(parcel.tracking_code)
+        serializer.save()  # The post_save signal writes the new position through to the tracking cache
+        ping = location_buffer.make_ping(
+            parcel.id, parcel.tracking_code, serializer.validated_data, driver_id=request.user.pk, sender_id=parcel.sender_id
+        )
+        # Outbox events only cover status, driver and payment changes, so positions are pushed here
+        transaction.on_commit(lambda: push.publish_locations([ping]))
+        _record_history([ping])
         return Response({"message": "Location updated", "data": serializer.data}, status=200)
-    return Response(serializer.errors, status=400)
\ No newline at end of file
+    return Response(serializer.errors, status=400)
+
+
+@api_view(['PATCH'])
+@permission_classes([permissions.IsAuthenticated, IsDriver])
+def update_driver_location(request):
+    """
+    Applies one position (or the newest point of a short trail) to every
+    parcel the driver is carrying, in a single UPDATE.
+    Returns:
+        200: Parcels updated
+        202: Pings accepted into the location buffer
+        400: Invalid data
+    """
+    serializer = DriverLocationSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    points = serializer.trail()
+    position = points[-1]["data"]
+
+    parcels = Parcel.objects.filter(assigned_driver_id=request.user.pk, status__in=Parcel.ACTIVE_STATUSES)
+    rows = list(parcels.values_list("id", "tracking_code", "sender_id"))
+    tracking_codes = [code for _, code, _ in rows]
+    pings = [
+        location_buffer.make_ping(
+            parcel_id, tracking_code, point["data"], driver_id=request.user.pk, sender_id=sender_id, ts=point["ts"]
+        )
+        for parcel_id, tracking_code, sender_id in rows
+        for point in points
+    ]
+    push.publish_locations(pings)
+    dispatch.record_driver_position(request.user.pk, position.get("current_latitude"), position.get("current_longitude"), points[-1]["ts"])
+    if settings.LOCATION_INGEST_MODE == "buffered" and location_buffer.append(pings):
+        return Response({"message": "Location accepted", "tracking_codes": tracking_codes}, status=202)
+
+    geohash = geo.geohash(position.get("current_latitude"), position.get("current_longitude"))
+    updated = parcels.update(**position, geohash=geohash, updated_at=timezone.now()) if rows else 0
+    if rows:
+        eta.refresh([parcel_id for parcel_id, _, _ in rows])
+    tracking.invalidate(tracking_codes)
+    versioning.touch_dashboards({request.user.pk} | {sender_id for _, _, sender_id in rows})
+    _record_history(pings)
+    return Response({"message": "Location updated", "updated": updated, "tracking_codes": tracking_codes}, status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def geocode_cache_stats(request):
+    """
+    Hit/miss counters for the address -> coordinate cache.
+    """
+    return Response(geocoding.cache_stats(), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def tracking_cache_stats(request):
+    """
+    Hit/miss counters for the tracking cache.
+    """
+    return Response(tracking.cache_stats(), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def notification_stats(request):
+    """
+    Per-channel throughput, dedupe and average queue-to-send latency.
+    """
+    return Response(notifications.stats(), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def outbox_stats(request):
+    """
+    Relay counters and the number of parcel events waiting for delivery.
+    """
+    return Response(outbox.stats(), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def stripe_event_stats(request):
+    """
+    Webhook events received, dropped as duplicates, applied and waiting.
+    """
+    return Response(webhooks.stats(), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([HasMetricsToken | IsAdmin])
+def prometheus_metrics(request):
+    """
+    Per-view latency histograms, query/cache counts and external-call time,
+    plus the subsystem counters, in the Prometheus text format.
+    """
+    counters = tracking.COUNTERS + geocoding.COUNTERS + outbox.COUNTERS + webhooks.COUNTERS + notifications.COUNTERS
+    return HttpResponse(instrumentation.exposition(counters), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _record_history(pings):
+    """
+    Directly saved positions still go through the location buffer so the
+    flusher can add them to the location history; while it's unavailable
+    they are recorded here.
+    """
+    if settings.LOCATION_HISTORY_ENABLED and pings and not location_buffer.append(pings):
+        history.record(pings)
+
+
+def _history_window(request):
+    """
+    Parses ?start=&end= (ISO 8601) into an aware datetime range, defaulting to
+    the last 24 hours. Returns (start, end, error).
+    """
+    try:
+        end = parse_datetime(request.query_params["end"]) if "end" in request.query_params else timezone.now()
+        start = parse_datetime(request.query_params["start"]) if "start" in request.query_params else end - timedelta(days=1)
+    except ValueError:
+        start = end = None
+    if start is None or end is None:
+        return None, None, "start and end must be ISO 8601 datetimes."
+    if timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    if timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    if start > end or end - start > timedelta(days=settings.LOCATION_HISTORY_MAX_WINDOW_DAYS):
+        return None, None, f"Window must be positive and at most {settings.LOCATION_HISTORY_MAX_WINDOW_DAYS} days."
+    return start, end, None
+
+
+def _history_response(request, **subject):
+    start, end, error = _history_window(request)
+    if error:
+        return Response({"error": error}, status=400)
+    try:
+        max_points = int(request.query_params.get("max_points", 0)) or None
+    except ValueError:
+        return Response({"error": "max_points must be an integer."}, status=400)
+    points = history.query(start, end, max_points=max_points, **subject)
+    return Response({
+        "start": start,
+        "end": end,
+        "fields": ["timestamp", "latitude", "longitude"],
+        "points": points,
+    }, status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def parcel_location_history(request, parcel_id):
+    """
+    A parcel's recorded track between ?start= and ?end=. Visible to the
+    sender, the assigned driver and admins.
+    """
+    parcel = get_object_or_404(Parcel.objects.only("sender_id", "assigned_driver_id"), id=parcel_id)
+    if request.user.role != "admin" and request.user.pk not in (parcel.sender_id, parcel.assigned_driver_id):
+        return Response({"detail": "Not found."}, status=404)
+    return _history_response(request, parcel_id=parcel.id)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def driver_location_history(request, driver_id):
+    """
+    A driver's recorded track. Visible to that driver and admins.
+    """
+    if request.user.role != "admin" and request.user.pk != driver_id:
+        return Response({"detail": "Not found."}, status=404)
+    get_object_or_404(Driver, pk=driver_id)
+    return _history_response(request, driver_id=driver_id)
+
+
+def _assignment(parcel_id, user):
+    """
+    Returns (tracking_code, sender_id) if the parcel is assigned to this
+    driver and still active. The answer is cached briefly so buffered pings
+    don't each hit the database; saves and dispatch drop it on change.
+    """
+    key = location_buffer.assignment_key(parcel_id)
+    assignment = cache.get(key)
+    # An answer naming another driver may predate this driver's assignment
+    if assignment is None or assignment[0] != user.pk:
+        row = Parcel.objects.filter(id=parcel_id).values_list(
+            "assigned_driver_id", "status", "tracking_code", "sender_id"
+        ).first()
+        if row is None:
+            return None
+        assignment = row
+        cache.set(key, assignment, timeout=settings.LOCATION_ASSIGNMENT_CACHE_TTL)
+    driver_id, status, tracking_code, sender_id = assignment
+    if driver_id != user.pk or status not in Parcel.ACTIVE_STATUSES:
+        return None
+    return tracking_code, sender_id
+
+
+def _nearby_query(request):
+    """
+    Parses ?lat=&lng=&radius_km= (default 5). Returns (lat, lng, radius_km, error).
+    """
+    try:
+        lat = float(request.query_params["lat"])
+        lng = float(request.query_params["lng"])
+        radius_km = float(request.query_params.get("radius_km", 5))
+    except (KeyError, ValueError):
+        return None, None, None, "lat and lng are required numbers; radius_km must be a number."
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None, None, None, "lat/lng out of range."
+    if not 0 < radius_km <= settings.SPATIAL_MAX_RADIUS_KM:
+        return None, None, None, f"radius_km must be between 0 and {settings.SPATIAL_MAX_RADIUS_KM}."
+    return lat, lng, radius_km, None
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def nearby_parcels(request):
+    """
+    Parcels within radius_km of a point, closest first. Optional ?status= (repeatable).
+    """
+    lat, lng, radius_km, error = _nearby_query(request)
+    if error:
+        return Response({"error": error}, status=400)
+    results = spatial.nearby_parcels(lat, lng, radius_km, statuses=request.query_params.getlist("status"))
+    return Response({"count": len(results), "results": results}, status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def nearby_drivers(request):
+    """
+    Drivers last seen within radius_km of a point, closest first. ?available=1
+    keeps only drivers below the active-parcel limit.
+    """
+    lat, lng, radius_km, error = _nearby_query(request)
+    if error:
+        return Response({"error": error}, status=400)
+    available = request.query_params.get("available") in ("1", "true")
+    results = spatial.nearby_drivers(lat, lng, radius_km, available_only=available)
+    return Response({"count": len(results), "results": results}, status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def driver_route(request, driver_id):
+    """
+    Optimized stop order for a driver's active parcels. Admins or the driver
+    themselves; ?refresh=1 forces a re-plan.
+    """
+    if request.user.role != "admin" and request.user.pk != driver_id:
+        return Response({"error": "Not allowed"}, status=403)
+    if not Driver.objects.filter(pk=driver_id).exists():
+        return Response({"error": "Driver not found"}, status=404)
+    refresh = request.query_params.get("refresh") in ("1", "true")
+    return Response(route_planner.driver_route(driver_id, refresh=refresh), status=200)
+
+
+def _report_range(request):
+    """
+    Parses ?from=&to= (YYYY-MM-DD, default the last 30 days). Returns (start, end, error).
+    """
+    try:
+        end = parse_date(request.query_params["to"]) if "to" in request.query_params else timezone.localdate()
+        start = parse_date(request.query_params["from"]) if "from" in request.query_params else end - timedelta(days=29)
+    except ValueError:
+        end = start = None
+    if start is None or end is None:
+        return None, None, "from and to must be dates (YYYY-MM-DD)."
+    if start > end or (end - start).days >= settings.ANALYTICS_MAX_DAYS:
+        return None, None, f"The range must run forwards and span at most {settings.ANALYTICS_MAX_DAYS} days."
+    return start, end, None
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def analytics_statuses(request):
+    """
+    Parcels entering and leaving each status per day, and the current count per status.
+    """
+    start, end, error = _report_range(request)
+    if error:
+        return Response({"error": error}, status=400)
+    return Response(analytics.status_report(start, end), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def analytics_revenue(request):
+    """
+    Parcel value entering each payment status per day, with range totals.
+    """
+    start, end, error = _report_range(request)
+    if error:
+        return Response({"error": error}, status=400)
+    return Response(analytics.revenue_report(start, end), status=200)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def analytics_drivers(request):
+    """
+    Assignments and deliveries per driver over the range, busiest first, or
+    per day for one driver with ?driver=.
+    """
+    start, end, error = _report_range(request)
+    if error:
+        return Response({"error": error}, status=400)
+    driver_id = request.query_params.get("driver")
+    if driver_id is not None and not driver_id.isdigit():
+        return Response({"error": "driver must be a driver id."}, status=400)
+    return Response(analytics.driver_report(start, end, int(driver_id) if driver_id else None), status=200)
+
+
+def _query_date(params, name):
+    """
+    An optional YYYY-MM-DD query parameter; raises ValueError when it isn't a date.
+    """
+    if name not in params:
+        return None
+    value = parse_date(params[name])
+    if value is None:
+        raise ValueError(f"{name} is not a date")
+    return value
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated, IsAdmin])
+def export_parcels(request):
+    """
+    Streams every matching parcel as a file download. ?output=csv (default),
+    ndjson, parquet or arrow; filters: status (repeatable), payment_status,
+    driver, from and to (created date, YYYY-MM-DD, inclusive), archived=0 to
+    leave out archived parcels. The rows are read from a replica when there
+    is one.
+    """
+    params = request.query_params
+    file_format = params.get("output", "csv")
+    if file_format not in export.available_formats():
+        return Response({"error": f"output must be one of {', '.join(export.available_formats())}."}, status=400)
+    driver = params.get("driver")
+    if driver is not None and not driver.isdigit():
+        return Response({"error": "driver must be a driver id."}, status=400)
+    try:
+        created_from = _query_date(params, "from")
+        created_to = _query_date(params, "to")
+    except ValueError:
+        return Response({"error": "from and to must be dates (YYYY-MM-DD)."}, status=400)
+
+    parcels = export.parcels(
+        statuses=params.getlist("status"), payment_status=params.get("payment_status"),
+        driver_id=int(driver) if driver else None, created_from=created_from, created_to=created_to,
+        archived=params.get("archived") != "0",
+    ).using(db_router.read_alias(request.user))  # Streamed after the view returns, so routed explicitly
+    content_type, extension, _ = export.FORMATS[file_format]
+    response = StreamingHttpResponse(export.stream(parcels, file_format), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="parcels-{timezone.now():%Y%m%d-%H%M%S}.{extension}"'
+    return response
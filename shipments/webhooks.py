@@ -0,0 +1,122 @@
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import metrics, payments
+from .models import StripeEvent
+
+logger = logging.getLogger(__name__)
+
+RECEIVED = "stripe_events.received"
+DUPLICATE = "stripe_events.duplicate"
+PROCESSED = "stripe_events.processed"
+FAILED = "stripe_events.failed"
+DEAD = "stripe_events.dead"
+COUNTERS = (RECEIVED, DUPLICATE, PROCESSED, FAILED, DEAD)
+
+
+def _intent_event(obj):
+    if not payments.handle_intent_event(obj):
+        logger.warning(f"No payment attempt or parcel matches intent {obj['id']}")
+
+
+def _charge_refunded(obj):
+    if not payments.refund(obj.get("payment_intent"), obj.get("amount_refunded", 0), obj.get("refunded", False), obj.get("metadata")):
+        logger.warning(f"No payment attempt or parcel matches refunded charge {obj['id']}")
+
+
+# Handlers must be idempotent and order-independent: Stripe retries and
+# reorders deliveries, and batches may run on several workers at once
+HANDLERS = {
+    "payment_intent.succeeded": _intent_event,
+    "payment_intent.payment_failed": _intent_event,
+    "payment_intent.canceled": _intent_event,
+    "charge.refunded": _charge_refunded,
+}
+
+
+def ingest(event):
+    """
+    Stores a verified webhook event (the decoded JSON body) for the worker.
+    Returns False for duplicates and for event types nothing handles.
+    """
+    if event["type"] not in HANDLERS:
+        return False
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(
+                stripe_id=event["id"],
+                type=event["type"],
+                payload=event,
+                created=datetime.fromtimestamp(event["created"], tz=dt_timezone.utc),
+            )
+    except IntegrityError:
+        metrics.increment(DUPLICATE)
+        return False
+    metrics.increment(RECEIVED)
+    return True
+
+
+def process(batch_size=None):
+    """
+    Applies stored events in batches of up to STRIPE_EVENTS_BATCH_SIZE. A
+    batch and its processed marks commit together, so an event is applied
+    exactly once; each event runs in a savepoint so one failure doesn't
+    undo the rest. Rows are claimed with SKIP LOCKED, letting several
+    workers drain a burst in parallel. Returns the number of events settled.
+    """
+    batch_size = batch_size or settings.STRIPE_EVENTS_BATCH_SIZE
+    processed = 0
+    while True:
+        with transaction.atomic():
+            events = list(
+                StripeEvent.objects.select_for_update(skip_locked=True)
+                .filter(processed_at__isnull=True).order_by("created", "id")[:batch_size]
+            )
+            if not events:
+                break
+            now = timezone.now()
+            done, failed = [], []
+            for event in events:
+                try:
+                    with transaction.atomic():
+                        HANDLERS[event.type](event.payload["data"]["object"])
+                    done.append(event)
+                except Exception as e:
+                    logger.warning(f"Stripe event {event.stripe_id} ({event.type}) failed: {e}")
+                    event.attempts += 1
+                    event.last_error = str(e)
+                    if event.attempts >= settings.STRIPE_EVENTS_MAX_ATTEMPTS:
+                        logger.error(f"Dropping Stripe event {event.stripe_id} after {event.attempts} attempts")
+                        event.processed_at = now
+                    failed.append(event)
+            if done:
+                StripeEvent.objects.filter(pk__in=[event.pk for event in done]).update(processed_at=now)
+            if failed:
+                StripeEvent.objects.bulk_update(failed, ["attempts", "last_error", "processed_at"])
+        dead = sum(1 for event in failed if event.processed_at)
+        metrics.increment(PROCESSED, len(done))
+        metrics.increment(FAILED, len(failed) - dead)
+        metrics.increment(DEAD, dead)
+        processed += len(done) + dead
+        if failed or len(events) < batch_size:
+            break  # Failures wait for the next run rather than spinning
+    return processed
+
+
+def purge():
+    """
+    Deletes processed events older than STRIPE_EVENTS_RETENTION_DAYS. Stripe
+    retries for up to three days, so the retention must outlast that for
+    duplicates to keep being recognised.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.STRIPE_EVENTS_RETENTION_DAYS)
+    deleted, _ = StripeEvent.objects.filter(processed_at__lt=cutoff).delete()
+    return deleted
+
+
+def stats():
+    counters = metrics.get_counters(COUNTERS)
+    counters["pending"] = StripeEvent.objects.filter(processed_at__isnull=True).count()
+    return counters